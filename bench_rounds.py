@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# bench_rounds.py
+# 對離線回放站（thsrc_replay_server.py）逐階段計時：
+#   查詢（thsrc_async）：launch / goto / close_consent / fill / captcha / submit_and_wait_step2 / scrape / save
+#   thsrc_auto_book_v2.run_once：launch / goto / close_consent / fill / captcha / submit / pick / step3
+# 不連官網，可重複執行；--json 存下結果、--baseline 與先前結果比較，超過容忍度即以非 0 結束。
+# 搜尋流程另記每輪流量（stage 名稱 net_kb，單位 KB）；--block-resources / --profile 可比較過濾與磁碟快取的效果。
+#
+# 需求:
+#   pip install playwright ddddocr
+#   python -m playwright install chromium
+#
+# 執行例:
+#   python bench_rounds.py --rounds 5 --scenario step2 --scenario error --json bench.json
+#   python bench_rounds.py --rounds 5 --baseline bench.json --tolerance 0.25
+#   python bench_rounds.py --suite search --rounds 5 --profile .bench_profile
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import thsrc_replay_server as replay
+
+# -----------------------------
+# 計時
+# -----------------------------
+class StageTimer:
+    def __init__(self):
+        self.samples = {}   # (suite, scenario, stage) -> [ms]
+
+    @contextmanager
+    def stage(self, suite, scenario, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            self.add(suite, scenario, name, ms)
+
+    def add(self, suite, scenario, name, value):
+        self.samples.setdefault((suite, scenario, name), []).append(value)
+
+    def summary(self):
+        out = {}
+        for (suite, scenario, name), xs in self.samples.items():
+            xs = sorted(xs)
+            out[f"{suite}/{scenario}/{name}"] = {
+                "n": len(xs),
+                "median_ms": round(statistics.median(xs), 1),
+                "p90_ms": round(xs[min(len(xs) - 1, int(len(xs) * 0.9))], 1),
+            }
+        return out
+
+class TraceSink:
+    """thsrc_trace 的 sink：把一輪紀錄的總時間、各 span 與流量（net_kb）轉交給 StageTimer。"""
+    def __init__(self, timer, suite, scenario):
+        self.timer, self.suite, self.scenario = timer, suite, scenario
+
+    def write(self, rec):
+        self.timer.add(self.suite, self.scenario, "round", rec["duration_ms"])
+        for sp in rec["spans"]:
+            self.timer.add(self.suite, self.scenario, sp["name"], sp["duration_ms"])
+        if "net_kb" in rec["attrs"]:
+            self.timer.add(self.suite, self.scenario, "net_kb", rec["attrs"]["net_kb"])
+
+# -----------------------------
+# 查詢流程（thsrc_async，thsrc_search_v2_plus 也是走它）
+# -----------------------------
+def bench_search(timer, base_url, scenario, rounds, engine, headless, block_resources=False, profile=""):
+    import asyncio
+    import thsrc_search_v2_plus as s
+    from thsrc_async import AsyncSearchEngine, search_and_save_async
+
+    query = s.SearchQuery(origin="台北", dest="台中", date="2025-10-20", time="15:00",
+                          adult=0, student=1, engine=engine, headless=headless,
+                          url=f"{base_url}?scenario={scenario}",
+                          block_resources=block_resources, profile=profile, measure_net=True)
+    out_csv = Path(tempfile.mkdtemp()) / "bench.csv"
+    sink = TraceSink(timer, "search", scenario)
+
+    async def run():
+        # max_rounds=1：每輪重開瀏覽器，launch 量的是冷啟動
+        async with AsyncSearchEngine(concurrency=1, max_rounds=1) as eng:
+            for _ in range(rounds):
+                await search_and_save_async(eng, query, str(out_csv), trace_sink=sink)
+
+    asyncio.run(run())
+
+# -----------------------------
+# thsrc_auto_book_v2.run_once
+# -----------------------------
+def bench_auto_book(timer, base_url, scenario, rounds, engine, headless):
+    import thsrc_auto_book_v2 as b
+    from playwright.sync_api import sync_playwright
+
+    b.URL = f"{base_url}?scenario={scenario}"
+    b.CONFIG["search"].update({"origin": "台北", "dest": "台中", "date": "2025-10-20", "time": "15:00",
+                               "adult": 0, "student": 1, "discount_key": "學生5折"})
+    b.CONFIG["browser"].update({"use_edge": engine == "edge", "headless": headless})
+    b.CONFIG["notify"]["enabled"] = False
+    stage = lambda name: timer.stage("auto_book", scenario, name)
+
+    with sync_playwright() as p:
+        for _ in range(rounds):
+            with stage("round"):
+                with stage("launch"):
+                    browser, ctx = b.new_browser_context(p, None)
+                    page = ctx.new_page()
+                try:
+                    with stage("goto"):
+                        page.goto(b.URL, wait_until="domcontentloaded", timeout=60000)
+                    with stage("close_consent"):
+                        b.close_consent(page)
+                        b.wait_ajax_idle(page, 15000)
+                    with stage("fill"):
+                        b.fill_search(page)
+                    with stage("captcha"):
+                        if not b.handle_captcha(page):
+                            raise RuntimeError("captcha failed")
+                    with stage("submit_and_wait_step2"):
+                        if not b.submit_and_wait_step2(page, max_submit_retries=6):
+                            raise RuntimeError("submit failed")
+                    with stage("pick"):
+                        if not b.parse_and_pick_discount(page):
+                            raise RuntimeError("no match")
+                    with stage("step3"):
+                        if not b.step3_fill_and_submit(page):
+                            raise RuntimeError("step3 failed")
+                finally:
+                    ctx.close()
+                    if browser is not None:
+                        browser.close()
+
+# -----------------------------
+# 報表與回歸比較
+# -----------------------------
+def print_table(summary):
+    print(f"{'stage':<48}{'n':>4}{'median ms':>12}{'p90 ms':>12}")
+    for k, v in summary.items():
+        print(f"{k:<48}{v['n']:>4}{v['median_ms']:>12.1f}{v['p90_ms']:>12.1f}")
+
+def compare(summary, baseline, tolerance):
+    """回傳比 baseline 慢超過 tolerance（比例）的階段清單。"""
+    slower = []
+    for k, v in summary.items():
+        old = baseline.get(k)
+        if not old or old["median_ms"] <= 0:
+            continue
+        ratio = v["median_ms"] / old["median_ms"]
+        if ratio > 1 + tolerance:
+            slower.append((k, old["median_ms"], v["median_ms"], ratio))
+    return slower
+
+def main():
+    ap = argparse.ArgumentParser(description="THSR 查詢 / 訂位流程逐階段 benchmark（離線回放站）")
+    ap.add_argument("--rounds", type=int, default=3, help="每個情境跑幾輪")
+    ap.add_argument("--scenario", action="append", choices=replay.SCENARIOS,
+                    help="要跑的情境，可重複；預設 step2")
+    ap.add_argument("--suite", choices=["search", "auto_book", "all"], default="all")
+    ap.add_argument("--engine", choices=["edge", "chromium"], default="chromium")
+    ap.add_argument("--headed", action="store_true", help="顯示瀏覽器視窗")
+    ap.add_argument("--submit-delay", type=int, default=300, help="回放站送出查詢延遲（毫秒）")
+    ap.add_argument("--block-resources", action="store_true", help="搜尋流程啟用資源過濾")
+    ap.add_argument("--profile", default="", help="搜尋流程使用持久化 profile 目錄（磁碟快取）")
+    ap.add_argument("--json", default="", help="把結果存成 JSON")
+    ap.add_argument("--baseline", default="", help="與先前 --json 的結果比較")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="median 比 baseline 慢超過此比例即視為退步")
+    args = ap.parse_args()
+
+    scenarios = args.scenario or ["step2"]
+    srv, base_url = replay.serve_in_background(replay.ReplayConfig(submit_delay_ms=args.submit_delay))
+    os.environ["THSRC_URL"] = base_url
+    timer = StageTimer()
+    try:
+        for sc in scenarios:
+            if args.suite in ("search", "all"):
+                bench_search(timer, base_url, sc, args.rounds, args.engine, not args.headed,
+                             args.block_resources, args.profile)
+            if args.suite in ("auto_book", "all"):
+                bench_auto_book(timer, base_url, sc, args.rounds, args.engine, not args.headed)
+    finally:
+        srv.shutdown()
+
+    summary = timer.summary()
+    print_table(summary)
+    if args.json:
+        Path(args.json).write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        slower = compare(summary, baseline, args.tolerance)
+        for k, old, new, ratio in slower:
+            print(f"退步：{k} {old:.1f} → {new:.1f} ms（{ratio:.2f}x）")
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
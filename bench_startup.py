@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# bench_startup.py
+# 啟動成本 benchmark：每個模組以 `python -X importtime -c "import 模組"` 在新直譯器載入，解析 stderr 的
+# import 樹，報告總載入時間與最慢的幾個子 import；另外量 CLI 的 --help 與參數錯誤（應以 exit code 2 結束）
+# 從啟動到結束的時間。
+#   - 任一模組載入超過 --budget-ms、CLI 超過 --cli-budget-ms，或 import 時就載入了重量級套件
+#     （playwright / ddddocr / onnxruntime / numpy / cv2 / PIL）即以非 0 結束，可放進本機的檢查流程。
+#   - 每項跑 --repeat 次取最小值，降低磁碟快取與排程雜訊。
+#
+# 需求：只用標準函式庫（不需要安裝 playwright / ddddocr 也能跑）。
+#
+# 執行例:
+#   python bench_startup.py
+#   python bench_startup.py --budget-ms 120 --top 15 --json startup.json
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+
+MODULES = ["thsrc_search_v2_plus", "thsrc_async", "thsrc_watch", "thsrc_scheduler", "thsrc_auto_book_v2"]
+HEAVY = ("playwright", "ddddocr", "onnxruntime", "numpy", "cv2", "PIL")
+
+# (名稱, argv, 預期 exit code)
+CLI_CASES = [
+    ("search --help", ["thsrc_search_v2_plus.py", "--help"], 0),
+    ("search bad station", ["thsrc_search_v2_plus.py", "--origin", "火星", "--dest", "台中",
+                            "--date", "2025-10-20", "--time", "15:00"], 2),
+    ("search bad date", ["thsrc_search_v2_plus.py", "--origin", "台北", "--dest", "台中",
+                         "--date", "2025/10/20", "--time", "15:00"], 2),
+    ("watch --help", ["thsrc_watch.py", "--help"], 0),
+    ("async --help", ["thsrc_async.py", "--help"], 0),
+]
+
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def parse_importtime(stderr: str):
+    """解析 -X importtime 輸出，回傳 list[(name, self_us, cumulative_us, depth)]。"""
+    out = []
+    for line in stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            out.append((m.group(4), int(m.group(1)), int(m.group(2)), (len(m.group(3)) - 1) // 2))
+    return out
+
+def measure_import(module: str):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=HERE, capture_output=True, text=True, encoding="utf-8", errors="replace")
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} 失敗：{proc.stderr.strip().splitlines()[-1:]}")
+    entries = parse_importtime(proc.stderr)
+    total = next((cum for name, _, cum, depth in entries if name == module and depth == 0), 0)
+    return total / 1000, entries
+
+def measure_cli(argv, expect_code: int):
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, *argv], cwd=HERE, capture_output=True, text=True,
+                          encoding="utf-8", errors="replace")
+    ms = (time.perf_counter() - t0) * 1000
+    return ms, proc.returncode == expect_code, proc.returncode
+
+def heavy_imports(entries):
+    return sorted({name.split(".")[0] for name, _, _, _ in entries if name.split(".")[0] in HEAVY})
+
+def main():
+    ap = argparse.ArgumentParser(description="模組載入與 CLI 啟動時間 benchmark（-X importtime）")
+    ap.add_argument("--module", action="append", help="要量的模組，可重複；預設為主要腳本")
+    ap.add_argument("--repeat", type=int, default=3, help="每項跑幾次取最小值")
+    ap.add_argument("--budget-ms", type=float, default=150, help="單一模組載入時間上限（毫秒）")
+    ap.add_argument("--cli-budget-ms", type=float, default=400, help="CLI --help / 參數錯誤從啟動到結束的上限（毫秒）")
+    ap.add_argument("--top", type=int, default=10, help="列出最慢的幾個子 import（cumulative）")
+    ap.add_argument("--no-cli", action="store_true", help="只量模組載入，不跑 CLI")
+    ap.add_argument("--json", default="", help="把結果存成 JSON")
+    args = ap.parse_args()
+
+    repeat = max(1, args.repeat)
+    failures = []
+    report = {"modules": {}, "cli": {}}
+
+    print(f"{'module':<28}{'import ms':>12}{'budget':>10}  heavy")
+    for module in args.module or MODULES:
+        best, best_entries = None, []
+        for _ in range(repeat):
+            ms, entries = measure_import(module)
+            if best is None or ms < best:
+                best, best_entries = ms, entries
+        heavy = heavy_imports(best_entries)
+        over = best > args.budget_ms
+        print(f"{module:<28}{best:>12.1f}{args.budget_ms:>10.0f}  {', '.join(heavy) or '-'}{'  ← 超過' if over else ''}")
+        slowest = sorted((e for e in best_entries if e[0] != module), key=lambda e: -e[2])[:args.top]
+        for name, _, cum, depth in slowest:
+            print(f"    {'  ' * min(depth, 4)}{name:<40}{cum / 1000:>8.1f} ms")
+        report["modules"][module] = {
+            "import_ms": round(best, 1), "heavy": heavy,
+            "slowest": [{"name": n, "cumulative_ms": round(c / 1000, 1)} for n, _, c, _ in slowest],
+        }
+        if over:
+            failures.append(f"import {module} {best:.1f} ms > {args.budget_ms:.0f} ms")
+        if heavy:
+            failures.append(f"import {module} 載入了重量級套件：{', '.join(heavy)}")
+
+    if not args.no_cli:
+        print()
+        print(f"{'cli':<28}{'wall ms':>12}{'budget':>10}  exit")
+        for name, argv, expect in CLI_CASES:
+            runs = [measure_cli(argv, expect) for _ in range(repeat)]
+            best = min(ms for ms, _, _ in runs)
+            ok = all(good for _, good, _ in runs)
+            code = runs[-1][2]
+            over = best > args.cli_budget_ms
+            print(f"{name:<28}{best:>12.1f}{args.cli_budget_ms:>10.0f}  {code}"
+                  f"{'' if ok else f'（預期 {expect}）'}{'  ← 超過' if over else ''}")
+            report["cli"][name] = {"wall_ms": round(best, 1), "exit": code, "expected_exit": expect}
+            if over:
+                failures.append(f"{name} {best:.1f} ms > {args.cli_budget_ms:.0f} ms")
+            if not ok:
+                failures.append(f"{name} exit code {code}，預期 {expect}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    if failures:
+        print()
+        for f in failures:
+            print(f"未通過：{f}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
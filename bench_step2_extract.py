@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# bench_step2_extract.py
+# 比較 Step2 車次擷取的舊路徑（逐列逐欄 Playwright 往返）與新路徑（一次 page.evaluate）。
+# 使用存檔的 fixtures/step2.html，不連線高鐵網站。
+#
+# 需求:
+#   pip install playwright
+#   python -m playwright install chromium
+#
+# 執行例:
+#   python bench_step2_extract.py --repeat 30
+#   python bench_step2_extract.py --repeat 10 --scale 5     # 把 10 列複製成 50 列
+
+import argparse
+import statistics
+import time
+from pathlib import Path
+
+from playwright.sync_api import sync_playwright
+
+from thsrc_browser import STEP2_ROWS_SELECTOR, extract_step2_rows
+
+FIXTURE = Path(__file__).with_name("fixtures") / "step2.html"
+
+# -----------------------------
+# 舊路徑（照搬改版前的寫法）
+# -----------------------------
+def legacy_scrape(page):
+    root = page.locator("#BookingS2Form_TrainQueryDataViewPanel")
+    rows = root.locator(".result-listing label.result-item")
+    n = rows.count()
+    data = []
+    for i in range(n):
+        row = rows.nth(i)
+        radio = row.locator("input.uk-radio")
+        departure = radio.get_attribute("querydeparture") or ""
+        arrival = radio.get_attribute("queryarrival") or ""
+        estimated = radio.get_attribute("queryestimatedtime") or ""
+        code = radio.get_attribute("querycode") or ""
+        date = radio.get_attribute("querydeparturedate") or ""
+        discount_text = row.locator(".discount span").all_inner_texts()
+        discount_text = " ".join([t.strip() for t in discount_text if t.strip()])
+        selected = (radio.is_checked() or "active" in (row.get_attribute("class") or ""))
+        data.append((date, code, departure, arrival, estimated, discount_text, selected))
+    return data
+
+def legacy_pick(page, key):
+    items = page.locator(STEP2_ROWS_SELECTOR)
+    for i in range(items.count()):
+        if key in items.nth(i).locator(".discount").inner_text(timeout=800).strip():
+            return i
+    return -1
+
+# -----------------------------
+# 新路徑
+# -----------------------------
+def bulk_scrape(page):
+    return [
+        (r["date"], r["code"], r["departure"], r["arrival"], r["estimated"], r["discount_text"], r["selected"])
+        for r in extract_step2_rows(page)
+    ]
+
+def bulk_pick(page, key):
+    for i, r in enumerate(extract_step2_rows(page)):
+        if key in r["discount_raw"]:
+            return i
+    return -1
+
+# -----------------------------
+# 量測
+# -----------------------------
+def timeit(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return result, samples
+
+def report(name, samples):
+    print(f"  {name:<8} median {statistics.median(samples):8.2f} ms   "
+          f"mean {statistics.mean(samples):8.2f} ms   min {min(samples):8.2f} ms")
+
+def scaled_fixture(scale: int) -> str:
+    html = FIXTURE.read_text(encoding="utf-8")
+    if scale <= 1:
+        return html
+    head, rest = html.split('<section class="result-listing">', 1)
+    body, tail = rest.split("</section>", 1)
+    return head + '<section class="result-listing">' + body * scale + "</section>" + tail
+
+def main():
+    ap = argparse.ArgumentParser(description="Step2 擷取 benchmark：逐列往返 vs 一次 evaluate")
+    ap.add_argument("--repeat", type=int, default=20, help="每種路徑重複次數")
+    ap.add_argument("--scale", type=int, default=1, help="把 fixture 的車次列複製幾倍")
+    ap.add_argument("--key", default="學生5折", help="挑選班次用的折扣關鍵字")
+    ap.add_argument("--engine", choices=["edge", "chromium"], default="chromium")
+    args = ap.parse_args()
+
+    with sync_playwright() as p:
+        launch_kwargs = dict(headless=True)
+        if args.engine == "edge":
+            launch_kwargs["channel"] = "msedge"
+        browser = p.chromium.launch(**launch_kwargs)
+        page = browser.new_page()
+        page.set_content(scaled_fixture(args.scale))
+
+        legacy_rows, legacy_ms = timeit(lambda: legacy_scrape(page), args.repeat)
+        bulk_rows, bulk_ms = timeit(lambda: bulk_scrape(page), args.repeat)
+        if legacy_rows != bulk_rows:
+            raise SystemExit("新舊路徑擷取結果不一致！")
+
+        legacy_idx, legacy_pick_ms = timeit(lambda: legacy_pick(page, args.key), args.repeat)
+        bulk_idx, bulk_pick_ms = timeit(lambda: bulk_pick(page, args.key), args.repeat)
+        if legacy_idx != bulk_idx:
+            raise SystemExit("新舊路徑挑選結果不一致！")
+
+        browser.close()
+
+    print(f"fixture: {FIXTURE.name} ×{args.scale}（{len(bulk_rows)} 列），每種路徑 {args.repeat} 次")
+    print("scrape_trains_on_step2")
+    report("legacy", legacy_ms)
+    report("bulk", bulk_ms)
+    print(f"  加速 {statistics.median(legacy_ms) / statistics.median(bulk_ms):.1f}x")
+    print(f"parse_and_pick_discount（key={args.key}，命中第 {bulk_idx} 列）")
+    report("legacy", legacy_pick_ms)
+    report("bulk", bulk_pick_ms)
+    print(f"  加速 {statistics.median(legacy_pick_ms) / statistics.median(bulk_pick_ms):.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# 測試直接 import 專案根目錄的模組（本專案不是套件）。
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
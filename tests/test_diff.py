@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# thsrc_diff.DiffStore：區間與 appeared / disappeared 事件、游標與 SqliteStore.hits_since 一致。
+import pytest
+
+import thsrc_search_v2_plus as scraper
+from thsrc_diff import DiffStore, query_key
+from thsrc_rows import TrainRow
+from thsrc_search_v2_plus import SearchQuery, save_results, search_and_save
+from thsrc_store import SqliteStore
+
+QUERY = SearchQuery(origin="台北", dest="台中", date="2025-10-20", time="15:00", adult=0, student=1)
+KEY = query_key(QUERY)
+
+def _row(code: str, dep: str = "15:11", discount: str = "學生75折") -> dict:
+    return {"date": "10/20", "code": code, "departure": dep, "arrival": "16:15", "estimated": "1:04",
+            "student_discount": True, "discount_text": discount, "selected": False}
+
+@pytest.fixture
+def store(tmp_path):
+    db = DiffStore(str(tmp_path / "diff.db"))
+    yield db
+    db.close()
+
+def _events(db, after=0):
+    events, cursor = db.events_since(after)
+    return [(e["kind"], e["code"]) for e in events], cursor
+
+def _counts(db):
+    return {t: db.conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("intervals", "events")}
+
+def test_appeared_and_disappeared_across_rounds(store):
+    d1 = store.apply(KEY, [_row("837"), _row("655", "15:21")], seen_at="2025-10-18T10:00:00")
+    assert [r.code for r in d1.appeared] == ["837", "655"] and d1.disappeared == [] and d1.unchanged == 0
+    d2 = store.apply(KEY, [_row("837"), _row("1653", "15:46", "早鳥9折")], seen_at="2025-10-18T10:05:00")
+    assert [r.code for r in d2.appeared] == ["1653"] and [r.code for r in d2.disappeared] == ["655"]
+    assert d2.unchanged == 1
+    d3 = store.apply(KEY, [_row("1653", "15:46", "早鳥9折"), _row("655", "15:21")], seen_at="2025-10-18T10:10:00")
+    assert [r.code for r in d3.appeared] == ["655"] and [r.code for r in d3.disappeared] == ["837"]
+
+    events, cursor = _events(store)
+    assert events == [("appeared", "837"), ("appeared", "655"),
+                      ("appeared", "1653"), ("disappeared", "655"),
+                      ("appeared", "655"), ("disappeared", "837")]
+    assert cursor == 6
+    spans = {(r["code"], r["first_seen"]): (r["seen_until"], r["open"]) for r in store.intervals()}
+    # 消失的區間 last_seen = 上一輪成功的時間；仍在的區間看到 queries.last_seen
+    assert spans == {
+        ("837", "2025-10-18T10:00:00"): ("2025-10-18T10:05:00", 0),
+        ("655", "2025-10-18T10:00:00"): ("2025-10-18T10:00:00", 0),
+        ("1653", "2025-10-18T10:05:00"): ("2025-10-18T10:10:00", 1),
+        ("655", "2025-10-18T10:10:00"): ("2025-10-18T10:10:00", 1),
+    }
+
+def test_unchanged_round_only_touches_queries(store):
+    rows = [_row("837"), _row("655", "15:21")]
+    store.apply(KEY, rows, seen_at="2025-10-18T10:00:00")
+    before = _counts(store)
+    changes = store.conn.total_changes
+    diff = store.apply(KEY, list(reversed(rows)), seen_at="2025-10-18T10:05:00")
+    assert not diff and diff.unchanged == 2
+    assert _counts(store) == before
+    assert store.conn.total_changes - changes == 1       # 只有 queries 那一列
+    assert store.conn.execute("SELECT last_seen FROM queries").fetchone()[0] == "2025-10-18T10:05:00"
+    assert {r["seen_until"] for r in store.intervals()} == {"2025-10-18T10:05:00"}
+
+def test_failed_or_empty_rounds_keep_intervals_open(tmp_path, monkeypatch):
+    spec = f"diff:{tmp_path / 'diff.db'}"
+    save_results([_row("837")], str(tmp_path / "out.csv"), spec, QUERY)
+    # 沒有結果的輪次：save_results 不寫入
+    assert save_results([], str(tmp_path / "out.csv"), spec, QUERY) is None
+    # 抓票失敗或空結果的一輪：search_and_save 不會呼叫 save
+    def broken(*a, **kw):
+        raise RuntimeError("timeout")
+    monkeypatch.setattr(scraper, "search", broken)
+    with pytest.raises(RuntimeError):
+        search_and_save(QUERY, str(tmp_path / "out.csv"), spec)
+    monkeypatch.setattr(scraper, "search", lambda *a, **kw: [])
+    assert search_and_save(QUERY, str(tmp_path / "out.csv"), spec) == []
+
+    db = DiffStore(str(tmp_path / "diff.db"))
+    try:
+        assert [(r["code"], r["open"]) for r in db.intervals()] == [("837", 1)]
+        assert _events(db) == ([("appeared", "837")], 1)
+    finally:
+        db.close()
+    assert not (tmp_path / "out.csv").exists()
+
+def test_hits_since_cursor_matches_sqlite_store(tmp_path, store):
+    sqlite = SqliteStore(str(tmp_path / "history.db"))
+    try:
+        for db in (store, sqlite):
+            assert db.hits_since(0) == ([], 0)
+            assert db.hits_since(5) == ([], 5)               # 游標不倒退
+        first = [_row("837"), _row("655", "15:21", "早鳥9折")]
+        store.apply(KEY, first, seen_at="2025-10-18T10:00:00")
+        sqlite.insert_rows(first, scraped_at="2025-10-18T10:00:00")
+        cursors = {}
+        for name, db in (("diff", store), ("sqlite", sqlite)):
+            rows, cursor = db.hits_since(0, "學生")
+            # thsrc_watch 對兩種儲存都用 TrainRow.from_dict 轉換
+            assert [(r.code, r.departure, r.discount_text) for r in map(TrainRow.from_dict, rows)] == \
+                [("837", 911, "學生75折")]
+            assert cursor == 2                              # 游標跳過不符合 keyword 的列
+            assert db.hits_since(cursor, "學生") == ([], cursor)
+            cursors[name] = cursor
+        second = first + [_row("1653", "15:46", "學生5折")]
+        store.apply(KEY, second, seen_at="2025-10-18T10:05:00")
+        sqlite.insert_rows([_row("1653", "15:46", "學生5折")], scraped_at="2025-10-18T10:05:00")
+        for name, db in (("diff", store), ("sqlite", sqlite)):
+            rows, cursor = db.hits_since(cursors[name], "學生")
+            assert [r["code"] for r in rows] == ["1653"] and cursor == cursors[name] + 1
+    finally:
+        sqlite.close()
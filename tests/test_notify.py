@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# thsrc_notify：摘要合併、連線重用、重寄佇列、背景寄送。
+# SMTP 替身用標準函式庫寫在本檔（不加密、不登入），只聽 localhost。
+import json
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+from thsrc_notify import Mail, Notifier, NotifyWorker, RetryQueue, SmtpConfig, SmtpConnection
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line: str):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self._reply("220 localhost test")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode("utf-8", "replace").strip().split(" ", 1)[0].upper()
+            if cmd == "EHLO":
+                self._reply("250-localhost")
+                self._reply("250 8BITMIME")
+            elif cmd == "DATA":
+                self._reply("354 end with .")
+                body = []
+                while True:
+                    ln = self.rfile.readline()
+                    if not ln or ln in (b".\r\n", b".\n"):
+                        break
+                    body.append(ln)
+                with server.lock:
+                    server.messages.append(b"".join(body))
+                self._reply("250 OK")
+            elif cmd == "QUIT":
+                self._reply("221 bye")
+                return
+            else:                               # HELO / MAIL / RCPT / NOOP / RSET
+                self._reply("250 OK")
+
+class _SmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SmtpHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+
+@pytest.fixture
+def smtp_server():
+    server = _SmtpServer()
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _conn(port: int) -> SmtpConnection:
+    return SmtpConnection(SmtpConfig("127.0.0.1", port, starttls=False, timeout=2))
+
+def _closed_port() -> int:
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def _wait(cond, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return cond()
+
+# -----------------------------
+# Notifier
+# -----------------------------
+def test_two_hits_become_one_digest_over_one_connection(smtp_server, tmp_path):
+    sent = []
+    notifier = Notifier(_conn(smtp_server.server_address[1]), "me@example.com",
+                        retry_path=str(tmp_path / "q.jsonl"), digest_sec=60, on_sent=sent.extend)
+    notifier.notify("you@example.com", "837 學生75折", "<html><body>a</body></html>", keys=["k1"])
+    notifier.notify("you@example.com", "841 學生75折", "<html><body>b</body></html>", keys=["k2"])
+    assert notifier.poll() == 0                 # 還沒等滿 digest_sec
+    assert notifier.flush() == 1
+    assert len(smtp_server.messages) == 1 and sent == ["k1", "k2"]
+    # 下一封沿用同一條連線
+    notifier.notify("you@example.com", "845 學生75折", "<p>c</p>", keys=["k3"])
+    notifier.close()
+    assert len(smtp_server.messages) == 2
+    assert smtp_server.connections == 1 and notifier.conn.connects == 1
+
+def test_refused_connection_writes_retry_file(tmp_path):
+    path = tmp_path / "q.jsonl"
+    notifier = Notifier(_conn(_closed_port()), "me@example.com", retry_path=str(path))
+    notifier.notify("you@example.com", "837 學生75折", "<p>a</p>", keys=["k1"])
+    assert notifier.failed == 1 and notifier.pending_keys() == {"k1"}
+    items = [json.loads(ln) for ln in path.read_text(encoding="utf-8").splitlines()]
+    assert len(items) == 1 and items[0]["attempts"] == 1 and items[0]["keys"] == ["k1"]
+    assert items[0]["next_try"] > time.time()
+    # 重啟後從檔案讀回
+    assert RetryQueue(str(path)).pending_keys() == {"k1"}
+
+def test_retry_item_survives_crash_during_send(tmp_path):
+    path = str(tmp_path / "q.jsonl")
+    q = RetryQueue(path, base_sec=60)
+    q.push(Mail(to=["you@example.com"], subject="s", html="<p>a</p>", keys=["k1"]))
+    due = q.pop_due(now=time.time() + 3600)
+    assert len(due) == 1
+    # 還沒 done() 就當掉：檔案裡仍有這封信，且下次重寄時間已往後排
+    again = RetryQueue(path)
+    assert len(again) == 1 and again.items[0].attempts == 2
+    assert again.items[0].next_try > time.time() + 3600
+    q.done(due[0])
+    assert len(RetryQueue(path)) == 0
+
+def test_retry_is_delivered_and_removed(smtp_server, tmp_path):
+    path = tmp_path / "q.jsonl"
+    notifier = Notifier(_conn(_closed_port()), "me@example.com", retry_path=str(path))
+    notifier.notify("you@example.com", "837 學生75折", "<p>a</p>", keys=["k1"])
+    notifier.retry.items[0].next_try = 0
+    notifier.conn = _conn(smtp_server.server_address[1])
+    assert notifier.poll() == 1
+    assert len(notifier.retry) == 0 and path.read_text(encoding="utf-8") == ""
+    assert len(smtp_server.messages) == 1
+
+# -----------------------------
+# NotifyWorker
+# -----------------------------
+def test_dropped_mail_releases_its_dedupe_keys(tmp_path):
+    notifier = Notifier(_conn(_closed_port()), "me@example.com", retry_path=str(tmp_path / "q.jsonl"))
+    notifier.retry.max_attempts = 1             # 第一次失敗就放棄
+    worker = NotifyWorker(notifier)
+    try:
+        assert worker.notify("you@example.com", "837 學生75折", "<p>a</p>", keys=["k1"])
+        assert "k1" in worker.pending_keys()
+        assert _wait(lambda: not worker.pending_keys())
+        assert worker.drain() == [] and len(notifier.retry) == 0
+    finally:
+        worker.close(timeout=5)
+
+class _StuckConnection:
+    """send() 卡住直到 release 被設定，模擬 SMTP 伺服器不回應。"""
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def send(self, msg):
+        self.started.set()
+        self.release.wait(30)
+
+    def close(self):
+        pass
+
+def test_close_returns_within_timeout_when_queue_is_full():
+    conn = _StuckConnection()
+    worker = NotifyWorker(Notifier(conn, "me@example.com"), maxsize=1, put_timeout=0.1)
+    try:
+        assert worker.notify("you@example.com", "a", "<p>a</p>", keys=["k1"])
+        assert conn.started.wait(5)                 # 背景執行緒卡在寄送
+        assert worker.notify("you@example.com", "b", "<p>b</p>", keys=["k2"])
+        assert not worker.notify("you@example.com", "c", "<p>c</p>", keys=["k3"])    # 佇列已滿
+        assert "k3" not in worker.pending_keys()
+        t0 = time.monotonic()
+        worker.close(timeout=0.5)
+        assert time.monotonic() - t0 < 2
+    finally:
+        conn.release.set()
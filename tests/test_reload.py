@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# thsrc_reload.ConfigFile 與 thsrc_auto_book_v2 的設定覆寫檔：寫壞的編輯沿用目前設定、刪掉的鍵回到預設。
+import copy
+import json
+import os
+
+import pytest
+
+import thsrc_auto_book_v2 as auto_book
+from thsrc_reload import ConfigFile, merge_config
+
+class _Editor:
+    """寫入覆寫檔，每次把 mtime 往後推，避免同一個時間戳內的兩次存檔被當成沒變。"""
+    def __init__(self, path):
+        self.path = path
+        self.stamp = 1_700_000_000
+
+    def write(self, text):
+        self.path.write_text(text, encoding="utf-8")
+        self.stamp += 10
+        os.utime(self.path, (self.stamp, self.stamp))
+
+    def dump(self, override):
+        self.write(json.dumps(override, ensure_ascii=False))
+
+@pytest.fixture
+def config(monkeypatch):
+    """測試中 apply_config 會原地改 CONFIG；結束後還原。"""
+    saved = copy.deepcopy(auto_book.CONFIG)
+    monkeypatch.setattr(auto_book, "close_notifier", lambda: None)
+    yield auto_book.CONFIG
+    auto_book.CONFIG.clear()
+    auto_book.CONFIG.update(saved)
+
+def test_poll_only_on_change(tmp_path):
+    ed = _Editor(tmp_path / "override.json")
+    ed.dump({"a": 1})
+    conf = ConfigFile(str(ed.path))
+    assert conf.poll() is None
+    ed.dump({"a": 2})
+    assert conf.poll() == {"a": 2} and conf.poll() is None
+    conf.request()                              # SIGHUP：沒改檔也重讀
+    assert conf.poll() == {"a": 2} and conf.reloads == 2
+
+def test_broken_edit_keeps_current_config(tmp_path, config):
+    ed = _Editor(tmp_path / "override.json")
+    ed.dump({"search": {"time": "09:00"}})
+    watch = ConfigFile(str(ed.path), auto_book.load_config_file)
+    ed.dump({"search": {"time": "09:30"}})
+    conf = watch.poll()
+    assert conf["search"]["time"] == "09:30"
+    assert auto_book.apply_config(conf)         # 查詢條件變了
+    assert config["search"]["time"] == "09:30"
+
+    ed.write('{"search": {"time": "10:00"')     # 存到一半的 JSON
+    assert watch.poll() is None
+    ed.dump({"search": {"time": "10:10"}})      # 不合法的時段
+    assert watch.poll() is None
+    ed.dump({"serch": {"time": "10:00"}})       # 打錯字的鍵
+    assert watch.poll() is None
+    ed.write("[]")
+    assert watch.poll() is None
+    assert watch.failures == 4
+    assert config["search"]["time"] == "09:30"
+
+def test_removed_key_reverts_to_base(tmp_path, config):
+    base = auto_book.BASE_CONFIG
+    path = tmp_path / "override.json"
+    ed = _Editor(path)
+    ed.dump({"search": {"time": "09:00", "discount_key": "學生<=75折"}, "watch": {"interval_min": 5}})
+    conf = auto_book.load_config_file(str(path))
+    assert conf["search"]["time"] == "09:00" and conf["watch"]["interval_min"] == 5
+    auto_book.apply_config(conf)
+    # 刪掉 time 與 watch：不是沿用上一次的值，而是回到 BASE_CONFIG
+    ed.dump({"search": {"discount_key": "學生<=75折"}})
+    conf = auto_book.load_config_file(str(path))
+    assert conf["search"]["time"] == base["search"]["time"]
+    assert conf["watch"] == base["watch"]
+    assert auto_book.apply_config(conf)
+    assert config["search"]["time"] == base["search"]["time"]
+    assert config["search"]["discount_key"] == "學生<=75折"
+    assert conf == merge_config(base, {"search": {"discount_key": "學生<=75折"}})
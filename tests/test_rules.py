@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# thsrc_rules：規則解析與比對（表格式測試）。
+import pytest
+
+from thsrc_rules import ANY, RuleSet, Term, compile_rules, parse_rule, parse_term
+from thsrc_rows import parse_discounts
+
+# -----------------------------
+# 解析
+# -----------------------------
+@pytest.mark.parametrize("text, term", [
+    ("學生5折", Term("student", "==", 50)),
+    ("學生75折", Term("student", "==", 75)),
+    ("學生=75折", Term("student", "==", 75)),
+    ("學生<=75折", Term("student", "<=", 75)),
+    ("學生≤75折", Term("student", "<=", 75)),
+    ("student<=75", Term("student", "<=", 75)),
+    ("學生<8折", Term("student", "<", 80)),
+    ("學生<=7.5折", Term("student", "<=", 75)),
+    ("學生7.5折", Term("student", "==", 75)),
+    ("早鳥", Term("early", "==", None)),
+    ("early-bird", Term("early", "==", None)),
+    ("<=65折", Term(ANY, "<=", 65)),
+    ("*<=65折", Term(ANY, "<=", 65)),
+    ("學⽣<=75折", Term("student", "<=", 75)),     # 網站的相容字
+])
+def test_parse_term(text, term):
+    assert parse_term(text) == term
+
+@pytest.mark.parametrize("text", ["", "<=", "學生<=", "學生<=123折", "學生<=75折折"])
+def test_parse_term_rejects(text):
+    with pytest.raises(ValueError):
+        parse_term(text)
+
+def test_parse_rule_alternatives_and_conjunctions():
+    assert parse_rule("學生<=75折,早鳥<=8折") == [(Term("student", "<=", 75),), (Term("early", "<=", 80),)]
+    assert parse_rule("學生<=75折，早鳥") == [(Term("student", "<=", 75),), (Term("early", "==", None),)]
+    assert parse_rule("早鳥 學生") == [(Term("early", "==", None), Term("student", "==", None))]
+    with pytest.raises(ValueError):
+        parse_rule(" , ")
+
+# -----------------------------
+# 比對
+# -----------------------------
+@pytest.mark.parametrize("spec, text, hit", [
+    # 剛好幾折：學生5折 不能命中 學生75折（舊的子字串比對會誤判）
+    ("學生5折", "學生5折", True),
+    ("學生5折", "學生75折", False),
+    ("學生5折", "早鳥5折", False),
+    ("學生75折", "早鳥9折 學生75折", True),
+    # <= 與 <
+    ("學生<=75折", "學生75折", True),
+    ("學生<=75折", "學生5折", True),
+    ("學生<=75折", "學生8折", False),
+    ("學生<75折", "學生75折", False),
+    ("學生<75折", "學生7折", True),
+    ("學生<8折", "學生75折", True),
+    # 小數折數
+    ("學生<=7.5折", "學生75折", True),
+    ("學生7.5折", "學生75折", True),
+    ("學生<=75折", "學生7.5折", True),
+    ("學生<=7.5折", "學生8折", False),
+    # 只寫類別
+    ("早鳥", "早鳥9折", True),
+    ("早鳥", "學生75折", False),
+    ("<=65折", "早鳥65折", True),
+    ("<=65折", "學生75折", False),
+    # 複合規則
+    ("學生<=75折,早鳥<=8折", "早鳥8折", True),
+    ("學生<=75折,早鳥<=8折", "早鳥9折", False),
+    ("學生<=75折,早鳥<=8折", "早鳥9折 學生75折", True),
+    ("早鳥 學生", "早鳥9折 學生75折", True),
+    ("早鳥 學生", "學生75折", False),
+    ("學生>=8折", "學生88折", True),
+    ("學生>=8折", "學生75折", False),
+    ("學生88折", "", False),
+])
+def test_match(spec, text, hit):
+    assert compile_rules(spec).test_text(text) is hit
+    # RuleSet 的分桶比對與逐條 Term.test 結果一致
+    assert any(all(t.test(parse_discounts(text)) for t in alt) for alt in parse_rule(spec)) is hit
+
+def test_ruleset_matches_many_subscriptions_at_once():
+    rules = RuleSet()
+    rules.add("a", "學生5折")
+    rules.add("b", "學生<=75折")
+    rules.add("c", "學生<8折,早鳥<=8折")
+    rules.add("d", "早鳥 學生")
+    assert len(rules) == 4
+    assert rules.match_text("學生75折") == {"b", "c"}
+    assert rules.match_text("學生5折") == {"a", "b", "c"}
+    assert rules.match_text("早鳥8折 學生88折") == {"c", "d"}
+    assert rules.match_text("") == set()
+
+def test_ruleset_rejects_bad_spec():
+    with pytest.raises(ValueError):
+        RuleSet().add("x", "學生<=")
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# thsrc_scheduler：優先佇列、速率上限與固定速率排程（假時鐘）、自適應間隔、
+# 合併訂閱（coalesce / fan_out / SearchGroup 拆出與併回）、查詢清單熱載入（reload_groups）。
+from datetime import datetime, timedelta
+
+import pytest
+
+from thsrc_rows import TrainRow, hhmm_to_min, parse_discount_rate
+from thsrc_scheduler import (COVER_MIN, FAR_DAYS, LAST_TRAIN_MIN, NEAR_HOURS, AdaptivePolicy, RateLimiter,
+                             Scheduler, SearchGroup, WatchJob, coalesce, fan_out, next_deadline, reload_groups)
+from thsrc_search_v2_plus import SearchQuery
+from thsrc_watch import compile_job_rules
+
+def _job(id, time, keyword="學生88折", date="2025-10-20", origin="台北", dest="台中", **kw) -> WatchJob:
+    return WatchJob(id=id, query=SearchQuery(origin=origin, dest=dest, date=date, time=time, adult=0, student=1),
+                    keyword=keyword, **kw)
+
+def _row(dep: str, discount: str = "", code: str = "") -> TrainRow:
+    t = hhmm_to_min(dep)
+    return TrainRow(date=None, code=code or dep.replace(":", ""), departure=t, arrival=t + 60, duration=60,
+                    discount_text=discount, discount_rate=parse_discount_rate(discount), selected=False)
+
+def _ids(groups):
+    return sorted(sorted(m.id for m in g.members) for g in groups)
+
+class _Clock:
+    """假時鐘：sleep 直接把時間往後推。"""
+    def __init__(self, t: float = 0.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+    def sleep(self, sec: float):
+        self.t += sec
+
+# -----------------------------
+# Scheduler
+# -----------------------------
+def test_scheduler_orders_by_due_then_priority():
+    sched = Scheduler()
+    sched.add(_job("late", "15:00", priority=0), 200.0)
+    sched.add(_job("low", "15:00", priority=2), 100.0)
+    sched.add(_job("high", "15:00", priority=1), 100.0)
+    sched.add(_job("tie", "15:00", priority=1), 100.0)       # 同時同 priority：先排入的先跑
+    order = [sched.pop()[1].id for _ in range(4)]
+    assert order == ["high", "tie", "low", "late"]
+    assert sched.pop() == (None, None)
+
+def test_scheduler_lazy_removal_and_reschedule():
+    sched = Scheduler()
+    for i, due in enumerate((100.0, 200.0, 300.0)):
+        sched.add(_job(f"j{i}", "15:00"), due)
+    sched.reschedule("j0", 250.0)           # 舊的 (100, j0) 留在 heap 裡，但已失效
+    sched.remove("j1")
+    assert len(sched) == 2 and sched.due("j1") is None
+    assert sched.peek() == (250.0, sched.jobs["j0"])
+    due, job = sched.pop()
+    assert (due, job.id) == (250.0, "j0")
+    # pop 之後沒 reschedule 就不會再出現；其他失效項目也不會冒出來
+    assert [sched.pop()[1].id, sched.pop()] == ["j2", (None, None)]
+    sched.reschedule("j0", 400.0)
+    assert sched.pop()[0] == 400.0 and sched.pop() == (None, None)
+
+# -----------------------------
+# RateLimiter / next_deadline
+# -----------------------------
+def test_rate_limiter_caps_searches_per_minute():
+    clock = _Clock()
+    limiter = RateLimiter(6, burst=2, clock=clock, sleep=clock.sleep)
+    # 主迴圈沒有別的等待：每次都立刻要下一個 token
+    stamps = []
+    while clock.t < 600:
+        limiter.acquire()
+        stamps.append(clock.t)
+    assert stamps[:3] == [0.0, 0.0, 10.0]         # 先用掉 burst，之後每 10 秒一次
+    for start in range(0, 540, 30):
+        in_window = [t for t in stamps if start <= t < start + 60]
+        assert len(in_window) <= 6 + 2
+    assert len([t for t in stamps if t >= 60]) <= 6 * 9 + 1
+    assert limiter.delay() > 0
+
+def test_rate_limiter_refills_after_idle_and_unlimited():
+    clock = _Clock()
+    limiter = RateLimiter(6, burst=2, clock=clock, sleep=clock.sleep)
+    limiter.acquire(), limiter.acquire()
+    assert limiter.delay() == pytest.approx(10.0)
+    clock.t += 3600                             # 閒置很久也只存到 burst 個
+    assert limiter.acquire() == 0 and limiter.acquire() == 0
+    assert limiter.acquire() == pytest.approx(10.0)
+    free = RateLimiter(0, clock=clock, sleep=clock.sleep)
+    assert all(free.acquire() == 0 for _ in range(100)) and free.delay() == 0
+
+def test_next_deadline_fixed_rate_without_drift():
+    due, runs = 0.0, []
+    for _ in range(10):
+        runs.append(due)
+        now = due + 7.0                         # 每輪耗時 7 秒，不累加進週期
+        due = next_deadline(due, 60, now=now)
+    assert runs == [i * 60.0 for i in range(10)]
+
+def test_next_deadline_does_not_burst_after_stall():
+    # 停了 10 分鐘（例如筆電休眠）：下一輪立刻跑，但不補跑錯過的 9 輪
+    due = next_deadline(0.0, 60, now=600.0)
+    assert due == 600.0
+    assert next_deadline(due, 60, now=601.0) == 660.0
+
+# -----------------------------
+# AdaptivePolicy
+# -----------------------------
+def test_proximity():
+    now = datetime(2025, 10, 18, 12, 0)
+    p = AdaptivePolicy.proximity
+    assert p(None, now) == 0.5
+    assert p(now + timedelta(hours=NEAR_HOURS), now) == 0.0
+    assert 0.0 < p(now + timedelta(days=3), now) < 1.0
+    assert p(now + timedelta(days=FAR_DAYS), now) == 1.0
+    # 已經發車：不再以最短間隔狂查
+    assert p(now - timedelta(minutes=1), now) == 1.0
+    assert p(now - timedelta(days=2), now) == 1.0
+
+def test_interval_for_past_departure_uses_max():
+    policy = AdaptivePolicy()
+    now = datetime(2025, 10, 18, 12, 0)
+    assert policy.interval(180, 300, now - timedelta(hours=1), now=now) >= 300 * 0.9
+
+# -----------------------------
+# coalesce
+# -----------------------------
+def test_coalesce_groups_within_window():
+    jobs = [_job("a", "15:00"), _job("b", "15:40"), _job("c", "16:00"), _job("d", "16:01")]
+    groups = coalesce(jobs, window_min=60)
+    # 以組內最早者為基準：16:00 剛好 60 分鐘仍在同組，16:01 另起一組
+    assert _ids(groups) == [["a", "b", "c"], ["d"]]
+    first = next(g for g in groups if len(g.members) == 3)
+    assert first.id == "a+b+c" and first.query.time == "15:00"
+    assert next(g for g in groups if g.members[0].id == "d").id == "d"
+
+def test_coalesce_keeps_routes_apart():
+    jobs = [_job("a", "15:00"), _job("b", "15:10", date="2025-10-21"), _job("c", "15:20", dest="台南"),
+            _job("d", "15:30", csv="other.csv")]
+    assert _ids(coalesce(jobs, 60)) == [["a"], ["b"], ["c"], ["d"]]
+
+def test_coalesce_disabled():
+    jobs = [_job("a", "15:00"), _job("b", "15:10")]
+    assert _ids(coalesce(jobs, 0)) == [["a"], ["b"]]
+
+# -----------------------------
+# fan_out
+# -----------------------------
+def test_fan_out_filters_by_member_time_and_keyword():
+    a, b = _job("a", "15:00", keyword="學生<=75折"), _job("b", "16:00", keyword="早鳥")
+    rows = [_row("15:11", "學生75折"), _row("15:40", "早鳥9折"), _row("16:11", "早鳥8折 學生5折"),
+            _row("17:30")]
+    rules = compile_job_rules([a, b])
+    hits = {}
+    for job in (a, b):
+        mine, covered = fan_out(rows, job)
+        assert covered
+        hits[job.id] = [r.code for r in mine if job.id in rules.match(r)]
+    assert hits == {"a": ["1511", "1611"], "b": ["1611"]}      # b 不會拿到 16:00 之前的早鳥
+
+def test_fan_out_coverage_needs_cover_min():
+    job = _job("b", "16:00")
+    short = [_row("15:00"), _row("15:30"), _row("16:20")]
+    assert fan_out(short, job) == (short[2:], False)            # 只到 16:20，不足 COVER_MIN
+    enough = short + [_row("17:00")]
+    assert hhmm_to_min("17:00") - hhmm_to_min("16:00") == COVER_MIN
+    assert fan_out(enough, job)[1]
+    assert fan_out([_row("15:00"), _row("15:50")], job) == ([], False)   # 完全沒有之後的車
+
+def test_fan_out_clamps_to_last_train():
+    # 22:40 的訂閱不可能湊滿 60 分鐘；最晚一班不早於 LAST_TRAIN_MIN 就算涵蓋
+    job = _job("late", "22:00")
+    assert fan_out([_row("22:10"), _row("22:30")], job)[1]
+    assert LAST_TRAIN_MIN == hhmm_to_min("22:30")
+    assert not fan_out([_row("22:10"), _row("22:29")], job)[1]
+
+# -----------------------------
+# SearchGroup 拆出與併回
+# -----------------------------
+def test_split_then_rejoin_when_coverage_returns():
+    a, b = _job("a", "15:00"), _job("b", "16:00")
+    (group,) = coalesce([a, b], 60)
+    sched = Scheduler()
+    sched.add(group, 100.0)
+
+    # 這輪結果只到 16:20：b 沒被涵蓋 → 拆出去單獨查，立刻到期
+    _, covered = fan_out([_row("15:10"), _row("16:20")], b)
+    assert not covered
+    group.split(sched, b, now=50.0)
+    assert group.members == [a] and group.detached == [b]
+    assert sched.due("b") == 50.0 and isinstance(sched.jobs["b"], SearchGroup)
+    assert sched.peek()[1].id == "b"
+
+    # 之後某輪本組結果又涵蓋到 16:00 之後 60 分鐘 → 併回，單獨查詢取消
+    _, covered = fan_out([_row("15:10"), _row("16:20"), _row("17:10")], b)
+    assert covered
+    group.rejoin(sched, b)
+    assert group.members == [a, b] and group.detached == []
+    assert sched.due("b") is None and sched.peek()[1] is group
+    assert len(sched) == 1
+
+# -----------------------------
+# reload_groups
+# -----------------------------
+def test_reload_groups_keeps_adds_and_removes():
+    old = [_job("a", "15:00"), _job("b", "15:30"), _job("c", "18:00"), _job("d", "09:00", date="2025-10-21")]
+    sched = Scheduler()
+    for group, due in zip(coalesce(old, 60), (100.0, 200.0, 300.0)):
+        sched.add(group, due)
+    assert sorted(sched.jobs) == ["a+b", "c", "d"]
+    old[0].rounds, old[0].hits, old[0].last_run = 7, 2, 50.0
+
+    # a、b 只改收件者與規則；c 改時段；d 刪除；e 新增
+    new = [_job("a", "15:00", keyword="學生<=75折", to="x@example.com"), _job("b", "15:30"),
+           _job("c", "18:30"), _job("e", "12:00")]
+    kept, added, removed = reload_groups(sched, new, window_min=60, spread_sec=60, now=1000.0)
+    assert kept == ["a+b"] and sorted(added) == ["c", "e"] and removed == ["d"]
+    assert sorted(sched.jobs) == ["a+b", "c", "e"]
+    # 沒變的組沿用原本的到期時間，換上新設定並保留統計
+    assert sched.due("a+b") == 100.0
+    a = sched.jobs["a+b"].members[0]
+    assert a is new[0] and a.keyword == "學生<=75折" and a.to == "x@example.com"
+    assert (a.rounds, a.hits, a.last_run) == (7, 2, 50.0)
+    # 新增或變更的組分散在 spread_sec 內，舊的到期時間不再有效
+    assert all(1000.0 <= sched.due(g) < 1060.0 for g in ("c", "e"))
+    assert sched.jobs["c"].query.time == "18:30"
+    assert sched.due("d") is None
+    order = []
+    while sched.peek()[1] is not None:
+        due, group = sched.pop()
+        order.append((due, group.id))
+    # 舊 c 的 heap 項目已失效，不會多跑一次
+    assert order[0] == (100.0, "a+b") and sorted(gid for _, gid in order) == ["a+b", "c", "e"]
+
+def test_reload_groups_regroups_when_membership_changes():
+    sched = Scheduler()
+    (group,) = coalesce([_job("a", "15:00"), _job("b", "15:30")], 60)
+    sched.add(group, 100.0)
+    kept, added, removed = reload_groups(sched, [_job("a", "15:00")], 60, now=1000.0)
+    assert (kept, added, removed) == ([], ["a"], ["a+b"])
+    assert list(sched.jobs) == ["a"] and sched.due("a") == 1000.0
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# thsrc_snapshots.SnapshotStore：去重、環狀目錄只刪自己的檔，刪掉的頁面雜湊一併移出 seen。
+import os
+import random
+import string
+
+from thsrc_snapshots import _NAME_RE, SnapshotStore, page_hash
+
+class _Page:
+    def __init__(self, html):
+        self.html = html
+
+    def content(self):
+        return self.html
+
+def _html(seed: int) -> str:
+    # 不含數字（數字在雜湊前會被正規化）、壓縮後約 1.5 KB
+    rnd = random.Random(seed)
+    return "<html><body>" + "".join(rnd.choice(string.ascii_letters) for _ in range(2000)) + "</body></html>"
+
+def _hashes_on_disk(directory):
+    return {m.group(1) for p in directory.iterdir() for m in [_NAME_RE.search(p.name)] if m}
+
+def test_duplicates_are_skipped(tmp_path):
+    store = SnapshotStore(str(tmp_path), screenshot=False, max_mb=0)
+    try:
+        page = "<p>驗證碼 /captcha?t=1700000001</p>" + _html(1)
+        assert store.capture(_Page(page), "failed")
+        # 只差在數字（時間戳）：視為同一種錯誤頁
+        assert not store.capture(_Page(page.replace("1700000001", "1700000999")), "failed")
+    finally:
+        store.close()
+    assert store.duplicates == 1 and _hashes_on_disk(tmp_path) == {page_hash(page)}
+    # 重新建立時從檔名讀回已存過的雜湊
+    again = SnapshotStore(str(tmp_path), screenshot=False)
+    try:
+        assert not again.capture(_Page(page), "failed")
+    finally:
+        again.close()
+
+def _store_pages(store, seeds):
+    """在測試執行緒直接寫檔（不經背景佇列），每個檔的 mtime 依序遞增。"""
+    for i in seeds:
+        html = _html(i)
+        h = store._accept(html)
+        store._write("failed", h, html, None)
+        (p,) = store.dir.glob(f"*_{h}.html.gz")
+        os.utime(p, (1_700_000_000 + i, 1_700_000_000 + i))
+
+def test_trim_prunes_seen_and_keeps_foreign_files(tmp_path):
+    foreign = tmp_path / "notes.txt"
+    foreign.write_text("x" * 20000)
+    store = SnapshotStore(str(tmp_path), screenshot=False, max_mb=4000 / 1024 / 1024)
+    try:
+        _store_pages(store, range(10))
+        assert len(store.seen) == 10
+        store._trim()
+        kept = _hashes_on_disk(tmp_path)
+        assert 0 < len(kept) < 10 and page_hash(_html(9)) in kept and page_hash(_html(0)) not in kept
+        # seen 只記目錄裡還在的頁面，不會無限增長
+        assert store.seen == kept
+        assert foreign.exists()
+        # 被刪掉的頁面再出現時會重新存一份
+        assert store.capture(_Page(_html(0)), "failed")
+    finally:
+        store.close()
+    assert page_hash(_html(0)) in _hashes_on_disk(tmp_path)
+    assert store.seen == _hashes_on_disk(tmp_path)
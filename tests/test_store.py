@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# thsrc_store.import_csv：多輪 CSV 歷史匯入後每一輪各自保留，不被唯一索引併成一筆。
+from thsrc_store import SqliteStore, import_csv
+
+HEADER = "date,code,departure,arrival,estimated,student_discount,discount_text,selected\n"
+ROUND = (
+    "10/20,837,15:11,16:15,1:04,True,早鳥9折 學生75折,True\n"
+    "10/20,655,15:21,16:23,1:02,True,學生75折,False\n"
+    "10/20,1653,15:46,16:48,1:02,False,,False\n"
+)
+
+def _write(path, rounds):
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        f.write(HEADER + ROUND * rounds)
+
+def test_import_keeps_every_round(tmp_path):
+    csv_path = tmp_path / "out.csv"
+    _write(csv_path, 3)
+    store = SqliteStore(str(tmp_path / "history.db"))
+    try:
+        assert import_csv(str(csv_path), store, scraped_at="2025-10-20T15:00:00") == 9
+        stamps = [r[0] for r in store.conn.execute("SELECT DISTINCT scraped_at FROM trains ORDER BY scraped_at")]
+        assert stamps == ["2025-10-20T14:59:58", "2025-10-20T14:59:59", "2025-10-20T15:00:00"]
+        # 同一個檔案再匯入一次不會重複寫入
+        assert import_csv(str(csv_path), store, scraped_at="2025-10-20T15:00:00") == 0
+    finally:
+        store.close()
+
+def test_import_splits_on_date_change(tmp_path):
+    csv_path = tmp_path / "out.csv"
+    with open(csv_path, "w", encoding="utf-8-sig", newline="") as f:
+        f.write(HEADER + ROUND + ROUND.replace("10/20", "10/21"))
+    store = SqliteStore(str(tmp_path / "history.db"))
+    try:
+        assert import_csv(str(csv_path), store, scraped_at="2025-10-20T15:00:00") == 6
+        assert store.conn.execute("SELECT COUNT(DISTINCT scraped_at) FROM trains").fetchone()[0] == 2
+    finally:
+        store.close()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# thsrc_watch：NotifiedLog（已通知 key 的過期與壓縮）、CsvTail（增量讀 CSV）。
+import os
+import time
+from datetime import date, timedelta
+
+from thsrc_rows import FIELDS
+from thsrc_watch import CsvTail, NotifiedLog, notify_new_hits, read_hits
+
+def _key(d: date, code: str = "837") -> str:
+    return f"{d.month:02d}/{d.day:02d}|{code}|15:11|學生75折"
+
+def _lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [ln.rstrip("\n") for ln in f if ln.strip()]
+
+# -----------------------------
+# NotifiedLog
+# -----------------------------
+def test_expiry_uses_recorded_date_not_today():
+    # 2025-02-20 記下 03/01 的車次；到 10/18 時早就過了。以今天推算會被當成明年 03/01 而永遠不過期。
+    key = "03/01|837|15:11|學生75折"
+    assert NotifiedLog._expired(key, date(2025, 2, 20), today=date(2025, 10, 18))
+    assert not NotifiedLog._expired(key, date(2025, 2, 20), today=date(2025, 2, 28))
+    # 跨年訂票：12/20 記下 01/05 的車次，是隔年的車
+    assert not NotifiedLog._expired("01/05|1|x", date(2025, 12, 20), today=date(2026, 1, 4))
+    assert NotifiedLog._expired("01/05|1|x", date(2025, 12, 20), today=date(2026, 1, 6))
+
+def test_load_drops_expired_and_compacts(tmp_path):
+    path = tmp_path / "notified.txt"
+    today = date.today()
+    old, live = _key(today - timedelta(days=3), "1"), _key(today + timedelta(days=3), "2")
+    path.write_text(f"{(today - timedelta(days=10)).isoformat()}\t{old}\n{today.isoformat()}\t{live}\n",
+                    encoding="utf-8")
+    log = NotifiedLog(str(path))
+    assert live in log and old not in log and len(log) == 1
+    assert _lines(path) == [f"{today.isoformat()}\t{live}"]
+
+def test_legacy_lines_are_rewritten_with_their_date(tmp_path):
+    path = tmp_path / "notified.txt"
+    recorded = date.today() - timedelta(days=2)
+    live = _key(date.today() + timedelta(days=5))
+    path.write_text(live + "\n", encoding="utf-8")
+    stamp = time.mktime(recorded.timetuple()) + 3600
+    os.utime(path, (stamp, stamp))
+    log = NotifiedLog(str(path))
+    assert live in log
+    # 載入時就改寫成新格式，之後 mtime 再變也不會把記錄日期往後推
+    assert _lines(path) == [f"{recorded.isoformat()}\t{live}"]
+    assert NotifiedLog(str(path)).keys[live] == recorded
+
+def test_add_many_appends_and_expire_compacts(tmp_path, monkeypatch):
+    monkeypatch.setattr(NotifiedLog, "COMPACT_MIN", 2)
+    path = tmp_path / "notified.txt"
+    log = NotifiedLog(str(path))
+    yesterday = date.today() - timedelta(days=1)
+    keys = [_key(yesterday, str(i)) for i in range(3)]
+    log.add_many(keys[:2])
+    log.add_many(keys[:2])                  # 重複的 key 不再追加
+    assert len(_lines(path)) == 2
+    log.add_many(keys[2:])                  # 3 行 > max(2, 2 * 3) 不成立，不壓縮
+    assert len(_lines(path)) == 3
+    log.expire()                            # 都是昨天的車：全部過期，3 行 > max(2, 0) → 改寫
+    assert len(log) == 0 and _lines(path) == []
+
+# -----------------------------
+# CsvTail
+# -----------------------------
+HEADER = (",".join(FIELDS) + "\n").encode()
+
+def _csv_line(code: str, discount: str = "學生75折") -> bytes:
+    return f"10/20,{code},15:11,16:15,1:04,True,{discount},False\n".encode()
+
+def _tail(tmp_path):
+    return CsvTail(str(tmp_path / "out.csv"), str(tmp_path / "state" / "csv_offset.json"))
+
+def _codes(rows):
+    return [r["code"] for r in rows]
+
+class _FakeNotifier:
+    def __init__(self, ok: bool):
+        self.ok = ok
+        self.sent = []
+
+    def pending_keys(self):
+        return set()
+
+    def notify(self, to, subject, html, text="", keys=()):
+        self.sent.append(list(keys))
+        return self.ok
+
+def test_tail_reads_only_complete_appended_rows(tmp_path):
+    path = tmp_path / "out.csv"
+    path.write_bytes(HEADER + _csv_line("1") + _csv_line("2")[:10])     # 第二列寫到一半
+    tail = _tail(tmp_path)
+    assert _codes(tail.read_new()) == ["1"]
+    tail.commit()
+    with open(path, "ab") as f:
+        f.write(_csv_line("2")[10:] + _csv_line("3"))
+    assert _codes(tail.read_new()) == ["2", "3"]
+    tail.commit()
+    assert tail.read_new() == []
+    # offset 存在 state 檔：重新建立也接著讀
+    with open(path, "ab") as f:
+        f.write(_csv_line("4"))
+    assert _codes(_tail(tmp_path).read_new()) == ["4"]
+
+def test_tail_rereads_after_truncation(tmp_path):
+    path = tmp_path / "out.csv"
+    path.write_bytes(HEADER + _csv_line("1") + _csv_line("2"))
+    tail = _tail(tmp_path)
+    tail.read_new()
+    tail.commit()
+    path.write_bytes(HEADER + _csv_line("9"))
+    assert _codes(tail.read_new()) == ["9"]
+
+def test_tail_rereads_same_size_rewrite(tmp_path):
+    path = tmp_path / "out.csv"
+    path.write_bytes(HEADER + _csv_line("1") + _csv_line("2"))
+    tail = _tail(tmp_path)
+    tail.read_new()
+    tail.commit()
+    ino = os.stat(path).st_ino
+    with open(path, "r+b") as f:                 # 原地覆寫成同樣長度的不同內容，inode 不變
+        f.write(HEADER + _csv_line("7") + _csv_line("8"))
+    assert os.stat(path).st_ino == ino and os.path.getsize(path) == tail.state["offset"]
+    assert _codes(tail.read_new()) == ["7", "8"]
+
+def test_tail_rereads_after_rotation(tmp_path):
+    path = tmp_path / "out.csv"
+    path.write_bytes(HEADER + _csv_line("1"))
+    tail = _tail(tmp_path)
+    tail.read_new()
+    tail.commit()
+    os.replace(path, tmp_path / "out.csv.1")
+    path.write_bytes(HEADER + _csv_line("1") + _csv_line("5"))     # 前段內容相同、inode 不同
+    assert os.stat(path).st_ino != tail.state["ino"]
+    assert _codes(tail.read_new()) == ["1", "5"]
+
+def test_tail_offset_stays_when_send_fails(tmp_path):
+    path = tmp_path / "out.csv"
+    path.write_bytes(HEADER + _csv_line("1") + _csv_line("2", "學生88折"))
+    notified = NotifiedLog(str(tmp_path / "notified.txt"))
+    tail = _tail(tmp_path)
+    # 主迴圈：排入通知成功才 commit
+    rows = read_hits(str(path), "學生<=75折", tail)
+    assert [r.code for r in rows] == ["1"]
+    if notify_new_hits(rows, notified, _FakeNotifier(ok=False), "me@example.com", "學生<=75折"):
+        tail.commit()
+    assert tail.state == {} and not os.path.exists(tail.state_path)
+    # 下一輪重讀同一段，這次排入成功才推進
+    notifier = _FakeNotifier(ok=True)
+    rows = read_hits(str(path), "學生<=75折", tail)
+    assert [r.code for r in rows] == ["1"]
+    assert notify_new_hits(rows, notified, notifier, "me@example.com", "學生<=75折")
+    tail.commit()
+    assert tail.state["offset"] == os.path.getsize(path) and len(notifier.sent) == 1
+    assert read_hits(str(path), "學生<=75折", tail) == []
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# thsrc_watchdog.Watchdog.check：假時鐘 + 真的 RoundTrace 心跳，kill / escalate 換成記錄呼叫的假動作。
+import pytest
+
+import thsrc_trace
+from thsrc_trace import RoundTrace
+from thsrc_watchdog import DEFAULT_TIMEOUT_SEC, STAGE_TIMEOUT_SEC, Watchdog
+
+class _Clock:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+class _Sink:
+    def __init__(self):
+        self.records = []
+
+    def write(self, rec):
+        self.records.append(rec)
+
+@pytest.fixture
+def env():
+    clock, calls, sink = _Clock(), [], _Sink()
+    dog = Watchdog(stall_sec=15, grace_sec=15, clock=clock, sink=sink,
+                   kill=lambda: calls.append("kill") or [101, 102],
+                   escalate=lambda: calls.append("escalate") or [100],
+                   on_escalate=lambda: calls.append("invalidate"))
+    thsrc_trace.add_listener(dog._on_beat)      # 不啟動監看執行緒，由測試直接呼叫 check()
+    yield dog, clock, calls, sink
+    thsrc_trace.remove_listener(dog._on_beat)
+
+def test_budget_is_stage_specific(env):
+    dog, clock, calls, _ = env
+    assert dog.budget("goto") == STAGE_TIMEOUT_SEC["goto"] + 15 == 75
+    assert dog.budget("fill_form") == DEFAULT_TIMEOUT_SEC + 15 == 45
+
+    trace = RoundTrace("search")
+    with trace.span("goto"):
+        clock.t += 74                   # 慢但健康的 page.goto：未超過 60 + 15
+        dog.check()
+        assert calls == [] and dog.stuck == 0
+        clock.t += 2
+        dog.check()
+        assert calls == ["kill"] and dog.stuck == 1 and dog.stages == {"goto": 1}
+    trace.finish("error")
+    assert dog.rounds == 1 and len(dog.recovery) == 1
+
+def test_beat_resets_timer_without_retry(env):
+    dog, clock, calls, _ = env
+    trace = RoundTrace("search")
+    with trace.span("fill_form") as sp:
+        for _ in range(5):              # 每次長等待之間 beat 一次：總計 200 秒也不算卡住
+            clock.t += 40
+            sp.beat()
+            dog.check()
+        assert calls == [] and sp.retries == 0
+        clock.t += 46
+        dog.check()
+        assert calls == ["kill"]
+    trace.finish("ok")
+
+def test_retry_moves_stage_and_counts(env):
+    dog, clock, calls, _ = env
+    trace = RoundTrace("search")
+    with trace.span("captcha") as sp:
+        clock.t += 50                   # 超過預設的 45 秒，但 captcha 的預算是 40 + 15
+        dog.check()
+        sp.retry()                      # 重試也是心跳，並計入 retries
+        clock.t += 54
+        dog.check()
+        assert sp.retries == 1 and calls == []
+    trace.finish("ok")
+
+def test_escalates_after_grace(env):
+    dog, clock, calls, sink = env
+    trace = RoundTrace("search")
+    with trace.span("submit_and_wait_step2"):
+        clock.t += 56
+        dog.check()
+        assert calls == ["kill"]
+        clock.t += 15                   # grace_sec 內：只等，不升級
+        dog.check()
+        assert calls == ["kill"]
+        clock.t += 1
+        dog.check()
+        assert calls == ["kill", "escalate", "invalidate"] and dog.escalations == 1
+        clock.t += 30
+        dog.check()                     # 只升級一次
+        assert calls == ["kill", "escalate", "invalidate"]
+    clock.t += 2
+    trace.finish("error")
+    (rec,) = sink.records
+    assert rec["stage"] == "submit_and_wait_step2" and rec["killed"] == 2 and rec["escalated"]
+    assert rec["recovery_ms"] == 48000.0 and rec["lost_ms"] == 104000.0
+    assert dog.stats()["stuck_rate"] == 1.0
+
+def test_skip_stage_is_never_killed(env):
+    dog, clock, calls, _ = env
+    trace = RoundTrace("search")
+    with trace.span("save"):
+        clock.t += 600
+        dog.check()
+    assert calls == []
+    trace.finish("ok")
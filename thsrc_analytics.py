@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+# thsrc_analytics.py
+# 歷史查詢結果（out.csv / SQLite）的折扣統計。資料先轉成欄式 NumPy 陣列，統計全部用 bincount / unique
+# 之類的向量化 group-by，不再逐列跑 csv.DictReader。
+#
+#   tiers   各來源（路線）每種折扣在多少比例的輪次中出現過
+#   trains  各車次出現符合 --keyword 規則（thsrc_rules 語法，例：學生<=75折、早鳥）折扣的輪數與比例、最常出現的時段、平均提前幾天；--train 看單一車次的時間分布
+#   hours   依列車出發時段（每小時）統計 --keyword 的出現比例
+#
+# 欄位快取：每個來源旁邊建一個 <來源>.cols/ 目錄（每欄一個 .npy + meta.json），之後以 mmap 載入。
+# CSV 只會追加，下次只解析新追加的部分；SQLite 只讀 id 大於上次的列。--no-cache 則每次重新解析。
+#
+# 注意：
+#   - CSV / SQLite 沒有記錄起訖站，「路線」以來源區分（可寫成 標籤=路徑，例如 台北台中=out.csv）
+#   - CSV 沒有寫入時間：輪次以「出發時間回頭或同車次重複」切分，與時段、提前天數有關的統計只有 SQLite 來源有
+#
+# 需求：pip install numpy（其餘腳本不需要）。
+#
+# 執行例:
+#   python thsrc_analytics.py tiers 台北台中=out.csv 新竹台南=sqlite:history.db
+#   python thsrc_analytics.py trains sqlite:history.db --keyword 學生5折 --top 20
+#   python thsrc_analytics.py trains sqlite:history.db --keyword 學生5折 --train 837
+#   python thsrc_analytics.py hours out.csv --keyword 學生75折
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import date, datetime
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from thsrc_rows import hhmm_to_min, infer_travel_date
+from thsrc_rules import compile_rules
+from thsrc_store import parse_store_spec
+
+CACHE_VERSION = 1
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+COLUMNS = {                 # 欄名 -> dtype
+    "round": "int32",       # 來源內的輪次編號
+    "scraped": "int64",     # 寫入時間（當地時間，自 1970-01-01 起的秒數）；CSV 為 -1
+    "travel": "int32",      # 乘車日期（date.toordinal()）；無法解析為 -1
+    "code": "int32",        # 車次（數字）；無法解析為 -1
+    "dep": "int16",         # 出發時間（分鐘）
+    "dur": "int16",         # 車程（分鐘）
+    "disc": "int32",        # 折扣文字在 vocab 中的編號
+}
+FINGERPRINT_BYTES = 64
+
+def log(msg: str):
+    ts = datetime.now().strftime("%H:%M:%S")
+    print(f"[{ts}] {msg}", file=sys.stderr)
+
+# -----------------------------
+# 解析（同一字串只解析一次）
+# -----------------------------
+class _Parser:
+    def __init__(self, vocab):
+        self.vocab = list(vocab)
+        self._disc = {t: i for i, t in enumerate(self.vocab)}
+        self._min = {}
+        self._code = {}
+        self._date = {}
+        self._ts = {}
+
+    def minutes(self, s: str) -> int:
+        v = self._min.get(s)
+        if v is None:
+            v = self._min[s] = hhmm_to_min(s)
+        return v
+
+    def code(self, s: str) -> int:
+        v = self._code.get(s)
+        if v is None:
+            s2 = s.strip()
+            v = self._code[s] = int(s2) if s2.isdigit() else -1
+        return v
+
+    def travel(self, mmdd: str, ref: date) -> int:
+        k = (mmdd, ref)
+        v = self._date.get(k)
+        if v is None:
+            d = infer_travel_date(mmdd, ref)
+            v = self._date[k] = d.toordinal() if d else -1
+        return v
+
+    def disc(self, text: str) -> int:
+        text = text.strip()
+        v = self._disc.get(text)
+        if v is None:
+            v = self._disc[text] = len(self.vocab)
+            self.vocab.append(text)
+        return v
+
+    def scraped(self, iso: str):
+        """回傳 (秒數, 日期)；同一輪的 scraped_at 相同，快取命中率很高。"""
+        v = self._ts.get(iso)
+        if v is None:
+            try:
+                dt = datetime.fromisoformat(iso)
+                v = (int((dt - datetime(1970, 1, 1)).total_seconds()), dt.date())
+            except (TypeError, ValueError):
+                v = (-1, date.today())
+            self._ts[iso] = v
+        return v
+
+def _fingerprint(path: str, offset: int) -> str:
+    with open(path, "rb") as f:
+        start = max(0, offset - FINGERPRINT_BYTES)
+        f.seek(start)
+        return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+def _split_rounds(code, dep, travel, prev=None, first_round=0):
+    """
+    CSV 沒有寫入時間：同一輪的列依出發時間排序，因此「出發時間回頭、同車次重複或換日」即為新的一輪。
+    prev = 上一段最後一列的 (code, dep, travel, round)，增量解析時接續編號。
+    """
+    n = len(code)
+    if n == 0:
+        return np.zeros(0, dtype="int32")
+    if prev is not None:
+        code = np.concatenate([[prev[0]], code])
+        dep = np.concatenate([[prev[1]], dep])
+        travel = np.concatenate([[prev[2]], travel])
+        first_round = prev[3]
+    brk = (dep[1:] < dep[:-1]) | (code[1:] == code[:-1]) | (travel[1:] != travel[:-1])
+    rounds = first_round + np.cumsum(brk, dtype="int64")
+    if prev is None:
+        rounds = np.concatenate([[first_round], rounds])
+    return rounds.astype("int32")
+
+# -----------------------------
+# 來源 → 欄式陣列
+# -----------------------------
+def _parse_csv(path: str, meta: dict):
+    """從 meta['offset'] 之後解析 CSV；回傳 (新列的欄位 dict, 新的 meta, 是否為接續上次的增量)。"""
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        header = f.readline()
+        data_start = len(header)
+        offset = meta.get("offset", 0)
+        if (offset < data_start or st.st_size < offset
+                or meta.get("fingerprint") != _fingerprint(path, offset)):
+            offset, meta = data_start, {}   # 被截短 / 輪替 → 從頭重建
+        f.seek(offset)
+        chunk = f.read()
+    end = chunk.rfind(b"\n")
+    chunk = chunk[:end + 1] if end >= 0 else b""
+
+    names = next(csv.reader([header.decode("utf-8-sig")]))
+    need = ("date", "code", "departure", "estimated", "discount_text")
+    missing = [n for n in need if n not in names]
+    if missing:
+        raise ValueError(f"{path} 缺少欄位：{', '.join(missing)}")
+    i_date, i_code, i_dep, i_dur, i_disc = (names.index(n) for n in need)
+
+    p = _Parser(meta.get("vocab", []))
+    ref = datetime.fromtimestamp(st.st_mtime).date()
+    code, dep, dur, travel, disc = [], [], [], [], []
+    width = max(i_date, i_code, i_dep, i_dur, i_disc) + 1
+    for rec in csv.reader(io.StringIO(chunk.decode("utf-8", "replace"))):
+        if len(rec) < width:
+            continue
+        code.append(p.code(rec[i_code]))
+        dep.append(p.minutes(rec[i_dep]))
+        dur.append(p.minutes(rec[i_dur]))
+        travel.append(p.travel(rec[i_date], ref))
+        disc.append(p.disc(rec[i_disc]))
+
+    cols = {
+        "code": np.array(code, dtype="int32"),
+        "dep": np.array(dep, dtype="int16"),
+        "dur": np.array(dur, dtype="int16"),
+        "travel": np.array(travel, dtype="int32"),
+        "disc": np.array(disc, dtype="int32"),
+    }
+    cols["scraped"] = np.full(len(code), -1, dtype="int64")
+    cols["round"] = _split_rounds(cols["code"], cols["dep"], cols["travel"], meta.get("last"))
+    new_offset = offset + len(chunk)
+    new_meta = {"kind": "csv", "offset": new_offset, "fingerprint": _fingerprint(path, new_offset),
+                "vocab": p.vocab, "last": meta.get("last")}
+    if len(code):
+        new_meta["last"] = [int(cols["code"][-1]), int(cols["dep"][-1]), int(cols["travel"][-1]),
+                            int(cols["round"][-1])]
+    return cols, new_meta, bool(meta)
+
+def _parse_sqlite(path: str, meta: dict):
+    """讀 id 大於 meta['max_id'] 的列；一輪 = 同一個 scraped_at。"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        max_id = meta.get("max_id", 0)
+        top = conn.execute("SELECT COALESCE(MAX(id), 0) FROM trains").fetchone()[0]
+        if top < max_id:
+            max_id, meta = 0, {}
+        cur = conn.execute(
+            "SELECT id, date, code, departure, estimated, discount_text, scraped_at FROM trains "
+            "WHERE id > ? ORDER BY id", (max_id,))
+        p = _Parser(meta.get("vocab", []))
+        rounds = dict(meta.get("rounds_tail", {}))      # scraped_at -> round（只留最後一輪，供接續）
+        next_round = meta.get("next_round", 0)
+        rnd, scraped, code, dep, dur, travel, disc = [], [], [], [], [], [], []
+        last_id = max_id
+        for rid, d, c, de, du, text, at in cur:
+            r = rounds.get(at)
+            if r is None:
+                r = rounds[at] = next_round
+                next_round += 1
+            secs, day = p.scraped(at)
+            rnd.append(r)
+            scraped.append(secs)
+            code.append(p.code(c or ""))
+            dep.append(p.minutes(de or ""))
+            dur.append(p.minutes(du or ""))
+            travel.append(p.travel(d or "", day))
+            disc.append(p.disc(text or ""))
+            last_id = rid
+    finally:
+        conn.close()
+    cols = {
+        "round": np.array(rnd, dtype="int32"),
+        "scraped": np.array(scraped, dtype="int64"),
+        "code": np.array(code, dtype="int32"),
+        "dep": np.array(dep, dtype="int16"),
+        "dur": np.array(dur, dtype="int16"),
+        "travel": np.array(travel, dtype="int32"),
+        "disc": np.array(disc, dtype="int32"),
+    }
+    tail = {at: r for at, r in rounds.items() if r == rnd[-1]} if rnd else meta.get("rounds_tail", {})
+    new_meta = {"kind": "sqlite", "max_id": last_id, "vocab": p.vocab, "rounds_tail": tail,
+                "next_round": next_round}
+    return cols, new_meta, bool(meta)
+
+class ColumnCache:
+    """<來源>.cols/：每欄一個 .npy（以 mmap 載入）+ meta.json（vocab、讀到哪裡）。"""
+    def __init__(self, source_path: str):
+        self.dir = Path(str(source_path) + ".cols")
+        self.meta_path = self.dir / "meta.json"
+
+    def load(self):
+        try:
+            meta = json.loads(self.meta_path.read_text(encoding="utf-8"))
+            if meta.get("version") != CACHE_VERSION:
+                return None, {}
+            cols = {k: np.load(self.dir / f"{k}.npy", mmap_mode="r") for k in COLUMNS}
+            return cols, meta
+        except (OSError, ValueError):
+            return None, {}
+
+    def save(self, cols: dict, meta: dict):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        for k, arr in cols.items():
+            tmp = self.dir / f"{k}.tmp.npy"
+            np.save(tmp, np.ascontiguousarray(arr, dtype=COLUMNS[k]))
+            os.replace(tmp, self.dir / f"{k}.npy")
+        tmp = self.dir / "meta.tmp.json"
+        tmp.write_text(json.dumps(dict(meta, version=CACHE_VERSION), ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.meta_path)
+
+def load_source(spec: str, use_cache: bool = True):
+    """回傳 (欄位 dict, vocab)。有快取時只解析新增的部分並更新快取。"""
+    kind, path = parse_store_spec(spec)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    parse = _parse_sqlite if kind == "sqlite" else _parse_csv
+    cache = ColumnCache(path) if use_cache else None
+    old, meta = cache.load() if cache else (None, {})
+    if old is None or meta.get("kind") != kind:
+        old, meta = None, {}
+    new, new_meta, appended = parse(path, meta)
+    if old is None or not appended:
+        cols = new
+    elif len(new["round"]) == 0:
+        cols = old
+    else:
+        cols = {k: np.concatenate([old[k], new[k]]) for k in COLUMNS}
+    if cache is not None and (not appended or len(new["round"])):
+        cache.save(cols, new_meta)
+    return cols, new_meta["vocab"]
+
+# -----------------------------
+# 多來源合併
+# -----------------------------
+class History:
+    """多個來源合併後的欄位；disc 統一對應到同一份 vocab，round 全域唯一。"""
+    def __init__(self, labels, cols, vocab):
+        self.labels = labels
+        self.vocab = vocab
+        self.__dict__.update(cols)
+        self.n = len(self.round)
+        self.n_rounds = int(self.round.max()) + 1 if self.n else 0
+        # 每輪屬於哪個來源
+        self.round_source = np.zeros(self.n_rounds, dtype="int32")
+        self.round_source[self.round] = self.source
+        self.has_time = self.scraped >= 0
+
+    @classmethod
+    def load(cls, specs, use_cache: bool = True):
+        labels, parts, vocab, index = [], [], [], {}
+        round_base = 0
+        for i, spec in enumerate(specs):
+            label, sep, path = spec.partition("=")
+            if not sep or spec.startswith(("sqlite:", "csv:")):
+                label, path = Path(parse_store_spec(spec)[1]).stem, spec
+            t0 = time.perf_counter()
+            cols, src_vocab = load_source(path, use_cache)
+            # 來源各自的 vocab 編號 → 合併後的編號
+            remap = np.array([index.setdefault(t, len(index)) for t in src_vocab] or [0], dtype="int32")
+            cols = dict(cols)
+            cols["disc"] = remap[cols["disc"]] if len(cols["disc"]) else cols["disc"]
+            cols["round"] = np.asarray(cols["round"]) + round_base
+            cols["source"] = np.full(len(cols["round"]), i, dtype="int16")
+            if len(cols["round"]):
+                round_base = int(cols["round"].max()) + 1
+            parts.append(cols)
+            labels.append(label)
+            log(f"{label}：{len(cols['round'])} 列，耗時 {time.perf_counter() - t0:.2f} 秒")
+        vocab = [None] * len(index)
+        for t, j in index.items():
+            vocab[j] = t
+        merged = {k: np.concatenate([np.asarray(p[k]) for p in parts]) for k in list(COLUMNS) + ["source"]}
+        return cls(labels, merged, vocab)
+
+    def vocab_mask(self, pred):
+        """vocab 上的布林查表（pred(text) -> bool），用 mask[disc] 套到每一列。"""
+        return np.array([bool(pred(t)) for t in self.vocab] or [False], dtype=bool)
+
+    def hit(self, keyword: str):
+        return self.vocab_mask(compile_rules(keyword).test_text)[self.disc]
+
+# -----------------------------
+# 統計
+# -----------------------------
+def tier_table(h: History):
+    """回傳 (tiers, table)：table[source][tier] = (出現的輪數, 總輪數)。"""
+    tiers = sorted({tok for t in h.vocab for tok in t.split()})
+    n_src = len(h.labels)
+    total = np.bincount(h.round_source, minlength=n_src)
+    table = [[None] * len(tiers) for _ in range(n_src)]
+    for j, tier in enumerate(tiers):
+        m = h.vocab_mask(lambda t: tier in t.split())[h.disc]
+        rounds = np.unique(h.round[m])
+        seen = np.bincount(h.round_source[rounds], minlength=n_src)
+        for s in range(n_src):
+            table[s][j] = (int(seen[s]), int(total[s]))
+    return tiers, table
+
+def train_table(h: History, keyword: str):
+    """各車次：觀測輪數、命中輪數、命中最多的寫入時段（小時）、命中時平均提前天數。"""
+    valid = h.code >= 0
+    codes, cidx = np.unique(h.code[valid], return_inverse=True)
+    rnd = h.round[valid]
+    hit = h.hit(keyword)[valid]
+    n = len(codes)
+    # 同一輪同車次可能出現多列，先以 (輪, 車次) 去重
+    pair = rnd.astype("int64") * n + cidx
+    seen_pairs = np.unique(pair)
+    hit_pairs = np.unique(pair[hit])
+    seen = np.bincount(seen_pairs % n, minlength=n)
+    hits = np.bincount(hit_pairs % n, minlength=n)
+
+    timed = hit & h.has_time[valid]
+    scraped = h.scraped[valid][timed]
+    hour = (scraped // 3600) % 24
+    peak = np.full(n, -1)
+    if len(hour):
+        hh = np.bincount(cidx[timed] * 24 + hour, minlength=n * 24).reshape(n, 24)
+        peak = np.where(hh.sum(axis=1) > 0, hh.argmax(axis=1), -1)
+    lead = h.travel[valid][timed] - (scraped // 86400 + EPOCH_ORDINAL)
+    lead_n = np.bincount(cidx[timed], minlength=n)
+    lead_sum = np.bincount(cidx[timed], weights=lead, minlength=n)
+    lead_avg = np.divide(lead_sum, lead_n, out=np.full(n, np.nan), where=lead_n > 0)
+    return codes, seen, hits, peak, lead_avg
+
+def train_timeline(h: History, code: int, keyword: str, max_lead: int = 60):
+    """單一車次：依寫入時段（小時）與提前天數的 (觀測數, 命中數)。"""
+    m = (h.code == code) & h.has_time
+    hit = h.hit(keyword)[m]
+    scraped = h.scraped[m]
+    hour = (scraped // 3600) % 24
+    lead = np.clip(h.travel[m] - (scraped // 86400 + EPOCH_ORDINAL), 0, max_lead)
+    by_hour = (np.bincount(hour, minlength=24), np.bincount(hour, weights=hit, minlength=24))
+    by_lead = (np.bincount(lead, minlength=max_lead + 1), np.bincount(lead, weights=hit, minlength=max_lead + 1))
+    return by_hour, by_lead
+
+def hour_table(h: History, keyword: str):
+    """依列車出發時段（小時）：(觀測列數, 命中列數)。"""
+    m = h.dep >= 0
+    hour = h.dep[m] // 60
+    hit = h.hit(keyword)[m]
+    return np.bincount(hour, minlength=24), np.bincount(hour, weights=hit, minlength=24)
+
+# -----------------------------
+# 輸出
+# -----------------------------
+def _pct(a, b) -> str:
+    return f"{100.0 * a / b:5.1f}%" if b else "    -"
+
+def _bar(frac: float, width: int = 30) -> str:
+    return "█" * int(round(frac * width))
+
+def print_tiers(h: History):
+    tiers, table = tier_table(h)
+    print(f"{'來源':<14}{'輪數':>8}  " + "".join(f"{t:>10}" for t in tiers))
+    for s, label in enumerate(h.labels):
+        total = table[s][0][1] if tiers else 0
+        print(f"{label:<14}{total:>8}  " + "".join(f"{_pct(seen, n):>10}" for seen, n in table[s]))
+
+def print_trains(h: History, keyword: str, top: int):
+    codes, seen, hits, peak, lead = train_table(h, keyword)
+    order = np.lexsort((-seen, -(hits / np.maximum(seen, 1))))
+    print(f"「{keyword}」各車次：")
+    print(f"{'車次':>6}{'觀測輪數':>10}{'命中輪數':>10}{'命中率':>9}{'常見時段':>10}{'平均提前天數':>14}")
+    for i in order[:top]:
+        if not hits[i]:
+            break
+        hour = f"{peak[i]:02d}:00" if peak[i] >= 0 else "-"
+        days = f"{lead[i]:.1f}" if not np.isnan(lead[i]) else "-"
+        print(f"{codes[i]:>6}{seen[i]:>10}{hits[i]:>10}{_pct(hits[i], seen[i]):>9}{hour:>10}{days:>14}")
+
+def print_train_timeline(h: History, code: int, keyword: str):
+    (n_h, hit_h), (n_l, hit_l) = train_timeline(h, code, keyword)
+    if not n_h.sum():
+        print(f"車次 {code} 沒有帶寫入時間的紀錄（CSV 來源沒有寫入時間，請改用 SQLite）")
+        return
+    print(f"車次 {code}「{keyword}」依查詢時段：")
+    for hr in range(24):
+        if n_h[hr]:
+            frac = hit_h[hr] / n_h[hr]
+            print(f"  {hr:02d}:00 {int(n_h[hr]):>6} 次 {_pct(hit_h[hr], n_h[hr])} {_bar(frac)}")
+    print(f"車次 {code}「{keyword}」依提前天數：")
+    for d in range(len(n_l)):
+        if n_l[d]:
+            frac = hit_l[d] / n_l[d]
+            label = f"{d}+" if d == len(n_l) - 1 else str(d)
+            print(f"  {label:>4} 天 {int(n_l[d]):>6} 次 {_pct(hit_l[d], n_l[d])} {_bar(frac)}")
+
+def print_hours(h: History, keyword: str):
+    n, hit = hour_table(h, keyword)
+    print(f"「{keyword}」依出發時段：")
+    for hr in range(24):
+        if n[hr]:
+            print(f"  {hr:02d}:00 {int(n[hr]):>8} 列 {_pct(hit[hr], n[hr])} {_bar(hit[hr] / n[hr])}")
+
+def main():
+    ap = argparse.ArgumentParser(description="THSR 歷史查詢結果的折扣統計（NumPy 欄式陣列）")
+    ap.add_argument("report", choices=["tiers", "trains", "hours"], help="統計種類")
+    ap.add_argument("sources", nargs="+", help="來源：CSV 路徑、sqlite:PATH，可寫成 標籤=來源")
+    ap.add_argument("--keyword", default="學生5折", help="trains / hours 統計的折扣規則（例：學生5折、學生<=75折、早鳥）")
+    ap.add_argument("--train", type=int, default=None, help="trains：只看這個車次的時段 / 提前天數分布")
+    ap.add_argument("--top", type=int, default=20, help="trains：列出前幾名")
+    ap.add_argument("--no-cache", action="store_true", help="不讀寫 <來源>.cols/ 欄位快取")
+    args = ap.parse_args()
+    if np is None:
+        ap.error("需要 numpy：pip install numpy")
+
+    try:
+        h = History.load(args.sources, use_cache=not args.no_cache)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        log(f"讀取歷史失敗：{e}")
+        sys.exit(2)
+    if not h.n:
+        log("沒有資料")
+        return
+
+    if args.report == "tiers":
+        print_tiers(h)
+    elif args.report == "trains":
+        if args.train is not None:
+            print_train_timeline(h, args.train, args.keyword)
+        else:
+            print_trains(h, args.keyword, args.top)
+    else:
+        print_hours(h, args.keyword)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,631 @@
+# -*- coding: utf-8 -*-
+# thsrc_async.py
+# 查詢流程的唯一實作（playwright.async_api）：
+# 一個 process、一個 event loop 同時開多個頁面查詢，以 semaphore 控制同時進行的頁數上限。
+# 等待改用 await（asyncio.sleep / 頁面內 MutationObserver），不再以 time.sleep 佔住整個 process；
+# OCR 是 CPU 工作、CSV / SQLite 寫入會阻塞，都丟到執行緒跑，不卡 event loop。
+#
+# 同一組瀏覽器參數（SearchQuery.launch_key）只開一個 browser，每個查詢各用一個 context（cookie 互不干擾）；
+# browser 跨查詢保留，失敗、用滿 max_rounds 次或記憶體超過 max_rss_mb 時重開。
+# 指定 profile 時每個同時進行的查詢各占一個 profile slot，以 launch_persistent_context 開（磁碟快取跨輪保留）。
+#
+# 同步程式的入口：
+#   thsrc_search_v2_plus.search / search_and_save  單次查詢（CLI）；給 pool 時借用長駐引擎
+#   BlockingSearchEngine                           背景執行緒跑 event loop 的長駐引擎（thsrc_watch 用）
+#
+# 需求:
+#   pip install playwright ddddocr
+#   python -m playwright install chromium
+#
+# 執行例:
+#   python thsrc_async.py --queries queries.json --concurrency 4 --trace trace.jsonl
+#
+# 查詢清單格式同 thsrc_watch --queries（見 thsrc_scheduler）；每筆依各自的 csv / store 寫出。
+
+import argparse
+import asyncio
+import random
+import re
+import sys
+import threading
+import time
+
+from thsrc_browser import (PAGE_STATE_JS, STEP2_ROWS_JS, STEP2_ROWS_SELECTOR, NetMeter, ProfileDir,
+                           browser_pids, descendant_pids, process_rss_mb, resource_allowed)
+from thsrc_search_v2_plus import (
+    CAPTCHA_EVENTS_JS, SET_DATE_JS, STEALTH_INIT_SCRIPT, URL,
+    SearchQuery, clean_captcha, context_options, flatpickr_date, launch_options, log, query_profile,
+    rows_from_step2, save_results,
+)
+import thsrc_snapshots as snapshots
+from thsrc_trace import RoundTrace, open_sink
+
+async def human_sleep(a=0.15, b=0.45):
+    await asyncio.sleep(random.uniform(a, b))
+
+def _beat(span):
+    """長等待之間回報心跳給看門狗（thsrc_watchdog）；沒有 span 時什麼都不做。"""
+    if span is not None:
+        span.beat()
+
+# -----------------------------
+# 驗證碼（OCR 共用一個模型，放到執行緒跑）
+# -----------------------------
+_ocr = None
+_ocr_lock = threading.Lock()
+
+def _classify(raw: bytes) -> str:
+    global _ocr
+    with _ocr_lock:
+        if _ocr is None:
+            import ddddocr
+            _ocr = ddddocr.DdddOcr()
+        return clean_captcha(_ocr.classification(raw))
+
+async def solve_captcha_once(page) -> str:
+    # 先刷新一次降低殘影
+    try:
+        await page.locator("#BookingS1Form_homeCaptcha_reCodeLink").click(timeout=800)
+        await page.wait_for_timeout(450)
+    except Exception:
+        pass
+    img = page.locator("#BookingS1Form_homeCaptcha_passCode")
+    await img.wait_for(timeout=6000)
+    raw = await img.screenshot()
+    return await asyncio.to_thread(_classify, raw)
+
+async def fill_captcha(page, text: str):
+    await page.locator("#securityCode").fill(text)
+    await page.evaluate(CAPTCHA_EVENTS_JS)
+
+async def handle_captcha(page, max_try=6, span=None) -> bool:
+    """span：thsrc_trace.Span，每次重試記一筆、辨識完回報一次心跳。"""
+    for i in range(max_try):
+        if i and span is not None:
+            span.retry()
+        try:
+            ans = await solve_captcha_once(page)
+            log(f"OCR 辨識結果: {ans}")
+            _beat(span)
+            if not ans:
+                continue
+            await fill_captcha(page, ans)
+            return True
+        except Exception as e:
+            log(f"處理驗證碼失敗（{i+1}/{max_try}）：{e}")
+    log("超過最大重試次數，無法處理驗證碼")
+    return False
+
+# -----------------------------
+# 填表
+# -----------------------------
+async def close_consent(page):
+    for label in ["我同意", "同意", "我同意，繼續", "同意並繼續"]:
+        try:
+            await page.get_by_role("button", name=label, exact=False).click(timeout=1200)
+            await human_sleep()
+            return
+        except Exception:
+            pass
+    try:
+        await page.get_by_text("同意", exact=False).first.click(timeout=1200)
+        await human_sleep()
+    except Exception:
+        pass
+
+async def _select(page, selector: str, span=None, **option):
+    await page.locator(selector).select_option(**option)
+    await human_sleep()
+    _beat(span)
+
+async def fill_search(page, query: SearchQuery, span=None):
+    """起訖站、日期、時間、票數。span：每填完一欄回報一次心跳。"""
+    await _select(page, 'select[name="selectStartStation"]', span, label=query.origin)
+    await _select(page, 'select[name="selectDestinationStation"]', span, label=query.dest)
+    await page.evaluate(SET_DATE_JS, flatpickr_date(query.date))
+    await human_sleep()
+    await _select(page, 'select[name="toTimeTable"]', span, label=query.time)
+    await _select(page, 'select[name="ticketPanel:rows:0:ticketAmount"]', span, value=f"{query.adult}F")
+    await _select(page, 'select[name="ticketPanel:rows:4:ticketAmount"]', span, value=f"{query.student}P")
+
+# -----------------------------
+# 送出與等待
+# -----------------------------
+async def wait_page_state(page, mode: str, timeout_ms: int) -> str:
+    """同 thsrc_browser.wait_page_state；導覽途中 context 被換掉時用剩餘時間重試。"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_ms / 1000.0
+    while True:
+        remaining = int((deadline - loop.time()) * 1000)
+        if remaining <= 0:
+            return "timeout"
+        try:
+            return await page.evaluate(PAGE_STATE_JS, {"mode": mode, "timeout": remaining})
+        except Exception:
+            await asyncio.sleep(0.1)
+
+async def wait_mask_then_clear_if_stuck(page, hard_timeout_ms=16000):
+    if await wait_page_state(page, "mask", hard_timeout_ms) == "clear":
+        return True
+    log("遮罩疑似卡住，嘗試呼叫 hideMaskFrame() 強制解除")
+    try:
+        await page.evaluate("hideMaskFrame && hideMaskFrame();")
+    except Exception:
+        pass
+    return await wait_page_state(page, "mask", 600) == "clear"
+
+async def wait_step2_or_error(page, timeout_ms=15000):
+    state = await wait_page_state(page, "step2", timeout_ms)
+    return state if state in ("step2", "error") else "none"
+
+async def read_error_text(page):
+    try:
+        if await page.locator("#divErrMSG").first.is_visible(timeout=500):
+            txt = await page.locator("#divErrMSG").inner_text(timeout=500)
+            return re.sub(r"\s+", " ", txt).strip()
+    except Exception:
+        pass
+    return ""
+
+async def submit_and_wait_step2(page, max_submit_retries=5, span=None):
+    """
+    - 送出查詢（no_wait_after：AJAX 提交，避免卡在「等待導航」）
+    - 等遮罩 → 等 Step2 或錯誤
+    - 若錯誤含驗證碼/錯誤字樣，重新解一次驗證碼後再送
+    span：thsrc_trace.Span，每次重送記一筆重試；點擊、等遮罩、等結果之間各回報一次心跳，
+    重解驗證碼也記在同一個 span（看門狗才看得到進度）。
+    """
+    for attempt in range(max_submit_retries):
+        if attempt and span is not None:
+            span.retry()
+        await page.locator("#SubmitButton").click(no_wait_after=True)
+        _beat(span)
+        await wait_mask_then_clear_if_stuck(page, hard_timeout_ms=18000)
+        _beat(span)
+        state = await wait_step2_or_error(page, timeout_ms=18000)
+        _beat(span)
+
+        if state == "step2":
+            return True
+        elif state == "error":
+            err = await read_error_text(page)
+            log(f"提交後出現錯誤：{err or '(無內容)'}")
+            if "驗證碼" in err or "錯誤" in err or "請重新輸入" in err:
+                log(f"嘗試重新解驗證碼並重送（{attempt+1} / {max_submit_retries}）")
+                await human_sleep(0.6)
+                if not await handle_captcha(page, span=span):
+                    return False
+                continue
+            return False
+        else:
+            log(f"等待結果超時（{attempt+1} / {max_submit_retries}），嘗試再送")
+            try:
+                await handle_captcha(page, span=span)
+            except Exception:
+                pass
+    return False
+
+async def scrape_trains_on_step2(page):
+    """
+    回傳 list[thsrc_rows.TrainRow]：date、code、departure / arrival / duration（分鐘）、
+    discount_text、discount_rate、selected。所有列在頁面內一次取回（STEP2_ROWS_JS）。
+    """
+    return rows_from_step2(await page.evaluate(STEP2_ROWS_JS, STEP2_ROWS_SELECTOR))
+
+async def save_debug_snapshot(page, name: str):
+    """抽樣 + 去重後交給 thsrc_snapshots 背景寫入 debug/；截圖失敗不影響原本的錯誤處理。"""
+    try:
+        await snapshots.capture_async(page, name)
+    except Exception as e:
+        log(f"除錯快照失敗：{e}")
+
+async def run_search(page, query: SearchQuery, trace: RoundTrace = None):
+    """
+    在既有 page 上跑完一輪：首頁 → 填表 → 驗證碼 → 送出 → 擷取 Step2。失敗丟 RuntimeError。
+    trace：thsrc_trace.RoundTrace，各階段記一個 span。
+    """
+    trace = trace or RoundTrace("search")
+    page.set_default_timeout(20000)
+
+    with trace.span("goto"):
+        log("前往首頁")
+        await page.goto(query.url or URL, wait_until="domcontentloaded", timeout=60000)
+        await human_sleep()
+
+    with trace.span("close_consent"):
+        await close_consent(page)
+
+    with trace.span("fill") as sp:
+        await fill_search(page, query, span=sp)
+
+    with trace.span("captcha") as sp:
+        log("嘗試解驗證碼")
+        if not await handle_captcha(page, span=sp):
+            sp.fail()
+            raise RuntimeError("無法處理驗證碼")
+
+    with trace.span("submit_and_wait_step2") as sp:
+        log("送出查詢")
+        if not await submit_and_wait_step2(page, max_submit_retries=6, span=sp):
+            sp.fail()
+            await save_debug_snapshot(page, "failed")
+            raise RuntimeError("送出查詢失敗或超時")
+
+    with trace.span("scrape") as sp:
+        log("已進入 Step2，開始擷取車次列表")
+        rows = await scrape_trains_on_step2(page)
+        sp.set(rows=len(rows))
+        if not rows:
+            sp.fail("no_rows")
+            log("Step2 無資料，儲存除錯快照")
+            await save_debug_snapshot(page, "no_rows")
+    return rows
+
+class AsyncNetMeter(NetMeter):
+    """thsrc_browser.NetMeter 的 async 版（route 改為 coroutine；流量同樣只讀 content-length）。"""
+    async def _on_route(self, route):
+        req = route.request
+        if resource_allowed(req.resource_type, req.url):
+            await route.continue_()
+        else:
+            self.blocked += 1
+            await route.abort()
+
+    async def attach(self, context):
+        if self.block:
+            await context.route("**/*", self._on_route)
+        context.on("response", self._on_response)
+        return self
+
+# -----------------------------
+# 引擎：共用 browser、每查詢一個 context、semaphore 限制同時頁數
+# -----------------------------
+class _Browser:
+    """引擎裡的一個瀏覽器：共用時跨查詢保留，profile 查詢時為該查詢專用的 persistent context。"""
+    __slots__ = ("key", "browser", "pids", "rounds", "active", "used", "retire")
+
+    def __init__(self, key, browser, pids):
+        self.key = key
+        self.browser = browser
+        self.pids = pids            # 啟動時新出現的瀏覽器行程（取不到時為空）
+        self.rounds = 0
+        self.active = 0             # 進行中的查詢數
+        self.used = time.monotonic()
+        self.retire = False         # 標記後不再分配新查詢，最後一個查詢結束時關閉
+
+    def process_tree(self):
+        return [q for pid in self.pids for q in (pid, *descendant_pids(pid))]
+
+class AsyncSearchEngine:
+    """
+    用法：
+        async with AsyncSearchEngine(concurrency=4) as eng:
+            rows = await eng.search(query)
+
+    max_rounds  : 同一個 browser 最多跑幾次查詢就關掉重開；0 代表不限
+    max_rss_mb  : 查詢結束時 browser 行程樹 RSS 超過此值就重開；0 代表不檢查
+    max_browsers: 同時保留的 browser 上限（不同 launch_key），超過時先關最久沒用的閒置 browser；0 代表不限
+    查詢失敗的 browser 一律重開（等進行中的其他查詢結束後才關）。
+    """
+    def __init__(self, concurrency: int = 4, max_rounds: int = 0, max_rss_mb: int = 0, max_browsers: int = 0):
+        self.concurrency = max(1, concurrency)
+        self.max_rounds = max_rounds
+        self.max_rss_mb = max_rss_mb
+        self.max_browsers = max_browsers
+        self.sem = asyncio.Semaphore(self.concurrency)
+        self.browsers = {}      # launch_key -> _Browser
+        self._profiles = set()  # 進行中的 persistent context（_Browser，browser 欄位為 context）
+        self._launch_lock = asyncio.Lock()
+        self._slots = {}        # launch_key -> asyncio.Queue（可用的 profile slot 編號）
+        self._pw = None
+        self._invalid = False
+        self.launches = 0
+        self.recycles = 0
+
+    async def __aenter__(self):
+        await self._start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _start(self):
+        from playwright.async_api import async_playwright
+        self._pw = await async_playwright().start()
+
+    # -------- 給 thsrc_watchdog 用（可從別的執行緒呼叫，只讀 pid / 設旗標） --------
+    def busy_pids(self):
+        """進行中查詢所用 browser 的行程樹。"""
+        busy = [b for b in list(self.browsers.values()) if b.active] + list(self._profiles)
+        return list(dict.fromkeys(pid for b in busy for pid in b.process_tree()))
+
+    def invalidate(self):
+        """Playwright driver 已被強制結束時呼叫：下一次查詢前整個引擎重開。"""
+        self._invalid = True
+
+    async def _restart_if_invalid(self):
+        if not self._invalid:
+            return
+        log("Playwright driver 已失效，整個瀏覽器引擎重開")
+        self._invalid = False
+        await self.close()
+        await self._start()
+
+    # -------- browser / context --------
+    async def _launch(self, key, launcher):
+        before = set(browser_pids())
+        browser = await launcher()
+        self.launches += 1
+        return _Browser(key, browser, [pid for pid in browser_pids() if pid not in before])
+
+    async def _browser(self, query: SearchQuery) -> _Browser:
+        key = query.launch_key()
+        async with self._launch_lock:
+            await self._restart_if_invalid()
+            b = self.browsers.get(key)
+            if b is not None and not b.browser.is_connected():
+                log("瀏覽器已斷線，重開")
+                b.retire = True
+                await self._drop(b)
+                b = None
+            if b is None:
+                await self._make_room()
+                b = await self._launch(key, lambda: self._pw.chromium.launch(**launch_options(query)))
+                self.browsers[key] = b
+            b.active += 1
+            b.used = time.monotonic()
+            return b
+
+    async def _make_room(self):
+        if not self.max_browsers:
+            return
+        idle = sorted((b for b in self.browsers.values() if not b.active), key=lambda b: b.used)
+        while idle and len(self.browsers) >= self.max_browsers:
+            b = idle.pop(0)
+            b.retire = True
+            await self._drop(b)
+
+    async def _context(self, query: SearchQuery):
+        """
+        回傳 (context, slot, owner)：slot 為占用的 profile slot 編號，owner 為所用的 _Browser。
+        沒用 profile 時 slot 為 None；用 profile 時 owner 的 browser 欄位就是 persistent context。
+        """
+        prof = query_profile(query)
+        if prof is None:
+            b = await self._browser(query)
+            try:
+                return await b.browser.new_context(**context_options(query)), None, b
+            except Exception:
+                await self._done(b, ok=False)
+                raise
+        key = query.launch_key()
+        if key not in self._slots:
+            self._slots[key] = asyncio.Queue()
+            for i in range(self.concurrency):
+                self._slots[key].put_nowait(i)
+        slot = await self._slots[key].get()
+        try:
+            async with self._launch_lock:
+                await self._restart_if_invalid()
+            user_data_dir = prof.prepare(f"{ProfileDir.slot_name(key)}-{slot}")
+            b = await self._launch(key, lambda: self._pw.chromium.launch_persistent_context(
+                user_data_dir, args=prof.launch_args(), **launch_options(query), **context_options(query)))
+            self._profiles.add(b)
+            await b.browser.clear_cookies()
+        except Exception:
+            self._slots[key].put_nowait(slot)
+            raise
+        return b.browser, slot, b
+
+    async def search(self, query: SearchQuery, trace: RoundTrace = None, linger_sec: float = 0.0):
+        """跑一輪查詢並回傳 rows（欄位同 scrape_trains_on_step2）；失敗丟例外（並留下 debug/ 快照）。"""
+        trace = trace or RoundTrace("search")
+        async with self.sem:
+            with trace.span("launch") as sp:
+                context, slot, owner = await self._context(query)
+                sp.set(reused=owner.rounds > 0)
+                try:
+                    await context.add_init_script(STEALTH_INIT_SCRIPT)
+                    meter = None
+                    if query.block_resources or query.measure_net:
+                        meter = await AsyncNetMeter(block=query.block_resources).attach(context)
+                    page = await context.new_page()
+                except Exception:
+                    await self._release(query, context, slot, owner, ok=False)
+                    raise
+            ok = False
+            try:
+                rows = await run_search(page, query, trace)
+                if linger_sec:
+                    await asyncio.sleep(linger_sec)  # 保留觀察
+                ok = True
+                return rows
+            except Exception:
+                try:
+                    await save_debug_snapshot(page, "exception")
+                except Exception:
+                    pass
+                raise
+            finally:
+                if meter is not None:
+                    trace.set(**meter.take())
+                await self._release(query, context, slot, owner, ok)
+
+    async def _release(self, query: SearchQuery, context, slot, owner: _Browser, ok: bool):
+        try:
+            if slot is None:
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+                await self._done(owner, ok)
+            else:
+                # persistent context：關 context 即關瀏覽器
+                self._profiles.discard(owner)
+                await context.close()
+        finally:
+            if slot is not None:
+                self._slots[query.launch_key()].put_nowait(slot)
+
+    async def _done(self, b: _Browser, ok: bool):
+        """查詢結束時歸還 browser，依錯誤 / 輪數 / 記憶體決定是否重開。"""
+        b.active -= 1
+        b.rounds += 1
+        why = self._recycle_reason(b, ok)
+        if why and not b.retire:
+            log(f"回收瀏覽器（{why}，已用 {b.rounds} 次查詢）")
+            b.retire = True
+        if b.retire:
+            await self._drop(b)
+
+    def _recycle_reason(self, b: _Browser, ok: bool) -> str:
+        if not ok:
+            return "本輪發生錯誤"
+        if self.max_rounds and b.rounds >= self.max_rounds:
+            return "達到輪數上限"
+        if self.max_rss_mb:
+            rss = sum(process_rss_mb(pid) for pid in b.process_tree())
+            if rss > self.max_rss_mb:
+                return f"記憶體 {rss:.0f}MB 超過上限 {self.max_rss_mb}MB"
+        return ""
+
+    async def _drop(self, b: _Browser):
+        """不再分配新查詢給 b；沒有進行中的查詢時關閉。"""
+        if self.browsers.get(b.key) is b:
+            del self.browsers[b.key]
+        if b.active:
+            return
+        self.recycles += 1
+        try:
+            await b.browser.close()
+        except Exception:
+            pass
+
+    async def close(self):
+        for b in list(self.browsers.values()) + list(self._profiles):
+            try:
+                await b.browser.close()
+            except Exception:
+                pass
+        self.browsers.clear()
+        self._profiles.clear()
+        if self._pw is not None:
+            try:
+                await self._pw.stop()
+            except Exception:
+                pass
+            self._pw = None
+
+class BlockingSearchEngine:
+    """
+    給同步程式（thsrc_watch 的 inprocess / 多查詢模式）用的長駐引擎：
+    背景執行緒跑一個 event loop 與 AsyncSearchEngine，search() 阻塞到該輪結束，browser 跨輪保留。
+    參數同 AsyncSearchEngine；第一次查詢時才載入 Playwright。
+    busy_pids / invalidate 照轉給引擎，可直接交給 thsrc_watchdog.Watchdog.for_pool。
+    """
+    def __init__(self, **engine_kw):
+        self.engine = AsyncSearchEngine(**engine_kw)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="thsrc-async", daemon=True)
+        self._thread.start()
+        self._started = False
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def search(self, query: SearchQuery, trace: RoundTrace = None, linger_sec: float = 0.0):
+        if not self._started:
+            self._call(self.engine._start())
+            self._started = True
+        return self._call(self.engine.search(query, trace=trace, linger_sec=linger_sec))
+
+    def busy_pids(self):
+        return self.engine.busy_pids()
+
+    def invalidate(self):
+        self.engine.invalidate()
+
+    @property
+    def launches(self):
+        return self.engine.launches
+
+    @property
+    def recycles(self):
+        return self.engine.recycles
+
+    def close(self):
+        try:
+            if self._started:
+                self._call(self.engine.close())
+                self._started = False
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop.close()
+
+async def search_async(query: SearchQuery, trace: RoundTrace = None, linger_sec: float = 0.0):
+    """單一查詢：開一個引擎、跑完即關。"""
+    async with AsyncSearchEngine(concurrency=1) as eng:
+        return await eng.search(query, trace=trace, linger_sec=linger_sec)
+
+async def search_and_save_async(eng: AsyncSearchEngine, query: SearchQuery, csv_path: str,
+                                store: str = "", trace_sink=None):
+    """同 thsrc_search_v2_plus.search_and_save：查詢 + 寫出，整輪記成一筆 trace。"""
+    trace = RoundTrace("search", sink=trace_sink, route=f"{query.origin}→{query.dest}",
+                       date=query.date, time=query.time)
+    try:
+        rows = await eng.search(query, trace=trace)
+        with trace.span("save") as sp:
+            if rows:
+                # CSV / SQLite 寫入會阻塞，丟到執行緒跑，不卡住其他頁面
+                diff = await asyncio.to_thread(save_results, rows, csv_path, store, query)
+                if diff is not None:
+                    sp.set(appeared=len(diff.appeared), disappeared=len(diff.disappeared))
+    except Exception as e:
+        trace.finish("error", reason=str(e))
+        raise
+    trace.finish("ok" if rows else "no_rows", rows=len(rows))
+    return rows
+
+async def search_many(jobs, concurrency: int = 4, trace_sink=None):
+    """
+    同時跑多個查詢（jobs：thsrc_scheduler.WatchJob），最多 concurrency 頁同時進行。
+    回傳 list，順序同 jobs；每項為 rows 或該查詢丟出的例外。
+    """
+    async with AsyncSearchEngine(concurrency=concurrency) as eng:
+        return await asyncio.gather(
+            *(search_and_save_async(eng, j.query, j.csv, j.store, trace_sink) for j in jobs),
+            return_exceptions=True,
+        )
+
+def main():
+    from thsrc_scheduler import load_jobs
+
+    ap = argparse.ArgumentParser(description="THSR 查詢（asyncio 版，多查詢共用一個 event loop）")
+    ap.add_argument("--queries", required=True, help="查詢清單 JSON（格式同 thsrc_watch --queries）")
+    ap.add_argument("--concurrency", type=int, default=4, help="同時進行的頁面數上限")
+    ap.add_argument("--trace", default="", help="逐階段計時輸出（JSON Lines 檔路徑；'-' 為 stdout；空白不輸出）")
+    ap.add_argument("--snapshot_dir", default="debug", help="失敗時的除錯快照目錄")
+    ap.add_argument("--snapshot_rate", type=float, default=1.0, help="失敗時拍快照的抽樣比例（0~1；0=不拍）")
+    ap.add_argument("--snapshot_max_mb", type=float, default=50, help="快照目錄大小上限（MB）")
+    args = ap.parse_args()
+    snapshots.configure(args.snapshot_dir, args.snapshot_rate, args.snapshot_max_mb)
+
+    try:
+        jobs = load_jobs(args.queries)
+    except (OSError, ValueError) as e:
+        log(f"讀取查詢清單失敗：{e}")
+        sys.exit(2)
+
+    results = asyncio.run(search_many(jobs, args.concurrency, open_sink(args.trace)))
+    failed = 0
+    for job, res in zip(jobs, results):
+        if isinstance(res, BaseException):
+            failed += 1
+            log(f"[{job.id}] 發生例外：{res}")
+        else:
+            log(f"[{job.id}] 完成：{len(res)} 筆")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,12 @@ THSR 監看 → 命中自動訂 (單檔版，使用 CONFIG 設定)
 
 說明:
   - 將下方 CONFIG 改成你的參數後，直接執行此檔。
-  - 會每次開新瀏覽器查詢 → 發現符合折數(預設「學生5折」)就自動選班次並完成訂位。
+  - 或把要改的項目寫成 JSON 覆寫檔（例：{"search": {"time": "09:00"}, "notify": {"mail_to": ["a@b.c"]}}），
+    以環境變數 THSRC_CONFIG 指向它：執行中修改該檔（或 kill -HUP）會在回合之間套用，不必重啟；
+    只有查詢條件改變時才立刻重查，其餘沿用原本的排程。browser 區段需重啟才會生效。
+  - 瀏覽器由 SessionPool 跨回合重用（每個代理一個 session，輪換代理不必重開）；
+    用滿 pool_max_rounds 輪、RSS 超過 pool_max_rss_mb 或該輪出錯時回收重開。
+    發現符合折數(預設「學生5折」)就自動選班次並完成訂位。
   - 成功或到期未命中，都會寄 Email 通知。(無簡訊)
 
 這版徹底修正「卡在請稍候…遮罩」：
@@ -19,16 +24,30 @@ THSR 監看 → 命中自動訂 (單檔版，使用 CONFIG 設定)
 """
 
 from __future__ import annotations
-import os, time, random, re, smtplib, traceback
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import copy, os, time, random, re, traceback
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from contextlib import contextmanager
 from typing import Optional, Tuple
 
-from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError
-import ddddocr
+# playwright / ddddocr 在第一次用到時才 import（載入要好幾秒），設定錯誤可以立刻回報
+from thsrc_browser import (
+    STEP2_ROWS_SELECTOR,
+    NetMeter,
+    ProfileDir,
+    SessionPool,
+    extract_step2_rows,
+    net_meter,
+    wait_mask_then_clear_if_stuck,
+    wait_step2_or_error,
+)
+from thsrc_notify import Notifier, NotifyWorker, SmtpConfig, SmtpConnection
+from thsrc_reload import ConfigFile, changed_sections, install_sighup, load_json, merge_config
+from thsrc_scheduler import AdaptivePolicy, next_deadline
+from thsrc_rules import compile_rules
+from thsrc_search_v2_plus import SearchQuery, check_query
+from thsrc_trace import RoundTrace, Span, open_sink
+from thsrc_watchdog import Watchdog
 
 # =============================
 #            CONFIG
@@ -41,7 +60,7 @@ CONFIG = {
         "time": "08:00",        # 下拉選項顯示文字
         "adult": 0,
         "student": 1,
-        "discount_key": "學生5折",  # 命中關鍵字 (例: 學生5折 / 學生75折 / 學生88折)
+        "discount_key": "學生5折",  # 命中規則 (例: 學生5折 / 學生<=75折 / 早鳥；語法見 thsrc_rules.py)
     },
     "booking": {
         "idno": "F130355710",
@@ -52,10 +71,20 @@ CONFIG = {
         # 每回合等待秒數區間 (含隨機抖動)
         "interval_min": 10,
         "interval_max": 30,
+        # 自適應間隔：近出發 / 歷史上常出現折扣的時段較密，其餘放慢 (最多 interval_max * backoff)
+        # history_db 為查詢結果的 SQLite 檔 (thsrc_search_v2_plus --store sqlite:PATH)，空字串則只看出發時間
+        "adaptive": False,
+        "history_db": "",
+        "backoff": 3.0,
         # 到期時間 (Asia/Taipei)，到期仍未命中會寄信並結束；留空代表無期限
         "until": "2025-10-17 01:50",
         # 安全網: 最多嘗試回合數 (None 代表不限制)
         "max_rounds": None,
+        # 逐階段計時輸出 (JSON Lines 檔路徑；"-" 為 stdout；空字串不輸出)
+        "trace_sink": "",
+        # 看門狗：超過該階段最長正常等待 (goto 60 秒、其餘 30~40 秒) 再加此秒數沒有進度，
+        # 就強制結束瀏覽器並回收，不等重試一路耗完 (0 = 關閉；例如 15)
+        "watchdog_sec": 0,
     },
     "browser": {
         "use_edge": True,       # True 則使用 Edge channel
@@ -64,6 +93,16 @@ CONFIG = {
         # 可選：覆寫 UA / Accept-Language
         "force_user_agent": None,  # 例如: Edge on Windows UA；None 則使用預設(隨 channel)
         "accept_language": "zh-TW,zh;q=0.9,en;q=0.8",
+        # 瀏覽器跨回合重用：同一個瀏覽器最多用幾回合 (0 = 每回合重開)、記憶體上限 MB (0 = 不檢查)
+        "pool_max_rounds": 30,
+        "pool_max_rss_mb": 0,
+        # 只載入頁面 / AJAX / script / 驗證碼圖，圖片、字型、CSS、第三方追蹤一律擋掉 (省 proxy 流量)
+        "block_resources": False,
+        # 持久化 profile 目錄：靜態 JS / CSS 第二回合起走磁碟快取 (空字串 = 每回合全新 context)
+        # 目錄超過 profile_max_mb 或每隔 profile_wipe_hours 小時整個清空；與 block_resources 同開時快取無效
+        "profile_dir": "",
+        "profile_max_mb": 200,
+        "profile_wipe_hours": 24,
     },
     "notify": {
         "enabled": True,
@@ -72,15 +111,28 @@ CONFIG = {
             "port": 587,
             "username": "gogle130355710@gmail.com",
             "password": "xyqrcfauievkzqap",  # 16 碼 App Password
-            "starttls": True,
+            "starttls": True,   # 本機測試替身 (aiosmtpd) 可設 False，username 留空則不登入
         },
+        # 寄送失敗的信存在這裡，之後重寄
+        "retry_queue": ".state/mail_queue.jsonl",
         "mail_from": "gogle130355710@gmail.com",
         "mail_to": ["gogle130355710@gmail.com"],
         "subject_prefix": "[THSR Watcher Test] ",
     },
 }
 
-URL = "https://irs.thsrc.com.tw/IMINT/?utm_source=thsrc&utm_medium=btnlink&utm_term=booking"
+# 可用環境變數 THSRC_CONFIG 指向 JSON 覆寫檔（合併進 CONFIG，執行中修改會熱載入）
+CONFIG_FILE = os.environ.get("THSRC_CONFIG", "")
+# 覆寫檔一律合併在這份原始預設上：從檔案刪掉的項目會回到預設值，重複載入結果相同
+BASE_CONFIG = copy.deepcopy(CONFIG)
+# 只在啟動時讀一次的 watch 設定（看門狗執行緒、trace 輸出檔），改了需重啟
+RESTART_WATCH_KEYS = ("watchdog_sec", "trace_sink")
+RELOAD_POLL_SEC = 2
+# 查詢條件：改變時下一回合立刻用新條件查
+SEARCH_KEYS = ("origin", "dest", "date", "time", "adult", "student")
+
+# 可用環境變數 THSRC_URL 指向離線回放站（thsrc_replay_server.py）
+URL = os.environ.get("THSRC_URL") or "https://irs.thsrc.com.tw/IMINT/?utm_source=thsrc&utm_medium=btnlink&utm_term=booking"
 TZ = ZoneInfo("Asia/Taipei")
 DEFAULT_EDGE_UA = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -92,8 +144,8 @@ DEFAULT_EDGE_UA = (
 #          Utilities
 # =============================
 
-def _until_dt() -> Optional[datetime]:
-    s = CONFIG["watch"].get("until")
+def _until_dt(conf: dict = None) -> Optional[datetime]:
+    s = (conf or CONFIG)["watch"].get("until")
     if not s:
         return None
     try:
@@ -122,28 +174,44 @@ def load_proxies(path: str) -> list[str]:
         return [ln.strip() for ln in f if ln.strip() and not ln.strip().startswith("#")]
 
 
+_notifier: Optional[NotifyWorker] = None
+
+
+def _get_notifier() -> NotifyWorker:
+    """
+    背景執行緒寄信，監看迴圈不必等 SMTP；整個程式共用一條 SMTP 連線。
+    寄送失敗的信存進 retry_queue，背景執行緒依退避時間重寄（下次啟動也會接著寄）。
+    """
+    global _notifier
+    if _notifier is None:
+        conf = CONFIG["notify"]
+        smtp = conf["smtp"]
+        cfg = SmtpConfig(
+            host=smtp["host"],
+            port=int(smtp["port"]),
+            username=smtp.get("username", ""),
+            password=smtp.get("password", ""),
+            starttls=smtp.get("starttls", True),
+        )
+        notifier = Notifier(SmtpConnection(cfg), conf["mail_from"],
+                            retry_path=conf.get("retry_queue", ".state/mail_queue.jsonl"))
+        _notifier = NotifyWorker(notifier)
+    return _notifier
+
+
 def send_email(subject: str, html: str):
     if not CONFIG["notify"]["enabled"]:
         return
     conf = CONFIG["notify"]
-    smtp = conf["smtp"]
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = conf.get("subject_prefix", "") + subject
-    msg["From"] = conf["mail_from"]
-    msg["To"] = ", ".join(conf["mail_to"])
-    msg.attach(MIMEText(html, "html", _charset="utf-8"))
-
-    s = smtplib.SMTP(smtp["host"], smtp["port"], timeout=20)
-    try:
-        if smtp.get("starttls", True):
-            s.starttls()
-        s.login(smtp["username"], smtp["password"])
-        s.sendmail(conf["mail_from"], conf["mail_to"], msg.as_string())
-    finally:
-        try:
-            s.quit()
-        except Exception:
-            pass
+    _get_notifier().notify(conf["mail_to"], conf.get("subject_prefix", "") + subject, html)
+
+
+def close_notifier():
+    """結束前等背景執行緒把排入的信寄完。"""
+    global _notifier
+    if _notifier is not None:
+        _notifier.close()
+        _notifier = None
 
 # =============================
 #       Playwright helpers
@@ -191,76 +259,6 @@ def force_hide_mask(page):
         pass
 
 
-def wait_mask_then_clear_if_stuck(page, check_every_ms=400, hard_timeout_ms=16000):
-    """
-    等待 loading 遮罩消失；若超時則呼叫頁面現成的 hideMaskFrame() 嘗試解除。
-    """
-    start = time.time()
-    while True:
-        try:
-            ok = page.evaluate(
-                """() => {
-                    const isHidden = (el) => !el || el.style.display === 'none' || getComputedStyle(el).display === 'none';
-                    const a = document.querySelector('#divMaskFrame');
-                    const b = document.querySelector('#loadingMask');
-                    const c = document.querySelector('#BusyBoxDiv');
-                    return isHidden(a) && isHidden(b) && isHidden(c);
-                }"""
-            )
-            if ok:
-                return True
-        except Exception:
-            pass
-
-        if (time.time() - start) * 1000 > hard_timeout_ms:
-            log("遮罩疑似卡住，嘗試呼叫 hideMaskFrame() 強制解除")
-            try:
-                page.evaluate("hideMaskFrame && hideMaskFrame();")
-            except Exception:
-                pass
-            time.sleep(0.6)
-            try:
-                ok = page.evaluate(
-                    """() => {
-                        const isHidden = (el) => !el || el.style.display === 'none' || getComputedStyle(el).display === 'none';
-                        const a = document.querySelector('#divMaskFrame');
-                        const b = document.querySelector('#loadingMask');
-                        const c = document.querySelector('#BusyBoxDiv');
-                        return isHidden(a) && isHidden(b) && isHidden(c);
-                    }"""
-                )
-                return ok
-            except Exception:
-                return False
-
-        time.sleep(check_every_ms / 1000.0)
-
-
-def wait_step2_or_error(page, timeout_ms: int = 15000):
-    """
-    等待「選擇車次」(Step2) 結果區塊，或錯誤區塊顯示。
-    回傳 'step2' / 'error' / 'none'
-    """
-    start = time.time()
-    while (time.time() - start) * 1000 <= timeout_ms:
-        try:
-            if page.locator("#BookingS2Form_TrainQueryDataViewPanel").first.is_visible(timeout=500):
-                return "step2"
-        except Exception:
-            pass
-
-        try:
-            err_block = page.locator("#divErrMSG")
-            if err_block.count() > 0 and err_block.first.is_visible(timeout=200):
-                return "error"
-        except Exception:
-            pass
-
-        time.sleep(0.25)
-
-    return "none"
-
-
 def wait_ajax_idle(page, timeout=20000):
     wait_mask_then_clear_if_stuck(page, hard_timeout_ms=timeout)
 
@@ -277,6 +275,7 @@ def read_error_text(page) -> str:
 
 class CaptchaSolver:
     def __init__(self):
+        import ddddocr
         self.ocr = ddddocr.DdddOcr()
 
     def solve_once(self, page) -> str:
@@ -314,12 +313,21 @@ class CaptchaSolver:
         )
 
 
-def handle_captcha(page, max_try=6) -> bool:
+def _beat(span: Optional[Span]):
+    """長等待之間回報心跳給看門狗（thsrc_watchdog）；沒有 span 時什麼都不做。"""
+    if span is not None:
+        span.beat()
+
+
+def handle_captcha(page, max_try=6, span: Optional[Span] = None) -> bool:
     solver = CaptchaSolver()
     for i in range(max_try):
+        if i and span is not None:
+            span.retry()
         try:
             ans = solver.solve_once(page)
             log(f"OCR 辨識結果: {ans}")
+            _beat(span)
             if not ans:
                 continue
             solver.fill(page, ans)
@@ -330,12 +338,14 @@ def handle_captcha(page, max_try=6) -> bool:
     return False
 
 
-def fill_search(page):
+def fill_search(page, span: Optional[Span] = None):
     s = CONFIG["search"]
     page.locator('select[name="selectStartStation"]').select_option(label=s["origin"])
     human_sleep()
+    _beat(span)
     page.locator('select[name="selectDestinationStation"]').select_option(label=s["dest"])
     human_sleep()
+    _beat(span)
     yyyy, mm, dd = s["date"].split("-")
     v = f"{yyyy}/{int(mm):02d}/{int(dd):02d}"
     page.evaluate(
@@ -349,8 +359,10 @@ def fill_search(page):
     human_sleep()
     page.locator('select[name="toTimeTable"]').select_option(label=s["time"])
     human_sleep()
+    _beat(span)
     page.locator('select[name="ticketPanel:rows:0:ticketAmount"]').select_option(value=f"{s['adult']}F")
     human_sleep()
+    _beat(span)
     page.locator('select[name="ticketPanel:rows:4:ticketAmount"]').select_option(value=f"{s['student']}P")
     human_sleep()
 
@@ -359,11 +371,16 @@ def click_search(page):
     page.locator('#SubmitButton').click(no_wait_after=True)
 
 
-def submit_and_wait_step2(page, max_submit_retries=5):
+def submit_and_wait_step2(page, max_submit_retries=5, span: Optional[Span] = None):
     for attempt in range(max_submit_retries):
+        if attempt and span is not None:
+            span.retry()
         click_search(page)
+        _beat(span)
         wait_mask_then_clear_if_stuck(page, hard_timeout_ms=18000)
+        _beat(span)
         state = wait_step2_or_error(page, timeout_ms=18000)
+        _beat(span)
 
         if state == "step2":
             return True
@@ -372,7 +389,7 @@ def submit_and_wait_step2(page, max_submit_retries=5):
             log(f"提交後出現錯誤：{err or '(無內容)'}")
             if "驗證碼" in err or "錯誤" in err or "請重新輸入" in err:
                 log(f"嘗試重新解驗證碼並重送（{attempt+1} / {max_submit_retries}）")
-                if not handle_captcha(page):
+                if not handle_captcha(page, span=span):
                     return False
                 continue
             else:
@@ -380,74 +397,84 @@ def submit_and_wait_step2(page, max_submit_retries=5):
         else:
             log(f"等待結果超時（{attempt+1} / {max_submit_retries}），嘗試再送")
             try:
-                handle_captcha(page)
+                handle_captcha(page, span=span)
             except Exception:
                 pass
             continue
     return False
 
 
-def parse_and_pick_discount(page) -> bool:
-    key = CONFIG["search"]["discount_key"]
+def parse_and_pick_discount(page, span: Optional[Span] = None) -> bool:
+    rules = compile_rules(CONFIG["search"]["discount_key"])
     page.wait_for_load_state("domcontentloaded")
+    _beat(span)
     wait_mask_then_clear_if_stuck(page, hard_timeout_ms=20000)
+    _beat(span)
     if wait_step2_or_error(page, timeout_ms=20000) != "step2":
         return False
+    _beat(span)
 
-    # 找到所有車次列
-    items = page.locator("#BookingS2Form_TrainQueryDataViewPanel .result-listing label.result-item")
-    n = items.count()
+    # 一次取回所有車次列的折扣文字，再挑第一個命中的
     target_index = -1
-    for i in range(n):
-        try:
-            lab = items.nth(i)
-            disc_txt = lab.locator(".discount").inner_text(timeout=800).strip()
-            if key in disc_txt:
-                target_index = i
-                break
-        except Exception:
-            continue
+    for i, r in enumerate(extract_step2_rows(page)):
+        if rules.test_text(r["discount_raw"]):
+            target_index = i
+            break
 
     if target_index == -1:
         return False
 
+    items = page.locator(STEP2_ROWS_SELECTOR)
+
     row = items.nth(target_index)
     row.click()
     human_sleep()
+    _beat(span)
     # 確認車次
     try:
         page.locator('input.btn-next[value="確認車次"]').click()
     except Exception:
+        _beat(span)
         try:
             page.get_by_role("button", name="確認車次", exact=False).click()
         except Exception:
             pass
+    _beat(span)
     wait_mask_then_clear_if_stuck(page, hard_timeout_ms=20000)
     return True
 
 
-def step3_fill_and_submit(page) -> bool:
+def step3_fill_and_submit(page, span: Optional[Span] = None) -> bool:
+    from playwright.sync_api import TimeoutError as PWTimeoutError
     b = CONFIG["booking"]
     page.wait_for_selector('#BookingS3FormSP', timeout=25000)
+    _beat(span)
 
     page.locator('#idInputRadio').select_option(value='0')
     page.locator('#idNumber').fill(b['idno'])
+    _beat(span)
     if b.get('phone'):
         page.locator('#mobilePhone').fill(b['phone'])
+        _beat(span)
     if b.get('email'):
         page.locator('#email').fill(b['email'])
+        _beat(span)
 
     try:
         page.locator('#memberSystemRadio3').check()
     except Exception:
         pass
+    _beat(span)
 
     page.locator('input[name="agree"]').check()
+    _beat(span)
 
     page.locator('#isSubmit').scroll_into_view_if_needed()
     human_sleep()
     page.locator('#isSubmit').click()
+    _beat(span)
     wait_mask_then_clear_if_stuck(page, hard_timeout_ms=20000)
+    _beat(span)
 
     # 可能彈窗
     for sel in ['#btn-custom2', '#SubmitPassButton']:
@@ -455,7 +482,9 @@ def step3_fill_and_submit(page) -> bool:
             page.locator(sel).click(timeout=1500)
         except Exception:
             pass
+    _beat(span)
     wait_mask_then_clear_if_stuck(page, hard_timeout_ms=20000)
+    _beat(span)
 
     try:
         page.wait_for_function(
@@ -467,22 +496,33 @@ def step3_fill_and_submit(page) -> bool:
         return False
 
 
-@contextmanager
-def make_context(p, proxy: Optional[str]):
+def new_browser_context(p, proxy: Optional[str]):
+    """回傳 (browser, ctx)；設定 profile_dir 時走 launch_persistent_context，browser 為 None。"""
     br = CONFIG["browser"]
-    browser = p.chromium.launch(
+    launch_kwargs = dict(
         headless=br.get("headless", False),
         channel=("msedge" if br.get("use_edge") else None),
         proxy=(proxy and {"server": proxy}) or None,
     )
     user_agent = br.get("force_user_agent") or DEFAULT_EDGE_UA
-    ctx = browser.new_context(
+    ctx_kwargs = dict(
         locale="zh-TW",
         timezone_id="Asia/Taipei",
         viewport={"width":1280, "height":900},
         user_agent=user_agent,
         extra_http_headers={"Accept-Language": br.get("accept_language", "zh-TW,zh;q=0.9")},
     )
+    if br.get("profile_dir"):
+        if br.get("block_resources"):
+            log("注意：block_resources 會讓瀏覽器停用 HTTP cache，profile_dir 的磁碟快取將無作用")
+        prof = ProfileDir(br["profile_dir"], int(br.get("profile_max_mb", 200)), float(br.get("profile_wipe_hours", 24)))
+        browser = None
+        ctx = p.chromium.launch_persistent_context(
+            prof.prepare(ProfileDir.slot_name(("book", proxy))), args=prof.launch_args(), **launch_kwargs, **ctx_kwargs)
+        ctx.clear_cookies()
+    else:
+        browser = p.chromium.launch(**launch_kwargs)
+        ctx = browser.new_context(**ctx_kwargs)
     ctx.add_init_script(
         """
             Object.defineProperty(navigator, 'webdriver', { get: () => undefined });
@@ -498,64 +538,243 @@ def make_context(p, proxy: Optional[str]):
             }
         """
     )
+    if br.get("block_resources"):
+        NetMeter(block=True).attach(ctx)
+    return browser, ctx
+
+
+@contextmanager
+def make_context(p, proxy: Optional[str]):
+    browser, ctx = new_browser_context(p, proxy)
     try:
         yield ctx
     finally:
-        ctx.close(); browser.close()
+        ctx.close()
+        if browser is not None:
+            browser.close()
 
 
 # =============================
 #           Runner
 # =============================
 
-def run_once(proxy: Optional[str]) -> Tuple[bool, str, Optional[str]]:
+def run_once(proxy: Optional[str], pool: Optional[SessionPool] = None,
+             trace: Optional[RoundTrace] = None) -> Tuple[bool, str, Optional[str]]:
     """回傳 (is_success, reason, ticket_html)
     reason: booked / no_match / captcha_failed / submit_failed / exception
     ticket_html: 成功時回傳 Step3 摘要 HTML 片段以供寄信 (容錯: 可能為 None)
+    pool: 給了就借用長駐瀏覽器 (exception 時該瀏覽器會被回收)，否則每回合開新瀏覽器
+    trace: 逐階段計時；本函式結束時會把 reason 寫進該回合紀錄
     """
-    with sync_playwright() as p, make_context(p, proxy) as ctx:
-        page = ctx.new_page()
-        try:
+    trace = trace or RoundTrace("auto_book", proxy=proxy or "-")
+    result = (False, 'exception', None)
+    try:
+        if pool is not None:
+            with trace.span("launch") as sp:
+                sess = pool.acquire(("book", proxy), lambda p: new_browser_context(p, proxy))
+                sp.set(reused=sess.rounds > 0)
+            try:
+                result = _run_on_page(sess.page, trace)
+            finally:
+                _record_net(sess.page, trace)
+                sess.failed = result[1] == 'exception'
+                pool.release(sess)
+            return result
+
+        from playwright.sync_api import sync_playwright
+        with sync_playwright() as p:
+            with trace.span("launch"):
+                browser, ctx = new_browser_context(p, proxy)
+            page = ctx.new_page()
+            try:
+                result = _run_on_page(page, trace)
+            finally:
+                _record_net(page, trace)
+                ctx.close()
+                if browser is not None:
+                    browser.close()
+            return result
+    finally:
+        trace.finish("ok" if result[0] else "fail", reason=result[1])
+
+
+def _record_net(page, trace: RoundTrace) -> None:
+    meter = net_meter(page)
+    if meter is not None:
+        trace.set(**meter.take())
+
+
+def _run_on_page(page, trace: RoundTrace) -> Tuple[bool, str, Optional[str]]:
+    try:
+        with trace.span("goto"):
             page.goto(URL, wait_until='domcontentloaded', timeout=60000)
+        with trace.span("close_consent") as sp:
             close_consent(page)
+            sp.beat()
             wait_ajax_idle(page, 15000)  # 首屏遮罩先確保關掉
 
-            fill_search(page)
-            if not handle_captcha(page):
+        with trace.span("fill") as sp:
+            fill_search(page, span=sp)
+        with trace.span("captcha") as sp:
+            if not handle_captcha(page, span=sp):
+                sp.fail()
                 return False, 'captcha_failed', None
 
+        with trace.span("submit_and_wait_step2") as sp:
             log("送出查詢")
-            ok_submit = submit_and_wait_step2(page, max_submit_retries=6)
+            ok_submit = submit_and_wait_step2(page, max_submit_retries=6, span=sp)
             if not ok_submit:
+                sp.fail()
                 return False, 'submit_failed', None
 
-            picked = parse_and_pick_discount(page)
+        with trace.span("pick") as sp:
+            picked = parse_and_pick_discount(page, span=sp)
             if not picked:
+                sp.fail("no_match")
                 return False, 'no_match', None
 
-            try:
-                card_html = page.locator('.ticket-card').first.inner_html(timeout=5000)
-            except Exception:
-                card_html = None
-
-            ok = step3_fill_and_submit(page)
-            return (True, 'booked', card_html) if ok else (False, 'submit_failed', card_html)
+        try:
+            card_html = page.locator('.ticket-card').first.inner_html(timeout=5000)
         except Exception:
-            return False, 'exception', None
+            card_html = None
+
+        with trace.span("step3") as sp:
+            ok = step3_fill_and_submit(page, span=sp)
+            if not ok:
+                sp.fail()
+        return (True, 'booked', card_html) if ok else (False, 'submit_failed', card_html)
+    except Exception:
+        return False, 'exception', None
+
+
+def config_errors(conf: dict) -> list[str]:
+    s, w = conf["search"], conf["watch"]
+    errors = []
+    try:
+        check_query(SearchQuery(origin=s["origin"], dest=s["dest"], date=s["date"], time=s["time"],
+                                adult=int(s["adult"]), student=int(s["student"])))
+    except ValueError as e:
+        errors.append(str(e))
+    try:
+        compile_rules(s.get("discount_key") or "")
+    except ValueError as e:
+        errors.append(f"search.discount_key：{e}")
+    if int(w["interval_min"]) <= 0 or int(w["interval_max"]) < int(w["interval_min"]):
+        errors.append("watch.interval_min 需大於 0 且不大於 interval_max")
+    if w.get("until") and _until_dt(conf) is None:
+        errors.append(f"watch.until 格式應為 YYYY-MM-DD 或 YYYY-MM-DD HH:MM：{w['until']}")
+    return errors
+
+
+def load_config_file(path: str) -> dict:
+    """讀 JSON 覆寫檔、合併進原始預設（BASE_CONFIG）並檢查，回傳新的完整設定；有錯丟 ValueError。"""
+    override = load_json(path)
+    if not isinstance(override, dict):
+        raise ValueError("覆寫檔的最外層必須是 JSON 物件")
+    conf = merge_config(BASE_CONFIG, override)
+    errors = config_errors(conf)
+    if errors:
+        raise ValueError("；".join(errors))
+    return conf
+
+
+def apply_config(conf: dict) -> bool:
+    """
+    把熱載入的設定換進 CONFIG（原地更新，其他模組拿到的參照仍有效）。
+    browser 區段（瀏覽器池、proxy）與 watch 的 watchdog_sec / trace_sink 需重啟才會生效，維持原值；
+    SMTP 設定變了就關掉寄信執行緒，下次寄信時重建。
+    回傳查詢條件是否改變。
+    """
+    changed = changed_sections(CONFIG, conf)
+    if "browser" in changed:
+        log("browser 設定需重啟才會生效，本次沿用原設定")
+        conf["browser"] = CONFIG["browser"]
+        changed.remove("browser")
+    for key in RESTART_WATCH_KEYS:
+        if conf["watch"].get(key) != CONFIG["watch"].get(key):
+            log(f"watch.{key} 需重啟才會生效，本次沿用原設定")
+            conf["watch"][key] = CONFIG["watch"].get(key)
+    if conf["watch"] == CONFIG["watch"] and "watch" in changed:
+        changed.remove("watch")
+    old_search, old_notify = CONFIG["search"], CONFIG["notify"]
+    CONFIG.clear()
+    CONFIG.update(conf)
+    n = conf["notify"]
+    if any(old_notify.get(k) != n.get(k) for k in ("smtp", "mail_from", "retry_queue")):
+        close_notifier()
+    log(f"已重新載入設定：{', '.join(changed) or '無變更'}")
+    return any(old_search.get(k) != conf["search"].get(k) for k in SEARCH_KEYS)
+
+
+def validate_config():
+    """開瀏覽器前先檢查 CONFIG（有 THSRC_CONFIG 時先合併覆寫檔）；有錯直接結束（exit code 2），不寄信。"""
+    if CONFIG_FILE:
+        try:
+            conf = load_config_file(CONFIG_FILE)
+        except (OSError, ValueError) as e:
+            print("CONFIG 錯誤：", f"{CONFIG_FILE}：{e}")
+            raise SystemExit(2)
+        CONFIG.clear()
+        CONFIG.update(conf)
+    errors = config_errors(CONFIG)
+    if errors:
+        for e in errors:
+            print("CONFIG 錯誤：", e)
+        raise SystemExit(2)
 
 
 def main():
+    validate_config()
     br = CONFIG["browser"]
     proxies = load_proxies(br.get("proxies_file", ""))
-    proxy_idx = 0
 
     until = _until_dt()
     max_rounds = CONFIG["watch"].get("max_rounds")
 
-    round_no = 0
     start_ts = _now()
+    if CONFIG["notify"]["enabled"]:
+        _get_notifier()  # 先啟動背景寄信，重寄上次留下的失敗信
+    # 輪換代理時每個代理各留一個閒置 session；上限只有 1 的話每輪都會把上一個代理的瀏覽器關掉重開
+    pool = SessionPool(
+        max_sessions=len(proxies) or 1,
+        max_rounds=int(br.get("pool_max_rounds", 30)),
+        max_rss_mb=int(br.get("pool_max_rss_mb", 0)),
+    )
+    trace_sink = open_sink(CONFIG["watch"].get("trace_sink", ""))
+    dog = None
+    if float(CONFIG["watch"].get("watchdog_sec", 0)) > 0:
+        dog = Watchdog.for_pool(pool, stall_sec=float(CONFIG["watch"]["watchdog_sec"]), sink=trace_sink).start()
+    try:
+        _watch_loop(pool, trace_sink, proxies, until, max_rounds, start_ts)
+    finally:
+        if dog is not None:
+            dog.close()
+        pool.close()
+
+
+def _watch_settings():
+    """(policy, departure)：依目前的 CONFIG 計算，熱載入後重算。"""
+    w, s = CONFIG["watch"], CONFIG["search"]
+    policy = AdaptivePolicy(w.get("history_db", ""), backoff=float(w.get("backoff", 3.0))) if w.get("adaptive") else None
+    try:
+        departure = datetime.strptime(f"{s['date']} {s['time']}", "%Y-%m-%d %H:%M")
+    except ValueError:
+        departure = None
+    return policy, departure
+
 
+def _watch_loop(pool: SessionPool, trace_sink, proxies: list[str], until: Optional[datetime], max_rounds, start_ts: datetime):
+    proxy_idx = 0
+    round_no = 0
+    policy, departure = _watch_settings()
+    config = None
+    if CONFIG_FILE:
+        config = ConfigFile(CONFIG_FILE, load_config_file)
+        hup = install_sighup(config)
+        log(f"設定熱載入：{CONFIG_FILE}{'（或 kill -HUP ' + str(os.getpid()) + '）' if hup else ''}")
+    due = time.time()
     while True:
+        w, s = CONFIG["watch"], CONFIG["search"]
         round_no += 1
         if max_rounds is not None and round_no > max_rounds:
             subject = "已達最大回合，未找到票"
@@ -577,7 +796,8 @@ def main():
             proxy_idx += 1
 
         print(f"== Round {round_no} | proxy={proxy or '-'} ==")
-        ok, why, ticket_html = run_once(proxy)
+        trace = RoundTrace("auto_book", sink=trace_sink, round=round_no, proxy=proxy or "-")
+        ok, why, ticket_html = run_once(proxy, pool, trace)
         print(f"結果：{why}")
 
         if ok:
@@ -593,12 +813,30 @@ def main():
             send_email(subject, "".join(body))
             break
 
-        # 未命中 → 等待後重試
-        minv = int(CONFIG["watch"]["interval_min"])
-        maxv = int(CONFIG["watch"]["interval_max"])
-        wait_sec = random.randint(minv, maxv)
-        print(f"未命中，{wait_sec} 秒後再試...")
-        time.sleep(wait_sec)
+        # 未命中 → 等待後重試（固定速率：從本回合預定開始時間起算，回合耗時不累加）
+        minv = int(w["interval_min"])
+        maxv = int(w["interval_max"])
+        if policy is not None:
+            interval = policy.interval(minv, maxv, departure, s["discount_key"])
+        else:
+            interval = random.randint(minv, maxv)
+        due = next_deadline(due, interval)
+        wait_sec = max(0, due - time.time())
+        print(f"未命中，{wait_sec:.0f} 秒後再試...")
+        if config is None:
+            time.sleep(wait_sec)
+            continue
+        # 等待期間分段檢查覆寫檔；查詢條件變了就不再等，其餘設定從下一回合起生效
+        while time.time() < due:
+            time.sleep(min(RELOAD_POLL_SEC, max(0.0, due - time.time())))
+            conf = config.poll()
+            if conf is None:
+                continue
+            if apply_config(conf):
+                due = time.time()
+            policy, departure = _watch_settings()
+            until = _until_dt()
+            max_rounds = CONFIG["watch"].get("max_rounds")
 
 
 if __name__ == "__main__":
@@ -611,3 +849,5 @@ if __name__ == "__main__":
             send_email("程式異常終止", f"<pre>{tb}</pre>")
         except Exception:
             pass
+    finally:
+        close_notifier()
@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+# thsrc_browser.py
+# thsrc_async（查詢）/ thsrc_auto_book_v2（訂位）共用的瀏覽器工具。
+#
+# SessionPool：長駐的 browser/context 池，跨輪重複使用，省掉每輪冷啟動瀏覽器（訂位用；查詢的長駐引擎見 thsrc_async）。
+#   - 取用前做健康檢查（連線仍在、新分頁可執行 JS），失敗就丟掉重開
+#   - 用滿 N 輪、發生錯誤、存活超過上限或記憶體超過上限時自動回收
+#   - 記下每個 session 啟動的瀏覽器行程（pids），thsrc_watchdog 可以從別的執行緒強制結束卡住的那一個
+#
+# 用法：
+#   pool = SessionPool(max_rounds=30)
+#   with pool.session(key, factory) as sess:   # factory(playwright) -> (browser, context)
+#       sess.page.goto(...)
+#   pool.close()
+#
+# 注意：playwright.sync_api 的物件只能在建立它的執行緒使用，pool 也一樣。
+#
+# NetMeter：context 層級的資源過濾（page.route）與每輪流量統計。
+# ProfileDir：持久化的瀏覽器 profile（launch_persistent_context），讓靜態資源跨輪走磁碟快取。
+
+import hashlib
+import os
+import re
+import shutil
+import signal
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+def log(msg: str):
+    ts = datetime.now().strftime("%H:%M:%S")
+    print(f"[{ts}] {msg}")
+
+# -----------------------------
+# 行程資訊（記憶體上限用）
+# -----------------------------
+def descendant_pids(root_pid=None, recursive: bool = True):
+    """
+    回傳 root_pid（預設本 process）底下所有子孫 process 的 pid（recursive=False 只回傳直接子行程）；
+    有 psutil 用 psutil，否則讀 /proc（Windows 沒有 psutil 時回傳空 list）。
+    """
+    root_pid = root_pid or os.getpid()
+    try:
+        import psutil
+        return [c.pid for c in psutil.Process(root_pid).children(recursive=recursive)]
+    except ImportError:
+        pass
+    except Exception:
+        return []
+
+    proc = Path("/proc")
+    if not proc.is_dir():
+        return []
+    children = {}
+    for d in proc.iterdir():
+        if not d.name.isdigit():
+            continue
+        try:
+            stat = (d / "stat").read_text()
+            # 第 4 欄是 ppid；comm 可能含空白，所以從最後一個 ')' 之後切
+            ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        except Exception:
+            continue
+        children.setdefault(ppid, []).append(int(d.name))
+    if not recursive:
+        return children.get(root_pid, [])
+    out, stack = [], [root_pid]
+    while stack:
+        for c in children.get(stack.pop(), []):
+            out.append(c)
+            stack.append(c)
+    return out
+
+def process_rss_mb(pid: int) -> float:
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    except Exception:
+        return 0.0
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            for ln in f:
+                if ln.startswith("VmRSS:"):
+                    return int(ln.split()[1]) / 1024.0
+    except Exception:
+        pass
+    return 0.0
+
+def kill_pids(pids) -> list:
+    """強制結束 pids，回傳實際送出訊號的 pid（已經不在的略過）。"""
+    sig = getattr(signal, "SIGKILL", signal.SIGTERM)    # Windows 的 SIGTERM 即 TerminateProcess
+    killed = []
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+            killed.append(pid)
+        except OSError:
+            pass
+    return killed
+
+def browser_pids():
+    """本 process 底下的瀏覽器行程：Playwright driver（直接子行程）的子孫，不含 driver 本身。"""
+    return [pid for drv in descendant_pids(recursive=False) for pid in descendant_pids(drv)]
+
+def browser_tree_rss_mb() -> float:
+    """本 process 底下所有子行程（Playwright driver + 瀏覽器）的 RSS 總和（MB）；無法取得時為 0。"""
+    return sum(process_rss_mb(pid) for pid in descendant_pids())
+
+# -----------------------------
+# Session 池
+# -----------------------------
+class BrowserSession:
+    def __init__(self, key, browser, context):
+        self.key = key
+        self.browser = browser      # launch_persistent_context 時為 None
+        self.context = context
+        self.page = None
+        self.rounds = 0
+        self.created = time.time()
+        self.failed = False         # 使用端可標記本輪失敗，歸還時即回收
+        self.pids = []              # 啟動時新出現的瀏覽器行程（取不到時為空）
+
+    def process_tree(self):
+        """這個 session 的瀏覽器行程與其子行程（renderer、GPU…）。"""
+        return [q for pid in self.pids for q in (pid, *descendant_pids(pid))]
+
+    def open_page(self):
+        self.page = self.context.new_page()
+        return self.page
+
+    def healthy(self) -> bool:
+        """開一個新分頁並執行一段 JS；瀏覽器卡死或已斷線時會失敗。"""
+        try:
+            if self.browser is not None and not self.browser.is_connected():
+                return False
+            page = self.open_page()
+            return page.evaluate("() => 1 + 1") == 2
+        except Exception:
+            return False
+
+    def reset(self):
+        """歸還前清掉本輪的分頁與 cookie，讓下一輪從乾淨的訂票流程開始（HTTP cache 保留）。"""
+        for pg in list(self.context.pages):
+            try:
+                pg.close()
+            except Exception:
+                pass
+        self.page = None
+        self.context.clear_cookies()
+
+    def close(self):
+        try:
+            self.context.close()
+        except Exception:
+            pass
+        if self.browser is not None:
+            try:
+                self.browser.close()
+            except Exception:
+                pass
+
+class SessionPool:
+    def __init__(self, max_sessions=1, max_rounds=30, max_rss_mb=0, max_age_sec=0):
+        """
+        max_sessions: 同時存在的 session 上限（含閒置）
+        max_rounds  : 每個 session 最多用幾輪就回收；0 代表每輪都重開（等同不用池）
+        max_rss_mb  : 瀏覽器行程樹 RSS 超過此值時回收歸還中的 session；0 代表不檢查
+        max_age_sec : session 存活超過此秒數就回收；0 代表不限
+        """
+        self.max_sessions = max(1, max_sessions)
+        self.max_rounds = max_rounds
+        self.max_rss_mb = max_rss_mb
+        self.max_age_sec = max_age_sec
+        self._pw_cm = None
+        self._pw = None
+        self._idle = []
+        self._busy = []
+        self._invalid = False
+        self.launches = 0
+        self.recycles = 0
+
+    def _playwright(self):
+        if self._pw is None:
+            from playwright.sync_api import sync_playwright
+            self._pw_cm = sync_playwright()
+            self._pw = self._pw_cm.start()
+        return self._pw
+
+    def invalidate(self):
+        """Playwright driver 已被強制結束時呼叫（可從別的執行緒）：下次 acquire 整個池重開。"""
+        self._invalid = True
+
+    def busy_pids(self):
+        """使用中 session 的瀏覽器行程樹；thsrc_watchdog 從監看執行緒呼叫，只讀 pid 不碰 Playwright 物件。"""
+        return list(dict.fromkeys(pid for sess in list(self._busy) for pid in sess.process_tree()))
+
+    def acquire(self, key, factory) -> BrowserSession:
+        if self._invalid:
+            log("Playwright driver 已失效，整個瀏覽器池重開")
+            self.close()
+            self._invalid = False
+        # 先找同 key 的閒置 session，健康檢查通過才拿來用
+        for sess in [s for s in self._idle if s.key == key]:
+            self._idle.remove(sess)
+            if sess.healthy():
+                self._busy.append(sess)
+                return sess
+            log("瀏覽器 session 健康檢查失敗，回收重開")
+            self._discard(sess)
+
+        # 騰出空間：先關掉最舊的閒置 session（不同 key）
+        while self._idle and len(self._idle) + len(self._busy) >= self.max_sessions:
+            self._discard(self._idle.pop(0))
+        if len(self._busy) >= self.max_sessions:
+            raise RuntimeError(f"瀏覽器 session 已用完（上限 {self.max_sessions}）")
+
+        pw = self._playwright()
+        before = set(browser_pids())
+        browser, context = factory(pw)
+        self.launches += 1
+        sess = BrowserSession(key, browser, context)
+        sess.pids = [pid for pid in browser_pids() if pid not in before]
+        sess.open_page()
+        self._busy.append(sess)
+        return sess
+
+    def release(self, sess: BrowserSession, ok: bool = True):
+        if sess in self._busy:
+            self._busy.remove(sess)
+        sess.rounds += 1
+        why = self._recycle_reason(sess, ok)
+        if not why:
+            try:
+                sess.reset()
+            except Exception:
+                why = "重置失敗"
+        if why:
+            log(f"回收瀏覽器 session（{why}，已用 {sess.rounds} 輪）")
+            self._discard(sess)
+        else:
+            self._idle.append(sess)
+
+    def _recycle_reason(self, sess: BrowserSession, ok: bool) -> str:
+        if not ok or sess.failed:
+            return "本輪發生錯誤"
+        if sess.rounds >= self.max_rounds:
+            return "達到輪數上限"
+        if self.max_age_sec and time.time() - sess.created > self.max_age_sec:
+            return "達到存活時間上限"
+        if self.max_rss_mb:
+            rss = browser_tree_rss_mb()
+            if rss > self.max_rss_mb:
+                return f"記憶體 {rss:.0f}MB 超過上限 {self.max_rss_mb}MB"
+        return ""
+
+    def _discard(self, sess: BrowserSession):
+        self.recycles += 1
+        sess.close()
+
+    @contextmanager
+    def session(self, key, factory):
+        sess = self.acquire(key, factory)
+        ok = False
+        try:
+            yield sess
+            ok = True
+        finally:
+            self.release(sess, ok)
+
+    def close(self):
+        for sess in self._idle + self._busy:
+            sess.close()
+        self._idle, self._busy = [], []
+        if self._pw_cm is not None:
+            try:
+                self._pw_cm.__exit__(None, None, None)
+            except Exception:
+                pass
+        self._pw_cm = self._pw = None
+
+# -----------------------------
+# Step2 車次清單：一次 evaluate 取回全部欄位
+# -----------------------------
+STEP2_ROWS_SELECTOR = "#BookingS2Form_TrainQueryDataViewPanel .result-listing label.result-item"
+
+# 以前每列要 ~7 次 Playwright 往返（get_attribute ×5、all_inner_texts、is_checked…），
+# 這裡在頁面內一次把所有列整理好再回傳。
+STEP2_ROWS_JS = """(sel) => Array.from(document.querySelectorAll(sel)).map((row) => {
+    const radio = row.querySelector('input.uk-radio');
+    const attr = (name) => (radio && radio.getAttribute(name)) || '';
+    const spans = Array.from(row.querySelectorAll('.discount span'))
+        .map((s) => (s.innerText || '').trim())
+        .filter((t) => t);
+    const disc = row.querySelector('.discount');
+    return {
+        departure: attr('querydeparture'),
+        arrival: attr('queryarrival'),
+        estimated: attr('queryestimatedtime'),
+        code: attr('querycode'),
+        date: attr('querydeparturedate'),
+        discount_text: spans.join(' '),
+        discount_raw: disc ? (disc.innerText || '').trim() : '',
+        selected: !!(radio && radio.checked) || (row.getAttribute('class') || '').includes('active'),
+    };
+})"""
+
+def extract_step2_rows(page):
+    """
+    回傳 Step2 每一列的原始欄位（list[dict]，順序同畫面）：
+        departure, arrival, estimated, code, date, discount_text（.discount span 以空白串接）,
+        discount_raw（整個 .discount 的文字）, selected(bool)
+    """
+    return page.evaluate(STEP2_ROWS_JS, STEP2_ROWS_SELECTOR)
+
+# -----------------------------
+# 遮罩與 Step2 / 錯誤的事件式等待
+# -----------------------------
+# 在頁面內用 MutationObserver 等狀態成立，一成立就 resolve；逾時則回傳 'timeout'。
+# mode='mask'  → 'clear'：三種 loading 遮罩都已隱藏
+# mode='step2' → 'step2'：選擇車次區塊可見；'error'：#divErrMSG 可見
+PAGE_STATE_JS = """({mode, timeout}) => new Promise((resolve) => {
+    const hidden = (el) => !el || el.style.display === 'none' || getComputedStyle(el).display === 'none';
+    const visible = (el) => {
+        if (!el) return false;
+        const r = el.getBoundingClientRect();
+        return r.width > 0 && r.height > 0 && getComputedStyle(el).visibility !== 'hidden';
+    };
+    const check = () => {
+        if (mode === 'mask') {
+            return ['#divMaskFrame', '#loadingMask', '#BusyBoxDiv']
+                .every((s) => hidden(document.querySelector(s))) ? 'clear' : null;
+        }
+        if (visible(document.querySelector('#BookingS2Form_TrainQueryDataViewPanel'))) return 'step2';
+        if (visible(document.querySelector('#divErrMSG'))) return 'error';
+        return null;
+    };
+    const now = check();
+    if (now) return resolve(now);
+    let timer = null;
+    const obs = new MutationObserver(() => {
+        const st = check();
+        if (st) { obs.disconnect(); clearTimeout(timer); resolve(st); }
+    });
+    obs.observe(document.documentElement, {
+        subtree: true, childList: true, attributes: true, attributeFilter: ['style', 'class', 'hidden'],
+    });
+    timer = setTimeout(() => { obs.disconnect(); resolve(check() || 'timeout'); }, timeout);
+})"""
+
+def wait_page_state(page, mode: str, timeout_ms: int) -> str:
+    """
+    等待頁面狀態（見 PAGE_STATE_JS），回傳 'clear' / 'step2' / 'error' / 'timeout'。
+    等待途中若頁面導覽（execution context 被換掉），就在新頁面上用剩餘時間繼續等。
+    """
+    deadline = time.time() + timeout_ms / 1000.0
+    while True:
+        remaining = int((deadline - time.time()) * 1000)
+        if remaining <= 0:
+            return "timeout"
+        try:
+            return page.evaluate(PAGE_STATE_JS, {"mode": mode, "timeout": remaining})
+        except Exception:
+            time.sleep(0.1)
+
+def wait_mask_then_clear_if_stuck(page, hard_timeout_ms=16000):
+    """
+    等待 loading 遮罩消失；若超時則呼叫頁面現成的 hideMaskFrame() 嘗試解除。
+    """
+    if wait_page_state(page, "mask", hard_timeout_ms) == "clear":
+        return True
+
+    log("遮罩疑似卡住，嘗試呼叫 hideMaskFrame() 強制解除")
+    try:
+        page.evaluate("hideMaskFrame && hideMaskFrame();")
+    except Exception:
+        pass
+    # 再給它一點時間
+    return wait_page_state(page, "mask", 600) == "clear"
+
+def wait_step2_or_error(page, timeout_ms=15000):
+    """
+    等待「選擇車次」(Step2) 結果區塊，或錯誤區塊顯示。
+    回傳 'step2' / 'error' / 'none'
+    """
+    state = wait_page_state(page, "step2", timeout_ms)
+    return state if state in ("step2", "error") else "none"
+
+# -----------------------------
+# 資源過濾與流量統計
+# -----------------------------
+# 查詢只需要頁面本身、AJAX 與 script（表單邏輯）以及驗證碼圖片；圖片、字型、CSS、媒體與第三方追蹤一律擋掉。
+ALLOWED_RESOURCE_TYPES = {"document", "xhr", "fetch", "script"}
+# 驗證碼圖：官網是 #BookingS1Form_homeCaptcha_passCode 的 wicket resource（網址含 passCode），回放站為 captcha.png
+CAPTCHA_URL_RE = re.compile(r"passCode|captcha", re.I)
+TRACKER_URL_RE = re.compile(
+    r"google-analytics|googletagmanager|gtag|doubleclick|facebook\.(net|com)|hotjar|/analytics/", re.I)
+
+def resource_allowed(resource_type: str, url: str) -> bool:
+    if TRACKER_URL_RE.search(url):
+        return False
+    if resource_type in ALLOWED_RESOURCE_TYPES:
+        return True
+    return resource_type == "image" and bool(CAPTCHA_URL_RE.search(url))
+
+class NetMeter:
+    """
+    掛在 browser context 上：block=True 時依 resource_allowed 擋掉不需要的請求，
+    並累計回應數與流量，take() 取出並歸零，一輪取一次。
+    流量只讀回應 header 的 content-length（事件本身就帶著，不必為每個請求再向 driver 要 sizes()），
+    沒有長度的回應（chunked）不計，是估計值。只在 --block_resources 或量測（bench_rounds）時掛上。
+    """
+    def __init__(self, block: bool = False):
+        self.block = block
+        self._zero()
+
+    def _zero(self):
+        self.requests = 0
+        self.blocked = 0
+        self.bytes = 0
+
+    def take(self) -> dict:
+        out = {"net_requests": self.requests, "net_blocked": self.blocked, "net_kb": round(self.bytes / 1024, 1)}
+        self._zero()
+        return out
+
+    def _on_route(self, route):
+        req = route.request
+        if resource_allowed(req.resource_type, req.url):
+            route.continue_()
+        else:
+            self.blocked += 1
+            route.abort()
+
+    def _on_response(self, response):
+        self.requests += 1
+        try:
+            self.bytes += int(response.headers.get("content-length") or 0)
+        except (AttributeError, ValueError):
+            pass
+
+    def attach(self, context):
+        if self.block:
+            context.route("**/*", self._on_route)
+        context.on("response", self._on_response)
+        _meters[context] = self
+        return self
+
+_meters = weakref.WeakKeyDictionary()
+
+def net_meter(context_or_page):
+    """取回 attach 在該 context（或 page 所屬 context）上的 NetMeter；沒有則回傳 None。"""
+    ctx = getattr(context_or_page, "context", context_or_page)
+    try:
+        return _meters.get(ctx)
+    except TypeError:
+        return None
+
+# -----------------------------
+# 持久化 profile（磁碟快取）
+# -----------------------------
+class ProfileDir:
+    """
+    launch_persistent_context 用的 user-data-dir。靜態 JS / CSS 第二輪起直接從磁碟快取載入。
+    - 每個 slot 一個子目錄（同一個目錄同時只能給一個瀏覽器用）
+    - 啟動前檢查：目錄超過 max_mb，或距上次清空超過 wipe_hours，就整個刪掉重建
+    - Chromium 的快取上限另以 --disk-cache-size 限制在 max_mb
+    注意：context.route（NetMeter(block=True)）啟用時瀏覽器會停用 HTTP cache，兩者不宜同時開。
+    """
+    STAMP = ".thsrc_created"
+
+    def __init__(self, base: str, max_mb: int = 200, wipe_hours: float = 24):
+        self.base = Path(base)
+        self.max_mb = max_mb
+        self.wipe_hours = wipe_hours
+
+    @staticmethod
+    def slot_name(key) -> str:
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:10]
+
+    def size_mb(self, path: Path) -> float:
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total / (1024 * 1024)
+
+    def _wipe_reason(self, path: Path) -> str:
+        stamp = path / self.STAMP
+        if not stamp.exists():
+            return ""
+        if self.wipe_hours and time.time() - stamp.stat().st_mtime > self.wipe_hours * 3600:
+            return f"超過 {self.wipe_hours} 小時"
+        if self.max_mb:
+            mb = self.size_mb(path)
+            if mb > self.max_mb:
+                return f"大小 {mb:.0f}MB 超過上限 {self.max_mb}MB"
+        return ""
+
+    def prepare(self, slot: str) -> str:
+        """回傳 slot 的目錄路徑；需要時先清空。必須在該目錄沒有瀏覽器使用時呼叫。"""
+        path = self.base / slot
+        why = self._wipe_reason(path)
+        if why:
+            log(f"清空瀏覽器 profile {path}（{why}）")
+            shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True, exist_ok=True)
+        stamp = path / self.STAMP
+        if not stamp.exists():
+            stamp.touch()
+        return str(path)
+
+    def launch_args(self):
+        return [f"--disk-cache-size={self.max_mb * 1024 * 1024}"] if self.max_mb else []
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# thsrc_diff.py
+# 查詢結果的差異儲存：每輪的 Step2 清單與同一查詢上一輪比較，只記「區間」與「事件」，不再每輪追加整份清單。
+#
+# - 表 intervals：(查詢, 日期, 車次, 折扣文字) 從 first_seen 到 last_seen 持續出現的區間。
+#   仍在出現（open=1）的區間 last_seen 為 NULL，實際值 = queries.last_seen（該查詢最後一次成功的時間）；
+#   因此沒有變化的輪次只更新 queries 一列，寫入量隨「變化次數」而非輪詢頻率成長。
+# - 表 events：appeared / disappeared，自增 id 當游標；thsrc_watch 只讀 id 大於上一輪的事件。
+#
+# 用法：
+#   python thsrc_search_v2_plus.py ... --store diff:history_diff.db
+#   python thsrc_watch.py --scraper "..." --store diff:history_diff.db ...
+#   python thsrc_diff.py intervals history_diff.db --keyword 學生5折
+#
+# 需求：內建 sqlite3 即可，無需額外套件。
+
+import argparse
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+from thsrc_rows import TrainRow, as_row
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    query       TEXT PRIMARY KEY,
+    last_seen   TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS intervals (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    query         TEXT NOT NULL,
+    date          TEXT NOT NULL,
+    code          TEXT NOT NULL,
+    departure     TEXT,
+    arrival       TEXT,
+    estimated     TEXT,
+    discount_text TEXT NOT NULL DEFAULT '',
+    first_seen    TEXT NOT NULL,
+    last_seen     TEXT,
+    open          INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS ix_intervals_open ON intervals(query, open);
+CREATE TABLE IF NOT EXISTS events (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    interval_id  INTEGER NOT NULL REFERENCES intervals(id),
+    kind         TEXT NOT NULL,          -- appeared / disappeared
+    at           TEXT NOT NULL
+);
+"""
+
+def log(msg: str):
+    ts = datetime.now().strftime("%H:%M:%S")
+    print(f"[{ts}] {msg}")
+
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+def query_key(query) -> str:
+    """SearchQuery → 區分「同一個查詢」的字串（起訖站、日期、時段、張數）。"""
+    return f"{query.origin}|{query.dest}|{query.date}|{query.time}|{query.adult}|{query.student}"
+
+def interval_key(row: TrainRow):
+    return (row.mmdd, row.code, row.discount_text)
+
+@dataclass
+class Diff:
+    appeared: list          # list[TrainRow]
+    disappeared: list       # list[TrainRow]
+    unchanged: int
+
+    def __bool__(self):
+        return bool(self.appeared or self.disappeared)
+
+class DiffStore:
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def apply(self, query: str, rows, seen_at: str = None) -> Diff:
+        """
+        以本輪成功擷取到的 rows（TrainRow 或 dict）更新 query 的區間，回傳 Diff。
+        失敗或沒有結果的輪次不要呼叫：那不代表折扣消失了。
+        """
+        seen_at = seen_at or now_iso()
+        current = {}
+        for r in rows:
+            r = as_row(r)
+            current.setdefault(interval_key(r), r)
+        with self.conn:
+            prev = self.conn.execute("SELECT last_seen FROM queries WHERE query = ?", (query,)).fetchone()
+            open_rows = {
+                (r["date"], r["code"], r["discount_text"]): r
+                for r in self.conn.execute("SELECT * FROM intervals WHERE query = ? AND open = 1", (query,))
+            }
+            appeared = [r for k, r in current.items() if k not in open_rows]
+            gone = [r for k, r in open_rows.items() if k not in current]
+
+            for r in appeared:
+                d = r.to_dict()
+                cur = self.conn.execute(
+                    "INSERT INTO intervals (query, date, code, departure, arrival, estimated, discount_text, "
+                    "first_seen) VALUES (?,?,?,?,?,?,?,?)",
+                    (query, d["date"], d["code"], d["departure"], d["arrival"], d["estimated"],
+                     d["discount_text"], seen_at),
+                )
+                self.conn.execute("INSERT INTO events (interval_id, kind, at) VALUES (?, 'appeared', ?)",
+                                  (cur.lastrowid, seen_at))
+            if gone:
+                # 最後一次看到它是上一輪成功的時間
+                last = prev["last_seen"] if prev else seen_at
+                self.conn.executemany("UPDATE intervals SET open = 0, last_seen = ? WHERE id = ?",
+                                      [(last, r["id"]) for r in gone])
+                self.conn.executemany("INSERT INTO events (interval_id, kind, at) VALUES (?, 'disappeared', ?)",
+                                      [(r["id"], seen_at) for r in gone])
+            self.conn.execute(
+                "INSERT INTO queries (query, last_seen) VALUES (?, ?) "
+                "ON CONFLICT(query) DO UPDATE SET last_seen = excluded.last_seen",
+                (query, seen_at),
+            )
+        return Diff(appeared=appeared, disappeared=[TrainRow.from_dict(dict(r)) for r in gone],
+                    unchanged=len(current) - len(appeared))
+
+    def events_since(self, after_id: int, keyword: str = "", kind: str = ""):
+        """
+        回傳 (events, last_id)：id > after_id 的事件（dict，欄位同 CSV + kind、at、first_seen、interval_id），
+        只留 discount_text 含 keyword（與 kind 相符）的事件。last_id 是目前最大的事件 id，當下一輪的游標。
+        """
+        sql = ("SELECT e.id AS event_id, e.kind, e.at, i.* FROM events e JOIN intervals i ON i.id = e.interval_id "
+               "WHERE e.id > ? AND instr(i.discount_text, ?) > 0")
+        args = [after_id, keyword]
+        if kind:
+            sql += " AND e.kind = ?"
+            args.append(kind)
+        rows = [dict(r, interval_id=r["id"]) for r in self.conn.execute(sql + " ORDER BY e.id", args)]
+        last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        return rows, max(after_id, last_id)
+
+    def hits_since(self, after_id: int, keyword: str = ""):
+        """同 thsrc_store.SqliteStore.hits_since 的介面：只回傳新出現（appeared）的列。"""
+        return self.events_since(after_id, keyword, kind="appeared")
+
+    def intervals(self, keyword: str = "", query: str = ""):
+        """所有區間（open 的 last_seen 以該查詢最後一次成功的時間補上），依 first_seen 排序。"""
+        sql = ("SELECT i.*, COALESCE(i.last_seen, q.last_seen) AS seen_until FROM intervals i "
+               "LEFT JOIN queries q ON q.query = i.query WHERE instr(i.discount_text, ?) > 0")
+        args = [keyword]
+        if query:
+            sql += " AND i.query = ?"
+            args.append(query)
+        return [dict(r) for r in self.conn.execute(sql + " ORDER BY i.first_seen, i.id", args)]
+
+    def close(self):
+        self.conn.close()
+
+def main():
+    ap = argparse.ArgumentParser(description="THSR 查詢結果差異儲存工具")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    lst = sub.add_parser("intervals", help="列出折扣出現的區間")
+    lst.add_argument("db", help="差異儲存的 SQLite 檔（--store diff:PATH 的 PATH）")
+    lst.add_argument("--keyword", default="", help="只列出折扣文字含此關鍵字的區間")
+    ev = sub.add_parser("events", help="列出 appeared / disappeared 事件")
+    ev.add_argument("db")
+    ev.add_argument("--keyword", default="")
+    ev.add_argument("--after", type=int, default=0, help="只列出 id 大於此值的事件")
+    args = ap.parse_args()
+
+    store = DiffStore(args.db)
+    try:
+        if args.cmd == "intervals":
+            for r in store.intervals(args.keyword):
+                state = "持續中" if r["open"] else "已消失"
+                print(f"{r['date']} 車次 {r['code']:>5} {r['departure']} {r['discount_text']:<16} "
+                      f"{r['first_seen']} → {r['seen_until']}  {state}  [{r['query']}]")
+        else:
+            events, _ = store.events_since(args.after, args.keyword)
+            for e in events:
+                kind = "出現" if e["kind"] == "appeared" else "消失"
+                print(f"#{e['event_id']} {e['at']} {kind} {e['date']} 車次 {e['code']} {e['departure']} "
+                      f"{e['discount_text']}  [{e['query']}]")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
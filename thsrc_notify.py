@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+# thsrc_notify.py
+# 通知信寄送元件（thsrc_watch / thsrc_auto_book_v2 共用）：
+#   - SmtpConnection：跨封信保持同一條 SMTP 連線（寄前以 NOOP 檢查，斷線就重連），不再每封都重做 TLS 與登入
+#   - Notifier：短時間內的多筆通知合併成一封摘要信（digest_sec 內同一收件者的信合併）
+#   - RetryQueue：寄送失敗的信存到 JSON Lines 檔，之後依退避時間重寄，程式重啟也不會遺失
+#   - NotifyWorker：在背景執行緒寄信（有上限的佇列），主迴圈不必等 SMTP
+#
+# 用法：
+#   conn = SmtpConnection(SmtpConfig("smtp.gmail.com", 587, "me@gmail.com", "app-password"))
+#   notifier = Notifier(conn, "me@gmail.com", retry_path=".state/mail_queue.jsonl", digest_sec=120,
+#                       on_sent=lambda keys: notified.add_many(keys))
+#   notifier.notify("you@example.com", "主旨", html, text, keys=[...])
+#   notifier.poll()      # 主迴圈定期呼叫：寄出到期的摘要、重寄到期的失敗信
+#   notifier.close()     # 結束前把還在等待合併的信寄出
+#
+#   背景寄送：worker = NotifyWorker(notifier)；worker.notify(...) 只排入佇列，
+#   主迴圈定期 notified.add_many(worker.drain()) 取回確定寄出的 key，結束時 worker.close()。
+#
+# 本機測試可接 aiosmtpd 之類的 SMTP 替身（不加密、不登入）：
+#   python -m aiosmtpd -n -l localhost:8025
+#   SmtpConfig("localhost", 8025, starttls=False)
+#
+# 需求：只用標準函式庫。
+
+import json
+import os
+import queue
+import re
+import smtplib
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from email.message import EmailMessage
+from pathlib import Path
+
+def log(msg: str):
+    ts = datetime.now().strftime("%H:%M:%S")
+    print(f"[{ts}] {msg}")
+
+# -----------------------------
+# 連線
+# -----------------------------
+@dataclass
+class SmtpConfig:
+    host: str = "smtp.gmail.com"
+    port: int = 587
+    username: str = ""          # 空字串則不登入
+    password: str = ""
+    starttls: bool = True
+    timeout: float = 20
+
+class SmtpConnection:
+    """
+    保持一條 SMTP 連線跨封信使用。寄信前若連線已閒置超過 idle_sec 或 NOOP 失敗就重連；
+    寄送途中斷線會重連再試一次。
+    """
+    def __init__(self, cfg: SmtpConfig, idle_sec: float = 120):
+        self.cfg = cfg
+        self.idle_sec = idle_sec
+        self.smtp = None
+        self.last_used = 0.0
+        self.connects = 0
+
+    def _connect(self):
+        cfg = self.cfg
+        smtp = smtplib.SMTP(cfg.host, cfg.port, timeout=cfg.timeout)
+        try:
+            smtp.ehlo()
+            if cfg.starttls:
+                smtp.starttls()
+                smtp.ehlo()
+            if cfg.username:
+                smtp.login(cfg.username, cfg.password)
+        except Exception:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.connects += 1
+
+    def _alive(self) -> bool:
+        if self.smtp is None or time.time() - self.last_used > self.idle_sec:
+            return False
+        try:
+            return self.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send(self, msg: EmailMessage):
+        if not self._alive():
+            self.close()
+            self._connect()
+        try:
+            self.smtp.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.close()
+            self._connect()
+            self.smtp.send_message(msg)
+        self.last_used = time.time()
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                try:
+                    self.smtp.close()
+                except Exception:
+                    pass
+            self.smtp = None
+
+# -----------------------------
+# 信件與重寄佇列
+# -----------------------------
+@dataclass
+class Mail:
+    to: list
+    subject: str
+    html: str
+    text: str = ""
+    keys: list = field(default_factory=list)    # 寄出成功後要回報的去重 key（例如 thsrc_watch.make_key）
+    created: float = field(default_factory=time.time)
+    attempts: int = 0
+    next_try: float = 0.0
+
+    def to_message(self, sender: str) -> EmailMessage:
+        msg = EmailMessage()
+        msg["From"] = sender
+        msg["To"] = ", ".join(self.to)
+        msg["Subject"] = self.subject
+        # 純文字 & HTML 兩種都放，增加相容性
+        msg.set_content(self.text or "See HTML content.")
+        msg.add_alternative(self.html, subtype="html")
+        return msg
+
+class RetryQueue:
+    """
+    寄送失敗的信，一行一封（JSON Lines）。每次變動都原子地改寫整個檔（佇列很短）。
+    重寄間隔依失敗次數退避：base_sec * 2^(attempts-1)，上限 max_sec。
+    on_drop(mail)：失敗達 max_attempts 次放棄時呼叫（讓呼叫端釋放該信的去重 key）。
+    """
+    def __init__(self, path: str, base_sec: float = 60, max_sec: float = 3600, max_attempts: int = 20,
+                 on_drop=None):
+        self.path = path
+        self.base_sec = base_sec
+        self.max_sec = max_sec
+        self.max_attempts = max_attempts
+        self.on_drop = on_drop
+        self.items = []
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        self.items.append(Mail(**json.loads(line)))
+                    except (ValueError, TypeError):
+                        log(f"略過無法解析的重寄項目：{line[:80]}")
+
+    def __len__(self):
+        return len(self.items)
+
+    def _save(self):
+        if not self.path:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for m in self.items:
+                f.write(json.dumps(asdict(m), ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+
+    def _backoff(self, mail: Mail, now: float):
+        mail.next_try = now + min(self.max_sec, self.base_sec * 2 ** (mail.attempts - 1))
+
+    def _drop(self, mail: Mail):
+        log(f"放棄重寄：{mail.subject}（已失敗 {mail.attempts} 次）")
+        if self.on_drop is not None:
+            self.on_drop(mail)
+
+    def push(self, mail: Mail):
+        """第一次寄送失敗的信排入佇列。"""
+        mail.attempts += 1
+        if mail.attempts >= self.max_attempts:
+            self._drop(mail)
+            return
+        self._backoff(mail, time.time())
+        self.items.append(mail)
+        self._save()
+
+    def pop_due(self, now: float = None):
+        """
+        取出到期要重寄的信。信不會先從檔案移除：先把這次嘗試算進 attempts、寫好下一次重寄時間再交給呼叫端，
+        寄送途中程式當掉，信仍在檔案裡，重啟後照退避時間重寄。寄出後呼叫 done(mail)，失敗呼叫 fail(mail)。
+        """
+        now = time.time() if now is None else now
+        due = [m for m in self.items if m.next_try <= now]
+        if due:
+            for m in due:
+                m.attempts += 1
+                self._backoff(m, now)
+            self._save()
+        return due
+
+    def done(self, mail: Mail):
+        """pop_due 取出的信已寄出，從佇列移除。"""
+        self.items = [m for m in self.items if m is not mail]
+        self._save()
+
+    def fail(self, mail: Mail):
+        """pop_due 取出的信又寄送失敗；下一次重寄時間已寫好，只需處理次數用完的情形。"""
+        if mail.attempts >= self.max_attempts:
+            self.items = [m for m in self.items if m is not mail]
+            self._save()
+            self._drop(mail)
+
+    def pending_keys(self):
+        return {k for m in self.items for k in m.keys}
+
+# -----------------------------
+# 通知器
+# -----------------------------
+_BODY_RE = re.compile(r"<body[^>]*>(.*?)</body>", re.S | re.I)
+
+def _html_body(html: str) -> str:
+    m = _BODY_RE.search(html)
+    return m.group(1) if m else html
+
+def make_digest(mails) -> Mail:
+    """同一收件者的多封信合併成一封摘要；只有一封時原樣回傳。"""
+    if len(mails) == 1:
+        return mails[0]
+    subject = f"[THSR] {len(mails)} 則通知：" + "；".join(m.subject for m in mails[:3]) + ("…" if len(mails) > 3 else "")
+    html = "<html><body>" + "<hr>".join(f"<h4>{m.subject}</h4>{_html_body(m.html)}" for m in mails) + "</body></html>"
+    text = "\n\n".join(f"{m.subject}\n{m.text}" for m in mails)
+    keys = [k for m in mails for k in m.keys]
+    return Mail(to=mails[0].to, subject=subject, html=html, text=text, keys=keys, created=mails[0].created)
+
+class Notifier:
+    """
+    digest_sec：同一收件者在這段時間內的通知合併成一封（0 = 立即寄出）。
+    on_sent(keys)：信確定寄出後呼叫，用來更新已通知記錄；失敗的信進 RetryQueue，之後重寄成功才回報。
+    on_drop(keys)：信重寄次數用完被放棄時呼叫，這些 key 不會再寄，呼叫端可以下一輪重新排入。
+    """
+    def __init__(self, conn: SmtpConnection, sender: str, retry_path: str = "", digest_sec: float = 0,
+                 on_sent=None, on_drop=None):
+        self.conn = conn
+        self.sender = sender
+        self.digest_sec = digest_sec
+        self.on_sent = on_sent
+        self.on_drop = on_drop
+        self.retry = RetryQueue(retry_path, on_drop=self._dropped)
+        self.pending = {}       # 收件者 → [Mail]（等待合併）
+        self.sent = 0
+        self.failed = 0
+
+    def pending_keys(self):
+        """還沒確定寄出（等待合併或等待重寄）的 key，呼叫端用來避免同一筆重複排入。"""
+        keys = self.retry.pending_keys()
+        for mails in self.pending.values():
+            for m in mails:
+                keys.update(m.keys)
+        return keys
+
+    def _dropped(self, mail: Mail):
+        if self.on_drop and mail.keys:
+            self.on_drop(mail.keys)
+
+    def notify(self, to, subject: str, html: str, text: str = "", keys=()):
+        to = [to] if isinstance(to, str) else list(to)
+        mail = Mail(to=to, subject=subject, html=html, text=text, keys=list(keys))
+        self.pending.setdefault(", ".join(to), []).append(mail)
+        if not self.digest_sec:
+            self.flush()
+        return True
+
+    def _deliver(self, mail: Mail, retrying: bool = False) -> bool:
+        """retrying=True 表示 mail 是 retry.pop_due() 取出的（仍在重寄佇列裡）。"""
+        try:
+            self.conn.send(mail.to_message(self.sender))
+        except Exception as e:
+            self.failed += 1
+            log(f"寄信失敗（{e}），已排入重寄佇列：{mail.subject}")
+            if retrying:
+                self.retry.fail(mail)
+            else:
+                self.retry.push(mail)
+            return False
+        if retrying:
+            self.retry.done(mail)
+        self.sent += 1
+        log(f"已寄出通知信：{mail.subject}")
+        if self.on_sent and mail.keys:
+            self.on_sent(mail.keys)
+        return True
+
+    def flush(self, force: bool = True) -> int:
+        """寄出等待合併的信；force=False 時只寄已等滿 digest_sec 的收件者。回傳寄出封數。"""
+        now = time.time()
+        n = 0
+        for to, mails in list(self.pending.items()):
+            if not force and now - mails[0].created < self.digest_sec:
+                continue
+            del self.pending[to]
+            n += self._deliver(make_digest(mails))
+        return n
+
+    def poll(self) -> int:
+        """寄出到期的摘要並重寄到期的失敗信。回傳寄出封數。"""
+        n = self.flush(force=False)
+        for mail in self.retry.pop_due():
+            n += self._deliver(mail, retrying=True)
+        return n
+
+    def next_due(self) -> float:
+        """下一次 poll 有事可做的時間（epoch 秒）；沒有待辦時回傳 inf。"""
+        times = [mails[0].created + self.digest_sec for mails in self.pending.values()]
+        times += [m.next_try for m in self.retry.items]
+        return min(times, default=float("inf"))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+# -----------------------------
+# 背景寄送
+# -----------------------------
+_STOP = object()
+
+class NotifyWorker:
+    """
+    在背景執行緒寄信，主迴圈只負責排入，不會被 SMTP 延遲拖慢。介面同 Notifier（notify / pending_keys）。
+    - 佇列有上限（maxsize）；滿了等 put_timeout 秒仍排不進去就回傳 False，由呼叫端下一輪再試
+    - Notifier 與其 SMTP 連線只在背景執行緒使用
+    - 確定寄出的 key 累積起來，由主執行緒呼叫 drain() 取回後自行更新已通知記錄
+    - 被放棄（重寄次數用完、寄送途中出錯而沒進任何佇列）的 key 從 pending_keys 移除，下一輪可以重新排入
+    - close() 把佇列與等待合併的信寄完才結束
+    """
+    def __init__(self, notifier: Notifier, maxsize: int = 100, put_timeout: float = 5):
+        self.notifier = notifier
+        self.notifier.on_sent = self._confirm
+        self.notifier.on_drop = self._forget
+        self.put_timeout = put_timeout
+        self.q = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._inflight = set(notifier.pending_keys())
+        self._confirmed = []
+        self._thread = threading.Thread(target=self._run, name="notify-worker", daemon=True)
+        self._thread.start()
+
+    def _confirm(self, keys):
+        with self._lock:
+            self._confirmed.extend(keys)
+            self._inflight.difference_update(keys)
+
+    def _forget(self, keys):
+        with self._lock:
+            self._inflight.difference_update(keys)
+
+    def pending_keys(self):
+        with self._lock:
+            return set(self._inflight)
+
+    def drain(self):
+        """取回上次呼叫以來確定寄出的 key。"""
+        with self._lock:
+            keys, self._confirmed = self._confirmed, []
+        return keys
+
+    def notify(self, to, subject: str, html: str, text: str = "", keys=()) -> bool:
+        keys = list(keys)
+        with self._lock:
+            self._inflight.update(keys)
+        try:
+            self.q.put(dict(to=to, subject=subject, html=html, text=text, keys=keys), timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self._forget(keys)
+            log(f"通知佇列已滿（{self.q.maxsize}），略過：{subject}")
+            return False
+
+    def _run(self):
+        while True:
+            wait = min(1.0, max(0.05, self.notifier.next_due() - time.time()))
+            try:
+                item = self.q.get(timeout=wait)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            try:
+                if item is not None:
+                    self.notifier.notify(**item)
+                self.notifier.poll()
+            except Exception as e:
+                log(f"背景寄信發生例外：{e}")
+                if item is not None:
+                    # 這封信若沒進等待合併或重寄佇列就不會再寄了，釋放它的 key
+                    pending = self.notifier.pending_keys()
+                    self._forget([k for k in item["keys"] if k not in pending])
+        try:
+            self.notifier.close()
+        except Exception as e:
+            log(f"結束前寄信失敗：{e}")
+
+    def close(self, timeout: float = 60):
+        """寄完佇列中與等待合併的信後結束背景執行緒（最多等 timeout 秒）。"""
+        if not self._thread.is_alive():
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            self.q.put(_STOP, timeout=timeout)
+        except queue.Full:
+            log("背景寄信逾時未結束（佇列仍滿），剩餘的信可能未寄出")
+            return
+        self._thread.join(max(0.0, deadline - time.monotonic()))
+        if self._thread.is_alive():
+            log("背景寄信逾時未結束，剩餘的信可能未寄出")
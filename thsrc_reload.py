@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# thsrc_reload.py
+# 設定檔熱載入：長時間監看時改路線、規則或收件者不必重啟（瀏覽器 session、排程進度、已通知紀錄都保留）。
+#
+# - ConfigFile：每次 poll() 只做一次 os.stat；mtime 或大小變了（或收到 SIGHUP）才重新讀檔。
+#   讀檔或驗證失敗（編輯到一半、JSON 寫錯）只記錄錯誤並沿用目前設定，下次存檔再試。
+# - install_sighup()：`kill -HUP <pid>` 立即要求重新載入；Windows 沒有 SIGHUP，只靠 mtime。
+# - merge_config()：把 JSON 覆寫檔遞迴合併進預設設定（thsrc_auto_book_v2 的 CONFIG）。
+#
+# 實際怎麼套用新設定由呼叫端決定：
+#   thsrc_watch.py --queries  只重排有變更的查詢（thsrc_scheduler.reload_groups）
+#   thsrc_auto_book_v2.py     環境變數 THSRC_CONFIG 指向 JSON 覆寫檔，每回合之間套用
+#
+# 需求：只用標準函式庫。
+
+import copy
+import json
+import os
+import signal
+import threading
+from datetime import datetime
+
+def log(msg: str):
+    ts = datetime.now().strftime("%H:%M:%S")
+    print(f"[{ts}] {msg}")
+
+def load_json(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class ConfigFile:
+    """
+    loader(path) 讀檔並驗證，回傳新設定；格式錯誤請丟 ValueError（json.JSONDecodeError 也是 ValueError）。
+    poll() 在檔案有變更或收到 SIGHUP 時回傳新設定，其餘情況（含載入失敗）回傳 None。
+    """
+    def __init__(self, path: str, loader=load_json):
+        self.path = path
+        self.loader = loader
+        self.reloads = 0
+        self.failures = 0
+        self._stamp = self._stat()
+        self._requested = threading.Event()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def request(self):
+        """要求下一次 poll() 無論 mtime 是否改變都重新載入（SIGHUP handler 呼叫）。"""
+        self._requested.set()
+
+    def poll(self):
+        stamp = self._stat()
+        if not self._requested.is_set() and stamp == self._stamp:
+            return None
+        self._requested.clear()
+        self._stamp = stamp
+        if stamp is None:
+            log(f"找不到 {self.path}，沿用目前設定")
+            self.failures += 1
+            return None
+        try:
+            conf = self.loader(self.path)
+        except (OSError, ValueError) as e:
+            log(f"重新載入 {self.path} 失敗，沿用目前設定：{e}")
+            self.failures += 1
+            return None
+        self.reloads += 1
+        return conf
+
+def install_sighup(*files: ConfigFile) -> bool:
+    """SIGHUP → 各 ConfigFile.request()。沒有 SIGHUP（Windows）或不在主執行緒時回傳 False。"""
+    if not hasattr(signal, "SIGHUP") or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signal.SIGHUP, lambda signum, frame: [f.request() for f in files])
+    return True
+
+def merge_config(base: dict, override: dict) -> dict:
+    """回傳 base 的深複本，override 的 dict 遞迴合併、其他值直接覆寫；base 沒有的鍵丟 ValueError（多半是打錯字）。"""
+    out = copy.deepcopy(base)
+    for key, value in override.items():
+        if key not in out:
+            raise ValueError(f"未知的設定項目：{key}")
+        if isinstance(out[key], dict) and isinstance(value, dict):
+            out[key] = merge_config(out[key], value)
+        else:
+            out[key] = value
+    return out
+
+def changed_sections(old: dict, new: dict):
+    """兩份設定中有差異的頂層鍵。"""
+    return sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# thsrc_replay_server.py
+# irs.thsrc.com.tw 訂票頁的離線回放站：用 fixtures/ 下的存檔頁面模擬 Step1 → Step2 → Step3，
+# 讓 thsrc_search_v2_plus / thsrc_auto_book_v2 不連官網也能跑、量效能、做回歸測試。
+#
+# 情境（網址參數 ?scenario=，或 --scenario 指定預設值）：
+#   step2      : 送出後顯示 Step2 車次清單（fixtures/step2.html）
+#   error      : 前 --error-times 次送出回「驗證碼錯誤」（#divErrMSG），之後才出 Step2
+#   consent    : 首頁先蓋一層「我同意」Cookie 對話框，其餘同 step2
+#   stuck_mask : 結果已出現，但 #divMaskFrame 不會自己消失，要呼叫 hideMaskFrame() 才解除
+#
+# 執行例:
+#   python thsrc_replay_server.py --port 8765 --submit-delay 800
+#   THSRC_URL="http://127.0.0.1:8765/IMINT/?scenario=error" python thsrc_search_v2_plus.py ...
+#   python thsrc_search_v2_plus.py ... --url "http://127.0.0.1:8765/IMINT/?scenario=stuck_mask"
+#
+# 需求：只用標準函式庫。
+
+import argparse
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES = Path(__file__).with_name("fixtures")
+SCENARIOS = ("step2", "error", "consent", "stuck_mask")
+
+def log(msg: str):
+    ts = datetime.now().strftime("%H:%M:%S")
+    print(f"[{ts}] {msg}")
+
+# -----------------------------
+# 驗證碼圖片（5x7 點陣數字 → PNG，不需 PIL）
+# -----------------------------
+DIGITS = {
+    "0": ["01110", "10001", "10011", "10101", "11001", "10001", "01110"],
+    "1": ["00100", "01100", "00100", "00100", "00100", "00100", "01110"],
+    "2": ["01110", "10001", "00001", "00010", "00100", "01000", "11111"],
+    "3": ["11110", "00001", "00001", "01110", "00001", "00001", "11110"],
+    "4": ["00010", "00110", "01010", "10010", "11111", "00010", "00010"],
+    "5": ["11111", "10000", "11110", "00001", "00001", "10001", "01110"],
+    "6": ["00110", "01000", "10000", "11110", "10001", "10001", "01110"],
+    "7": ["11111", "00001", "00010", "00100", "01000", "01000", "01000"],
+    "8": ["01110", "10001", "10001", "01110", "10001", "10001", "01110"],
+    "9": ["01110", "10001", "10001", "01111", "00001", "00010", "01100"],
+}
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+def captcha_png(text: str, scale: int = 4, pad: int = 6) -> bytes:
+    """把數字畫成黑字白底的灰階 PNG。"""
+    cols = len(text) * 6 - 1
+    w, h = cols * scale + pad * 2, 7 * scale + pad * 2
+    pixels = [[255] * w for _ in range(h)]
+    for i, ch in enumerate(text):
+        for y, line in enumerate(DIGITS[ch]):
+            for x, bit in enumerate(line):
+                if bit == "1":
+                    for dy in range(scale):
+                        for dx in range(scale):
+                            pixels[pad + y * scale + dy][pad + (i * 6 + x) * scale + dx] = 0
+    raw = b"".join(b"\x00" + bytes(row) for row in pixels)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 0, 0, 0, 0))
+        + _png_chunk(b"IDAT", zlib.compress(raw, 9))
+        + _png_chunk(b"IEND", b"")
+    )
+
+# -----------------------------
+# 頁面內容
+# -----------------------------
+def load_pages():
+    step1 = (FIXTURES / "step1.html").read_text(encoding="utf-8")
+    step2_full = (FIXTURES / "step2.html").read_text(encoding="utf-8")
+    m = re.search(r'<form id="BookingS2Form".*?</form>', step2_full, re.S)
+    step2 = m.group(0) if m else step2_full
+    step3 = (FIXTURES / "step3.html").read_text(encoding="utf-8")
+    return step1, step2, step3
+
+ERROR_FRAGMENT = "<ul><li>檢測碼輸入錯誤，請確認後重新輸入，謝謝！</li></ul>"
+
+# 靜態資源與第三方追蹤（給 resource filter / 快取比較用），內容是填充字元
+ASSETS = {
+    "/IMINT/assets/uikit.min.css": ("text/css", "/* uikit */\n"),
+    "/IMINT/assets/booking.css": ("text/css", "/* booking */\n"),
+    "/IMINT/assets/jquery.min.js": ("application/javascript", "/* jquery */\n"),
+    "/IMINT/assets/booking.js": ("application/javascript", "/* booking */\n"),
+    "/IMINT/assets/logo.png": ("image/png", None),
+    "/analytics/gtag.js": ("application/javascript", "/* analytics */\n"),
+}
+
+class ReplayConfig:
+    def __init__(self, scenario="step2", page_delay_ms=0, submit_delay_ms=500,
+                 asset_delay_ms=0, asset_kb=64, error_times=1):
+        self.scenario = scenario
+        self.page_delay_ms = page_delay_ms
+        self.submit_delay_ms = submit_delay_ms
+        self.asset_delay_ms = asset_delay_ms
+        self.asset_kb = asset_kb
+        self.error_times = error_times
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    server_version = "THSRReplay/1.0"
+
+    # server 物件上帶 cfg / pages / submits / lock
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, ctype: str, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _scenario(self, qs) -> str:
+        sc = (qs.get("scenario") or [self.server.cfg.scenario])[0]
+        return sc if sc in SCENARIOS else "step2"
+
+    def _sid(self) -> str:
+        m = re.search(r"replay_sid=([0-9a-f]+)", self.headers.get("Cookie", ""))
+        return m.group(1) if m else ""
+
+    @staticmethod
+    def _sleep(ms: int):
+        if ms:
+            time.sleep(ms / 1000.0)
+
+    def do_GET(self):
+        cfg = self.server.cfg
+        u = urlparse(self.path)
+        qs = parse_qs(u.query)
+
+        if u.path in ASSETS:
+            self._sleep(cfg.asset_delay_ms)
+            ctype, head = ASSETS[u.path]
+            body = captcha_png("0000", scale=8) if head is None else (head + "/*" + "x" * (cfg.asset_kb * 1024) + "*/\n").encode()
+            etag = f'"{zlib.crc32(body):08x}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            return self._send(200, body, ctype, {"Cache-Control": "public, max-age=86400", "ETag": etag})
+
+        if u.path == "/IMINT/captcha.png":
+            code = "".join(random.choice("0123456789") for _ in range(4))
+            return self._send(200, captcha_png(code), "image/png", {"Cache-Control": "no-store"})
+
+        if u.path in ("/IMINT", "/IMINT/"):
+            self._sleep(cfg.page_delay_ms)
+            scenario = self._scenario(qs)
+            step1 = self.server.pages[0]
+            html = (step1.replace("{{SCENARIO}}", scenario)
+                         .replace("{{CONSENT_STYLE}}", "" if scenario == "consent" else "display: none;"))
+            sid = self._sid() or uuid.uuid4().hex
+            return self._send(200, html.encode("utf-8"), "text/html; charset=utf-8",
+                              {"Set-Cookie": f"replay_sid={sid}; Path=/", "Cache-Control": "no-store"})
+
+        self._send(404, b"not found", "text/plain")
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        cfg = self.server.cfg
+        u = urlparse(self.path)
+        qs = parse_qs(u.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        if u.path == "/IMINT/step2":
+            self._sleep(cfg.submit_delay_ms)
+            scenario = self._scenario(qs)
+            with self.server.lock:
+                n = self.server.submits.get(self._sid(), 0)
+                self.server.submits[self._sid()] = n + 1
+            if scenario == "error" and n < cfg.error_times:
+                return self._send(409, ERROR_FRAGMENT.encode("utf-8"), "text/html; charset=utf-8")
+            return self._send(200, self.server.pages[1].encode("utf-8"), "text/html; charset=utf-8")
+
+        if "BookingS2Form" in u.query:
+            self._sleep(cfg.page_delay_ms)
+            return self._send(200, self.server.pages[2].encode("utf-8"), "text/html; charset=utf-8")
+
+        self._send(404, b"not found", "text/plain")
+
+def make_server(host="127.0.0.1", port=8765, cfg: ReplayConfig = None) -> ThreadingHTTPServer:
+    srv = ThreadingHTTPServer((host, port), ReplayHandler)
+    srv.daemon_threads = True
+    srv.cfg = cfg or ReplayConfig()
+    srv.pages = load_pages()
+    srv.submits = {}
+    srv.lock = threading.Lock()
+    return srv
+
+def serve_in_background(cfg: ReplayConfig = None, host="127.0.0.1", port=0):
+    """在背景執行緒啟動回放站（port=0 表示隨機可用埠），回傳 (server, base_url)。用完呼叫 server.shutdown()。"""
+    srv = make_server(host, port, cfg)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://{host}:{srv.server_address[1]}/IMINT/"
+
+def main():
+    ap = argparse.ArgumentParser(description="THSR 訂票頁離線回放站")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--scenario", choices=SCENARIOS, default="step2", help="網址未帶 ?scenario= 時的預設情境")
+    ap.add_argument("--page-delay", type=int, default=0, help="首頁 / Step3 回應延遲（毫秒）")
+    ap.add_argument("--submit-delay", type=int, default=500, help="送出查詢到回應的延遲（毫秒）")
+    ap.add_argument("--asset-delay", type=int, default=0, help="靜態資源回應延遲（毫秒）")
+    ap.add_argument("--asset-kb", type=int, default=64, help="每個靜態資源的大小（KB）")
+    ap.add_argument("--error-times", type=int, default=1, help="error 情境下前幾次送出回錯誤")
+    args = ap.parse_args()
+
+    cfg = ReplayConfig(args.scenario, args.page_delay, args.submit_delay,
+                       args.asset_delay, args.asset_kb, args.error_times)
+    srv = make_server(args.host, args.port, cfg)
+    log(f"回放站啟動：http://{args.host}:{srv.server_address[1]}/IMINT/?scenario={args.scenario}（Ctrl+C 停止）")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        log("停止。")
+    finally:
+        srv.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# thsrc_rows.py
+# Step2 車次列的型別化表示：TrainRow（NamedTuple，無 __dict__，一列只佔一個 tuple）。
+# 時間一律存成整數，比較與排序不必每次重新解析字串：
+#   departure / arrival：當天 00:00 起算的分鐘數（'15:11' → 911）
+#   duration：車程分鐘數（'1:04' → 64）
+#   date：完整乘車日期（Step2 只給 'MM/DD'，依今天推回年份，見 infer_travel_date）
+#   discount_rate：折扣文字中最低的折數，以百分比表示（'早鳥9折 學生75折' → 75；沒有折扣 → 100）
+#   discounts：折扣文字解析成 (類別, 折數) 的 tuple（'早鳥9折 學生75折' → (('early', 90), ('student', 75))）
+#
+# CSV、SQLite 與已通知 key 的格式不變：to_dict() 轉回原本的字串欄位，key() 同 thsrc_watch.make_key。
+#
+# 需求：只用標準函式庫。
+
+import re
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import NamedTuple
+
+FIELDS = ["date", "code", "departure", "arrival", "estimated", "student_discount", "discount_text", "selected"]
+
+_DISCOUNT_RE = re.compile(r"([^\d\s.]*?)\s*(\d{1,2}(?:\.\d)?)\s*折")
+
+# 折扣類別的標準名稱（網站偶爾會出現相容字 ⽣）
+CATEGORY_ALIASES = {
+    "學生": "student", "學⽣": "student", "student": "student",
+    "早鳥": "early", "early": "early", "early-bird": "early", "earlybird": "early",
+}
+
+def hhmm_to_min(s: str) -> int:
+    """'15:11' → 911；無法解析回傳 -1。"""
+    try:
+        hh, mm = s.strip().split(":")[:2]
+        return int(hh) * 60 + int(mm)
+    except (ValueError, AttributeError):
+        return -1
+
+def min_to_hhmm(m: int) -> str:
+    return f"{m // 60:02d}:{m % 60:02d}" if m >= 0 else ""
+
+def duration_text(m: int) -> str:
+    """64 → '1:04'（同 Step2 的 queryestimatedtime）。"""
+    return f"{m // 60}:{m % 60:02d}" if m >= 0 else ""
+
+def infer_travel_date(mmdd: str, today: date = None):
+    """
+    Step2 的日期只有 'MM/DD'，依今天推回完整日期：半年以前的視為明年（跨年訂票），
+    其餘視為今年。無法解析時回傳 None。
+    """
+    today = today or date.today()
+    try:
+        mm, dd = (int(x) for x in mmdd.strip().split("/")[:2])
+        d = date(today.year, mm, dd)
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if d < today - timedelta(days=183):
+        d = d.replace(year=today.year + 1)
+    return d
+
+def rate_percent(s: str) -> int:
+    """折數文字 → 百分比：'5' → 50、'75' → 75、'7.5' → 75。"""
+    return int(round(float(s) * 10)) if len(s) == 1 or "." in s else int(s)
+
+def category_name(label: str) -> str:
+    label = label.strip()
+    return CATEGORY_ALIASES.get(label.lower(), label)
+
+@lru_cache(maxsize=4096)
+def parse_discounts(text: str) -> tuple:
+    """'早鳥9折 學生75折' → (('early', 90), ('student', 75))；類別不認得時保留原文字。同一段文字只解析一次。"""
+    return tuple((category_name(label), rate_percent(n)) for label, n in _DISCOUNT_RE.findall(text or ""))
+
+def parse_discount_rate(text: str) -> int:
+    """折扣文字中最低的折數（百分比）：'學生5折' → 50、'學生75折' → 75、'早鳥9折' → 90；沒有則 100。"""
+    return min((rate for _, rate in parse_discounts(text)), default=100)
+
+def _truthy(v) -> bool:
+    if isinstance(v, str):
+        return v.strip().lower() in ("true", "1", "yes")
+    return bool(v)
+
+class TrainRow(NamedTuple):
+    date: date              # 乘車日期；Step2 的日期無法解析時為 None
+    code: str               # 車次
+    departure: int          # 出發時間（分鐘）
+    arrival: int            # 到達時間（分鐘）
+    duration: int           # 車程（分鐘）
+    discount_text: str      # 原始折扣文字（多個以空白串接）
+    discount_rate: int      # 最低折數（百分比），100 = 無折扣
+    selected: bool
+
+    @classmethod
+    def from_step2(cls, raw: dict, today: date = None) -> "TrainRow":
+        """thsrc_browser.extract_step2_rows 的一列 → TrainRow。"""
+        return cls.from_dict(raw, today)
+
+    @classmethod
+    def from_dict(cls, d: dict, today: date = None) -> "TrainRow":
+        """CSV（csv.DictReader，布林為 'True' 字串）或 SQLite 的列 → TrainRow。"""
+        text = str(d.get("discount_text") or "").strip()
+        return cls(
+            date=infer_travel_date(str(d.get("date") or ""), today),
+            code=str(d.get("code") or "").strip(),
+            departure=hhmm_to_min(str(d.get("departure") or "")),
+            arrival=hhmm_to_min(str(d.get("arrival") or "")),
+            duration=hhmm_to_min(str(d.get("estimated") or "")),
+            discount_text=text,
+            discount_rate=parse_discount_rate(text),
+            selected=_truthy(d.get("selected")),
+        )
+
+    @property
+    def discounts(self) -> tuple:
+        return parse_discounts(self.discount_text)
+
+    @property
+    def student_discount(self) -> bool:
+        return "學生" in self.discount_text or "學⽣" in self.discount_text  # 容錯
+
+    @property
+    def mmdd(self) -> str:
+        return f"{self.date.month:02d}/{self.date.day:02d}" if self.date else ""
+
+    def to_dict(self) -> dict:
+        """轉回 CSV / SQLite 用的字串欄位（欄位同 FIELDS）。"""
+        return {
+            "date": self.mmdd,
+            "code": self.code,
+            "departure": min_to_hhmm(self.departure),
+            "arrival": min_to_hhmm(self.arrival),
+            "estimated": duration_text(self.duration),
+            "student_discount": self.student_discount,
+            "discount_text": self.discount_text,
+            "selected": self.selected,
+        }
+
+    def key(self) -> str:
+        """去重用的 key：'10/20|837|15:11|16:15|早鳥9折 學生75折'（同 thsrc_watch.make_key 的舊格式）。"""
+        return "|".join([self.mmdd, self.code, min_to_hhmm(self.departure), min_to_hhmm(self.arrival),
+                         self.discount_text])
+
+def as_row(r) -> TrainRow:
+    """TrainRow 原樣回傳；dict 轉成 TrainRow。"""
+    return r if isinstance(r, TrainRow) else TrainRow.from_dict(r)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# thsrc_rules.py
+# 折扣命中規則：取代「折扣文字是否含某個關鍵字」的子字串比對。
+#
+# 規則語法（一條訂閱可寫多條，以逗號分隔 = 任一成立；同一條內以空白分隔 = 全部成立）：
+#   學生5折            學生票剛好 5 折（舊的 KEYWORD 寫法照樣可用）
+#   學生<=75折         學生票 75 折或更便宜（也可寫 學生≤75折、student<=75）
+#   早鳥               任何早鳥折扣（也可寫 early、early-bird）
+#   <=65折             任何類別 65 折或更便宜（也可寫 *<=65折）
+#   學生<=75折,早鳥<=8折   任一成立
+#   早鳥 學生           同一班車同時有早鳥與學生折扣
+# 折數：一位數為幾折（5 → 50%）、兩位數為幾幾折（75 → 75%），也可寫 7.5。
+#
+# RuleSet 把許多訂閱的規則預先編好：依類別分桶，「<=」門檻排序後以 bisect 找出所有成立的門檻，
+# 每列只需掃一次自己的折扣，不必對每個訂閱各做一次字串比對。
+#
+# 用法：
+#   rules = RuleSet()
+#   rules.add("tpe-txg", "學生<=75折")
+#   rules.add("hsz-tnn", "早鳥,學生5折")
+#   rules.match(row)                 # → {'tpe-txg', ...}（row 為 thsrc_rows.TrainRow）
+#   compile_rules("學生<=75折").test(row)   # 單一規則
+#
+# 需求：只用標準函式庫。
+
+import bisect
+import operator
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+from thsrc_rows import category_name, parse_discounts, rate_percent
+
+ANY = "*"
+_OPS = {"<=": operator.le, "<": operator.lt, ">=": operator.ge, ">": operator.gt, "==": operator.eq}
+_OP_ALIASES = {"≤": "<=", "≥": ">=", "=": "==", "": "=="}
+_TERM_RE = re.compile(r"^(?P<cat>[^\d<>=≤≥.]*?)\s*(?P<op><=|>=|==|=|<|>|≤|≥)?\s*(?P<rate>\d{1,2}(?:\.\d)?)?\s*折?$")
+_SPLIT_RE = re.compile(r"\s*[,，|｜]\s*")
+
+class Term(NamedTuple):
+    category: str       # 標準類別名（student / early / 原文字），ANY = 任何類別
+    op: str             # <=、<、>=、>、==；rate 為 None 時不比較折數
+    rate: int           # 百分比
+
+    def test(self, discounts) -> bool:
+        fn = _OPS[self.op]
+        for cat, rate in discounts:
+            if (self.category == ANY or cat == self.category) and (self.rate is None or fn(rate, self.rate)):
+                return True
+        return False
+
+def parse_term(text: str) -> Term:
+    m = _TERM_RE.match(text.strip())
+    if not m or not (m.group("cat").strip() or m.group("rate")):
+        raise ValueError(f"看不懂的折扣規則：{text}")
+    cat = m.group("cat").strip()
+    cat = ANY if cat in ("", ANY, "任何", "any") else category_name(cat)
+    op = m.group("op") or ""
+    op = _OP_ALIASES.get(op, op)
+    if m.group("rate") is None:
+        if m.group("op"):
+            raise ValueError(f"折扣規則缺少折數：{text}")
+        return Term(cat, "==", None)
+    return Term(cat, op, rate_percent(m.group("rate")))
+
+def parse_rule(spec: str):
+    """'學生<=75折,早鳥' → [(Term,), (Term,)]：外層任一成立，內層全部成立。"""
+    alts = []
+    for alt in _SPLIT_RE.split(spec.strip()):
+        if alt:
+            alts.append(tuple(parse_term(t) for t in alt.split()))
+    if not alts:
+        raise ValueError("折扣規則是空的")
+    return alts
+
+class RuleSet:
+    def __init__(self):
+        self.specs = {}             # 訂閱 id -> 規則原文
+        self._le = {}               # 類別 -> 排序的 [(門檻, 序號)]，「<=」與「<」（< n 視為 <= n-1）
+        self._le_ids = {}           # 類別 -> 與 _le 對齊的訂閱 id
+        self._eq = {}               # (類別, 折數) -> {訂閱 id}；只寫類別時折數為 None
+        self._compound = []         # (訂閱 id, (Term, ...))：多條件或 >= / >
+        self._text_cache = {}
+
+    def add(self, sub_id, spec: str):
+        """加入一條訂閱的規則；語法錯誤丟 ValueError。"""
+        alts = parse_rule(spec)
+        self.specs[sub_id] = spec
+        self._text_cache.clear()
+        for alt in alts:
+            if len(alt) == 1 and alt[0].op in ("<=", "<") and alt[0].rate is not None:
+                t = alt[0]
+                limit = t.rate if t.op == "<=" else t.rate - 1
+                keys = self._le.setdefault(t.category, [])
+                ids = self._le_ids.setdefault(t.category, [])
+                i = bisect.bisect_left(keys, limit)
+                keys.insert(i, limit)
+                ids.insert(i, sub_id)
+            elif len(alt) == 1 and alt[0].op == "==":
+                self._eq.setdefault((alt[0].category, alt[0].rate), set()).add(sub_id)
+            else:
+                self._compound.append((sub_id, alt))
+        return self
+
+    def __len__(self):
+        return len(self.specs)
+
+    def match_discounts(self, discounts) -> set:
+        """(類別, 折數) 的序列 → 成立的訂閱 id 集合。"""
+        out = set()
+        for cat, rate in discounts:
+            for c in (cat, ANY):
+                keys = self._le.get(c)
+                if keys:
+                    # 門檻 >= rate 的規則全部成立
+                    out.update(self._le_ids[c][bisect.bisect_left(keys, rate):])
+                for r in (rate, None):
+                    ids = self._eq.get((c, r))
+                    if ids:
+                        out.update(ids)
+        for sub_id, alt in self._compound:
+            if sub_id not in out and all(t.test(discounts) for t in alt):
+                out.add(sub_id)
+        return out
+
+    def match_text(self, text: str) -> set:
+        """折扣文字 → 成立的訂閱 id 集合（同一段文字只比對一次）。"""
+        hit = self._text_cache.get(text)
+        if hit is None:
+            hit = self._text_cache[text] = frozenset(self.match_discounts(parse_discounts(text)))
+        return hit
+
+    def match(self, row) -> set:
+        """row：thsrc_rows.TrainRow（或有 discount_text 的 dict）。"""
+        text = row.discount_text if hasattr(row, "discount_text") else (row.get("discount_text") or "")
+        return self.match_text(text.strip())
+
+    def test(self, row) -> bool:
+        return bool(self.match(row))
+
+    def test_text(self, text: str) -> bool:
+        return bool(self.match_text(text.strip()))
+
+@lru_cache(maxsize=256)
+def compile_rules(spec: str) -> RuleSet:
+    """單一規則（訂閱 id 為 spec 本身）；同一字串只編譯一次。"""
+    return RuleSet().add(spec, spec)
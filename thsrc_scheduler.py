@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+# thsrc_scheduler.py
+# 多查詢監看的排程元件：一個 process 讀入查詢清單，用優先佇列排程，共用一組有上限的瀏覽器 session，
+# 並以全域速率上限控制對官網的總請求量（查詢數變多時總負載仍維持平穩）。
+# 時段重疊的訂閱會合併成一次查詢（coalesce），結果再分給各訂閱者。
+# 輪詢間隔可依離出發時間與歷史命中時段自動伸縮（AdaptivePolicy），並以固定速率排程（next_deadline）。
+#
+# 查詢清單（JSON）：
+#   {
+#     "defaults": {"engine": "edge", "headless": true, "min_sec": 180, "max_sec": 300,
+#                  "keyword": "學生88折", "to": "me@example.com", "csv": "out.csv"},
+#     "queries": [
+#       {"id": "tpe-txg-1020", "origin": "台北", "dest": "台中", "date": "2025-10-20", "time": "15:00",
+#        "adult": 0, "student": 1, "priority": 0},
+#       {"id": "hsz-tnn-1026", "origin": "新竹", "dest": "台南", "date": "2025-10-26", "time": "08:00",
+#        "adult": 0, "student": 1, "keyword": "學生5折", "to": "friend@example.com", "priority": 1}
+#     ]
+#   }
+#   priority 數字越小越優先（同一時間到期時先跑）。
+#   keyword 為折扣規則（例：學生5折、學生<=75折、早鳥、學生<=75折,早鳥<=8折；語法見 thsrc_rules.py）。
+#
+# 需求：只用標準函式庫（實際查詢仍需 thsrc_search_v2_plus 的相依套件）。
+
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from thsrc_rows import hhmm_to_min
+from thsrc_rules import parse_rule
+from thsrc_search_v2_plus import SearchQuery, check_query
+
+QUERY_FIELDS = ("origin", "dest", "date", "time", "adult", "student", "engine", "headless", "proxy", "ua", "url",
+                "block_resources", "profile", "profile_max_mb", "profile_wipe_hours")
+
+@dataclass
+class WatchJob:
+    id: str
+    query: SearchQuery
+    keyword: str = "學生88折"
+    to: str = ""
+    csv: str = "out.csv"
+    store: str = ""
+    min_sec: int = 180
+    max_sec: int = 300
+    priority: int = 0
+    rounds: int = 0
+    hits: int = 0
+    last_run: float = 0.0
+    extra: dict = field(default_factory=dict)
+
+    def next_interval(self, policy=None) -> int:
+        if policy is not None:
+            return policy.interval(self.min_sec, self.max_sec, query_departure(self.query), self.keyword)
+        return random.randint(self.min_sec, max(self.min_sec, self.max_sec))
+
+def job_from_dict(d: dict, defaults: dict = None) -> WatchJob:
+    merged = dict(defaults or {})
+    merged.update(d)
+    missing = [k for k in ("origin", "dest", "date", "time") if not merged.get(k)]
+    if missing:
+        raise ValueError(f"查詢 {merged.get('id') or '(未命名)'} 缺少欄位：{', '.join(missing)}")
+    query = SearchQuery(**{k: merged[k] for k in QUERY_FIELDS if k in merged})
+    job_id = merged.get("id") or f"{query.origin}-{query.dest}-{query.date}-{query.time}"
+    try:
+        check_query(query)
+    except ValueError as e:
+        raise ValueError(f"查詢 {job_id}：{e}") from None
+    try:
+        parse_rule(merged.get("keyword", "學生88折"))
+    except ValueError as e:
+        raise ValueError(f"查詢 {job_id}：{e}") from None
+    known = set(QUERY_FIELDS) | {"id", "keyword", "to", "csv", "store", "min_sec", "max_sec", "priority"}
+    return WatchJob(
+        id=str(job_id),
+        query=query,
+        keyword=merged.get("keyword", "學生88折"),
+        to=merged.get("to", ""),
+        csv=merged.get("csv", "out.csv"),
+        store=merged.get("store", ""),
+        min_sec=int(merged.get("min_sec", 180)),
+        max_sec=int(merged.get("max_sec", 300)),
+        priority=int(merged.get("priority", 0)),
+        extra={k: v for k, v in merged.items() if k not in known},
+    )
+
+def load_jobs(path: str):
+    """讀查詢清單 JSON，回傳 list[WatchJob]；格式錯誤丟 ValueError。"""
+    with open(path, "r", encoding="utf-8") as f:
+        doc = json.load(f)
+    if isinstance(doc, list):
+        doc = {"queries": doc}
+    defaults = doc.get("defaults") or {}
+    jobs = [job_from_dict(q, defaults) for q in doc.get("queries") or []]
+    ids = [j.id for j in jobs]
+    dup = {i for i in ids if ids.count(i) > 1}
+    if dup:
+        raise ValueError(f"查詢 id 重複：{', '.join(sorted(dup))}")
+    return jobs
+
+# -----------------------------
+# 全域速率上限
+# -----------------------------
+class RateLimiter:
+    """
+    Token bucket：平均每分鐘最多 per_min 次，允許 burst 次的瞬間突發。
+    per_min <= 0 代表不限制。clock / sleep 預設為 time.monotonic / time.sleep（測試時可換成假時鐘）。
+    """
+    def __init__(self, per_min: float, burst: int = 1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = per_min / 60.0 if per_min > 0 else 0.0
+        self.capacity = max(1, burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(self.capacity)
+        self.stamp = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self) -> float:
+        """取得一個 token 前還需要等幾秒（不消耗 token）。"""
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            self._refill()
+            return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def acquire(self) -> float:
+        """阻塞直到取得一個 token，回傳實際等待秒數。"""
+        if not self.rate:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                need = (1 - self.tokens) / self.rate
+            self.sleep(need)
+            waited += need
+
+# -----------------------------
+# 優先佇列排程
+# -----------------------------
+class Scheduler:
+    """
+    依 (到期時間, priority) 排序的 heap。移除 / 重排採 lazy deletion：
+    每個 job 記一個版本號，heap 裡版本過期的項目在 pop 時丟掉。
+    """
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._version = {}
+        self._due = {}
+        self.jobs = {}
+
+    def add(self, job: WatchJob, due: float):
+        self.jobs[job.id] = job
+        self.reschedule(job.id, due)
+
+    def reschedule(self, job_id: str, due: float):
+        ver = self._version.get(job_id, 0) + 1
+        self._version[job_id] = ver
+        self._due[job_id] = due
+        job = self.jobs[job_id]
+        heapq.heappush(self._heap, (due, job.priority, next(self._seq), job_id, ver))
+
+    def remove(self, job_id: str):
+        self.jobs.pop(job_id, None)
+        self._version.pop(job_id, None)
+        self._due.pop(job_id, None)
+
+    def due(self, job_id: str):
+        """job 目前排定的到期時間；不在佇列中回傳 None。"""
+        return self._due.get(job_id)
+
+    def _drop_stale(self):
+        while self._heap:
+            due, _, _, job_id, ver = self._heap[0]
+            if self._version.get(job_id) == ver:
+                return
+            heapq.heappop(self._heap)
+
+    def peek(self):
+        """回傳 (due, job)；佇列為空時回傳 (None, None)。"""
+        self._drop_stale()
+        if not self._heap:
+            return None, None
+        due, _, _, job_id, _ = self._heap[0]
+        return due, self.jobs[job_id]
+
+    def pop(self):
+        """取出最早到期的 (due, job)；之後需呼叫 reschedule 才會再排入。"""
+        due, job = self.peek()
+        if job is not None:
+            heapq.heappop(self._heap)
+            self._version[job.id] = self._version.get(job.id, 0) + 1
+        return due, job
+
+    def __len__(self):
+        return len(self.jobs)
+
+def next_deadline(prev_due: float, interval: float, now: float = None) -> float:
+    """
+    固定速率排程：下一輪預定在「上一輪的預定時間 + interval」，本輪耗時不會累加進週期。
+    已經落後（本輪跑太久）時就立刻跑下一輪，但不補跑錯過的輪次。
+    """
+    now = time.time() if now is None else now
+    due = prev_due + interval
+    return due if due > now else now
+
+def stagger(jobs, start: float, spread_sec: float):
+    """第一次排程時把查詢平均分散在 spread_sec 內，避免同時開跑。回傳 [(job, due)]。"""
+    n = max(1, len(jobs))
+    step = spread_sec / n
+    return [(job, start + i * step) for i, job in enumerate(sorted(jobs, key=lambda j: j.priority))]
+
+# -----------------------------
+# 合併重疊的訂閱
+# -----------------------------
+# 同起訖站、同日期、同票數的訂閱，若出發時間落在同一個 Step2 結果範圍內，就只查一次，
+# 再把結果依各自的出發時間與關鍵字分給每個訂閱者。
+COVER_MIN = 60   # 合併查詢的結果至少要涵蓋到訂閱時間後這麼多分鐘，才算涵蓋該訂閱
+# 各站末班車最早約在這個時間發車；COVER_MIN 的要求不超過它，否則晚間的訂閱永遠湊不滿 60 分鐘而一直被拆出去
+LAST_TRAIN_MIN = hhmm_to_min("22:30")
+
+def route_key(job: WatchJob):
+    q = job.query
+    return (q.origin, q.dest, q.date, q.adult, q.student, q.engine, q.headless, q.proxy, q.ua, q.url,
+            q.block_resources, q.profile, job.csv, job.store)
+
+@dataclass
+class SearchGroup:
+    """
+    一次實際查詢；members 為共用這次查詢結果的訂閱。介面與 WatchJob 相同，可直接交給 Scheduler。
+    detached 為結果沒涵蓋而拆出去單獨查詢的訂閱（各自以 SearchGroup.single 排程）；
+    本組每查一輪就用 fan_out 重新檢查一次，涵蓋到了就併回（見 split / rejoin）。
+    """
+    id: str
+    query: SearchQuery
+    members: list
+    detached: list = field(default_factory=list)
+
+    @property
+    def priority(self) -> int:
+        return min(m.priority for m in self.members)
+
+    @property
+    def csv(self) -> str:
+        return self.members[0].csv
+
+    @property
+    def store(self) -> str:
+        return self.members[0].store
+
+    def next_interval(self, policy=None) -> int:
+        # 取成員中最頻繁的需求
+        if policy is not None:
+            return min(m.next_interval(policy) for m in self.members)
+        lo = min(m.min_sec for m in self.members)
+        hi = min(max(m.min_sec, m.max_sec) for m in self.members)
+        return random.randint(lo, max(lo, hi))
+
+    @classmethod
+    def single(cls, job: WatchJob) -> "SearchGroup":
+        return cls(id=job.id, query=job.query, members=[job])
+
+    def split(self, sched: "Scheduler", job: WatchJob, now: float = None):
+        """把 job 拆出去單獨查詢（立刻到期）；之後每輪仍由本組檢查能否併回。"""
+        self.members.remove(job)
+        self.detached.append(job)
+        sched.add(SearchGroup.single(job), time.time() if now is None else now)
+
+    def rejoin(self, sched: "Scheduler", job: WatchJob):
+        """本組的結果又涵蓋到 job 了：取消它的單獨查詢，併回本組。"""
+        self.detached.remove(job)
+        sched.remove(job.id)
+        self.members.append(job)
+
+def coalesce(jobs, window_min: int = 60):
+    """
+    把可共用查詢的訂閱分組：同 route_key，且出發時間與組內最早者相差不超過 window_min 分鐘。
+    組的查詢時間取組內最早的時間。window_min <= 0 時每個訂閱各自一組。回傳 list[SearchGroup]。
+    """
+    if window_min <= 0:
+        return [SearchGroup.single(j) for j in jobs]
+    by_route = {}
+    for j in jobs:
+        by_route.setdefault(route_key(j), []).append(j)
+    groups = []
+    for members in by_route.values():
+        members.sort(key=lambda j: hhmm_to_min(j.query.time))
+        cur = []
+        for j in members:
+            if cur and hhmm_to_min(j.query.time) - hhmm_to_min(cur[0].query.time) > window_min:
+                groups.append(cur)
+                cur = []
+            cur.append(j)
+        groups.append(cur)
+    out = []
+    for g in groups:
+        gid = g[0].id if len(g) == 1 else "+".join(j.id for j in g)
+        out.append(SearchGroup(id=gid, query=g[0].query, members=g))
+    return out
+
+def _search_signature(group: SearchGroup):
+    """決定「查什麼、結果寫到哪」的部分；收件者、規則、間隔、priority 改變不影響。"""
+    members = sorted(group.members + group.detached, key=lambda m: m.id)
+    return (group.query, tuple((m.id, m.query, m.csv, m.store) for m in members))
+
+def reload_groups(sched: Scheduler, jobs, window_min: int = 60, spread_sec: float = 0, now: float = None):
+    """
+    查詢清單熱載入：新清單 coalesce 後與排程中的組比對。
+      - 查詢內容與成員都沒變的組：沿用原本的到期時間，只換上新的訂閱設定（收件者、規則、間隔、priority）
+      - 新增或查詢有變的組：重新排入，分散在 spread_sec 內
+      - 不在新清單裡的組：移出排程
+    同 id 的訂閱保留 rounds / hits / last_run。回傳 (kept, added, removed) 三個 group id 的 list。
+    """
+    now = time.time() if now is None else now
+    old_jobs = {m.id: m for g in sched.jobs.values() for m in g.members}
+    for job in jobs:
+        prev = old_jobs.get(job.id)
+        if prev is not None:
+            job.rounds, job.hits, job.last_run = prev.rounds, prev.hits, prev.last_run
+    kept, fresh = [], []
+    new_ids = set()
+    for group in coalesce(jobs, window_min):
+        new_ids.add(group.id)
+        old = sched.jobs.get(group.id)
+        due = sched.due(group.id)
+        if old is not None and due is not None and _search_signature(old) == _search_signature(group):
+            sched.add(group, due)
+            kept.append(group.id)
+        else:
+            fresh.append(group)
+    removed = [gid for gid in list(sched.jobs) if gid not in new_ids]
+    for gid in removed:
+        sched.remove(gid)
+    for group, due in stagger(fresh, now, spread_sec):
+        sched.add(group, due)
+    return kept, [g.id for g in fresh], removed
+
+def fan_out(rows, job: WatchJob):
+    """
+    從合併查詢的結果取出屬於此訂閱的列（出發時間不早於訂閱時間），回傳 (rows, covered)。
+    covered=False 表示結果沒涵蓋到此訂閱的時段，應改為單獨查詢。
+    涵蓋 = 結果裡有此訂閱時間之後的車，且最晚一班不早於訂閱時間 + COVER_MIN（最多要求到 LAST_TRAIN_MIN）。
+    """
+    t = hhmm_to_min(job.query.time)
+    mine = [r for r in rows if r.departure >= t]
+    last = max((r.departure for r in rows), default=-1)
+    covered = bool(mine) and last >= min(t + COVER_MIN, LAST_TRAIN_MIN)
+    return mine, covered
+
+# -----------------------------
+# 自適應輪詢間隔
+# -----------------------------
+# 間隔依兩件事伸縮，結果落在 [min_sec, max_sec * backoff]：
+#   1. 離出發還多久：NEAR_HOURS 內用 min_sec、FAR_DAYS 以上用 max_sec，中間依對數內插
+#   2. 歷史上這個小時有命中的輪數比例（從 SQLite 結果統計）：最熱門的時段縮成 0.5 倍，
+#      樣本足夠卻從沒命中過的時段拉長到 backoff 倍；沒有歷史資料時不調整
+NEAR_HOURS = 6
+FAR_DAYS = 14
+MIN_SAMPLES = 5     # 某小時至少要有這麼多輪紀錄才拿來判斷
+
+def query_departure(query):
+    """SearchQuery 的出發時間（datetime）；無法解析回傳 None。"""
+    try:
+        return datetime.strptime(f"{query.date} {query.time}", "%Y-%m-%d %H:%M")
+    except (ValueError, TypeError):
+        return None
+
+class HitProfile:
+    """每小時的 (輪數, 命中輪數)，來源為 thsrc_store.SqliteStore.hit_hours。"""
+    def __init__(self, hours=None):
+        self.hours = hours or {}
+
+    @classmethod
+    def from_store(cls, path: str, keyword: str) -> "HitProfile":
+        if not path or not os.path.exists(path):
+            return cls()
+        from thsrc_store import SqliteStore
+        db = SqliteStore(path)
+        try:
+            return cls(db.hit_hours(keyword))
+        finally:
+            db.close()
+
+    def rate(self, hour: int):
+        n, hit = self.hours.get(hour, (0, 0))
+        return hit / n if n >= MIN_SAMPLES else None
+
+    def heat(self, hour: int):
+        """此小時的命中率相對於最熱門時段（0~1）；樣本不足或從未命中過回傳 None。"""
+        r = self.rate(hour)
+        top = max((self.rate(h) or 0.0) for h in range(24))
+        if r is None or top <= 0:
+            return None
+        return r / top
+
+class AdaptivePolicy:
+    """
+    history：SQLite 結果檔路徑（--store sqlite:PATH 的 PATH）；空字串則只依出發時間調整。
+    各關鍵字的 HitProfile 每 refresh_sec 秒重新統計一次。
+    """
+    def __init__(self, history: str = "", backoff: float = 3.0, refresh_sec: int = 3600):
+        self.history = history
+        self.backoff = max(1.0, backoff)
+        self.refresh_sec = refresh_sec
+        self._profiles = {}     # keyword -> (loaded_at, HitProfile)
+
+    def profile(self, keyword: str) -> HitProfile:
+        loaded_at, prof = self._profiles.get(keyword, (0.0, None))
+        if prof is None or time.time() - loaded_at > self.refresh_sec:
+            try:
+                prof = HitProfile.from_store(self.history, keyword)
+            except Exception:
+                prof = prof or HitProfile()
+            self._profiles[keyword] = (time.time(), prof)
+        return prof
+
+    @staticmethod
+    def proximity(departure, now: datetime) -> float:
+        """0 = 即將出發，1 = 還很久；不知道出發時間回傳 0.5；已經發車（查詢過期）回傳 1，不再密集輪詢。"""
+        if departure is None:
+            return 0.5
+        hours = (departure - now).total_seconds() / 3600
+        if hours < 0:
+            return 1.0
+        if hours <= NEAR_HOURS:
+            return 0.0
+        far = FAR_DAYS * 24
+        if hours >= far:
+            return 1.0
+        return math.log(hours / NEAR_HOURS) / math.log(far / NEAR_HOURS)
+
+    def interval(self, min_sec: int, max_sec: int, departure=None, keyword: str = "", now: datetime = None) -> int:
+        now = now or datetime.now()
+        lo, hi = min_sec, max(min_sec, max_sec)
+        base = lo + (hi - lo) * self.proximity(departure, now)
+        heat = self.profile(keyword).heat(now.hour)
+        if heat is None:
+            factor = 1.0
+        elif heat == 0:
+            factor = self.backoff
+        else:
+            factor = 1.5 - heat
+        sec = base * factor * random.uniform(0.9, 1.1)   # 保留一點抖動
+        return int(max(lo, min(hi * self.backoff, sec)))
@@ -11,22 +11,28 @@
 # 重要說明：
 # - 以你 v2 的做法為主：Submit 使用 no_wait_after=True、顯式等遮罩消失、等待 Step2 結果區塊或錯誤。
 # - 這版加強點：更穩定的遮罩偵測與「強制解除」、更完整的錯誤訊息檢查、可選 Edge/Chromium、可自定 UA 與 Proxy。
+# - 頁面流程只有 thsrc_async 一份（asyncio）；本檔提供 CLI、查詢參數、寫出結果與同步入口 search()。
 # - 擷取欄位：出發時間、抵達時間、車程、車次、日期、是否學生折扣、折數（若有文字如「學生88折」）、是否為目前頁面預設選取列車。
 
 import argparse
 import csv
 import os
-import random
 import re
 import sys
-import time
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 
-import ddddocr
-from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError
+# ddddocr（連帶 onnxruntime）與 playwright 載入很慢，改在第一次用到時才 import：
+# --help、參數錯誤與 thsrc_watch 解析 --scraper 都不必付這筆成本（見 bench_startup.py）
+from thsrc_browser import ProfileDir
+from thsrc_rows import FIELDS, TrainRow, as_row
+import thsrc_snapshots as snapshots
+from thsrc_store import SqliteStore, parse_store_spec
+from thsrc_trace import RoundTrace, open_sink
 
-URL = "https://irs.thsrc.com.tw/IMINT/?utm_source=thsrc&utm_medium=btnlink&utm_term=booking"
+# 可用環境變數 THSRC_URL 或 --url 指向離線回放站（thsrc_replay_server.py）
+URL = os.environ.get("THSRC_URL") or "https://irs.thsrc.com.tw/IMINT/?utm_source=thsrc&utm_medium=btnlink&utm_term=booking"
 
 # -----------------------------
 # 小工具
@@ -35,301 +41,48 @@ def log(msg: str):
     ts = datetime.now().strftime("%H:%M:%S")
     print(f"[{ts}] {msg}")
 
-def human_sleep(a=0.15, b=0.45):
-    time.sleep(random.uniform(a, b))
-
 def ensure_dir(p: str):
     Path(p).parent.mkdir(parents=True, exist_ok=True)
 
 # -----------------------------
-# 遮罩處理與頁面等待
-# -----------------------------
-def wait_mask_then_clear_if_stuck(page, check_every_ms=400, hard_timeout_ms=16000):
-    """
-    等待 loading 遮罩消失；若超時則呼叫頁面現成的 hideMaskFrame() 嘗試解除。
-    """
-    start = time.time()
-    while True:
-        try:
-            ok = page.evaluate(
-                """() => {
-                    const isHidden = (el) => !el || el.style.display === 'none' || getComputedStyle(el).display === 'none';
-                    const a = document.querySelector('#divMaskFrame');
-                    const b = document.querySelector('#loadingMask');
-                    const c = document.querySelector('#BusyBoxDiv');
-                    return isHidden(a) && isHidden(b) && isHidden(c);
-                }"""
-            )
-            if ok:
-                return True
-        except Exception:
-            pass
-
-        if (time.time() - start) * 1000 > hard_timeout_ms:
-            log("遮罩疑似卡住，嘗試呼叫 hideMaskFrame() 強制解除")
-            try:
-                page.evaluate("hideMaskFrame && hideMaskFrame();")
-            except Exception:
-                pass
-            # 再給它一點時間
-            time.sleep(0.6)
-            try:
-                ok = page.evaluate(
-                    """() => {
-                        const isHidden = (el) => !el || el.style.display === 'none' || getComputedStyle(el).display === 'none';
-                        const a = document.querySelector('#divMaskFrame');
-                        const b = document.querySelector('#loadingMask');
-                        const c = document.querySelector('#BusyBoxDiv');
-                        return isHidden(a) && isHidden(b) && isHidden(c);
-                    }"""
-                )
-                return ok
-            except Exception:
-                return False
-
-        time.sleep(check_every_ms / 1000.0)
-
-def wait_step2_or_error(page, timeout_ms=15000):
-    """
-    等待「選擇車次」(Step2) 結果區塊，或錯誤區塊顯示。
-    回傳 'step2' / 'error' / 'none'
-    """
-    start = time.time()
-    while (time.time() - start) * 1000 <= timeout_ms:
-        try:
-            exist_step2 = page.locator("#BookingS2Form_TrainQueryDataViewPanel").first.is_visible(timeout=500)
-            if exist_step2:
-                return "step2"
-        except Exception:
-            pass
-
-        try:
-            # divErrMSG 只有在內部有字或 li 時會顯示，保守地只要顯示就算 error
-            err_block = page.locator("#divErrMSG")
-            if err_block.count() > 0 and err_block.first.is_visible(timeout=200):
-                return "error"
-        except Exception:
-            pass
-
-        time.sleep(0.25)
-
-    return "none"
-
-def read_error_text(page):
-    try:
-        if page.locator("#divErrMSG").first.is_visible(timeout=500):
-            txt = page.locator("#divErrMSG").inner_text(timeout=500)
-            return re.sub(r"\s+", " ", txt).strip()
-    except Exception:
-        pass
-    return ""
-
-# -----------------------------
-# 初始頁面操作
+# 填表 / 驗證碼共用的頁面腳本（實際流程在 thsrc_async）
 # -----------------------------
-def close_consent(page):
-    for label in ["我同意", "同意", "我同意，繼續", "同意並繼續"]:
-        try:
-            page.get_by_role("button", name=label, exact=False).click(timeout=1200)
-            human_sleep()
-            return
-        except Exception:
-            pass
-    try:
-        page.get_by_text("同意", exact=False).first.click(timeout=1200)
-        human_sleep()
-    except Exception:
-        pass
-
-def select_station(page, which: str, name: str):
-    sel = page.locator('select[name="selectStartStation"]') if which == "出發" \
-          else page.locator('select[name="selectDestinationStation"]')
-    sel.select_option(label=name)
-    human_sleep()
-
-def set_date(page, date_str: str):
+SET_DATE_JS = """(val)=>{
+    const el = document.querySelector('#toTimeInputField');
+    if(!el) return;
+    el.value = val;
+    el.setAttribute('value', val);
+    el.dispatchEvent(new Event('input', {bubbles:true}));
+    el.dispatchEvent(new Event('change', {bubbles:true}));
+    if (window.BookingS1 && BookingS1.typesoftrainCheck) {
+        try { BookingS1.typesoftrainCheck(); } catch(e){}
+    }
+}"""
+
+def flatpickr_date(date_str: str) -> str:
     # flatpickr: 真正送出的值在隱藏 input #toTimeInputField，格式需 YYYY/MM/DD
     yyyy, mm, dd = date_str.split("-")
-    v = f"{yyyy}/{int(mm):02d}/{int(dd):02d}"
-    page.evaluate(
-        """(val)=>{
-            const el = document.querySelector('#toTimeInputField');
-            if(!el) return;
-            el.value = val;
-            el.setAttribute('value', val);
-            el.dispatchEvent(new Event('input', {bubbles:true}));
-            el.dispatchEvent(new Event('change', {bubbles:true}));
-            if (window.BookingS1 && BookingS1.typesoftrainCheck) {
-                try { BookingS1.typesoftrainCheck(); } catch(e){}
-            }
-        }""",
-        v
-    )
-    human_sleep()
-
-def set_time(page, time_label: str):
-    page.locator('select[name="toTimeTable"]').select_option(label=time_label)
-    human_sleep()
-
-def set_student_count(page, n: int):
-    page.locator('select[name="ticketPanel:rows:4:ticketAmount"]').select_option(value=f"{n}P")
-    human_sleep()
-
-def set_adult_count(page, n: int):
-    page.locator('select[name="ticketPanel:rows:0:ticketAmount"]').select_option(value=f"{n}F")
-    human_sleep()
-
-# -----------------------------
-# 驗證碼
-# -----------------------------
-class CaptchaSolver:
-    def __init__(self):
-        self.ocr = ddddocr.DdddOcr()
-
-    def solve_once(self, page) -> str:
-        # 先刷新一次降低殘影
-        try:
-            page.locator("#BookingS1Form_homeCaptcha_reCodeLink").click(timeout=800)
-            page.wait_for_timeout(450)
-        except Exception:
-            pass
-
-        img = page.locator("#BookingS1Form_homeCaptcha_passCode")
-        img.wait_for(timeout=6000)
-        path = "captcha.png"
-        img.screenshot(path=path)
-        with open(path, "rb") as f:
-            raw = f.read()
-        try:
-            os.remove(path)
-        except Exception:
-            pass
-        res = self.ocr.classification(raw)
-        # 清理成英數（網站常見 4 位）
-        res = re.sub(r"[^0-9a-zA-Z]", "", res or "")
-        return res
+    return f"{yyyy}/{int(mm):02d}/{int(dd):02d}"
 
-    def fill(self, page, text: str):
-        sc = page.locator("#securityCode")
-        sc.fill(text)
-        # 觸發事件
-        page.evaluate(
-            """() => {
-                const el = document.querySelector('#securityCode');
-                if (!el) return;
-                el.dispatchEvent(new Event('input', {bubbles:true}));
-                el.dispatchEvent(new Event('change', {bubbles:true}));
-                el.blur();
-            }"""
-        )
+CAPTCHA_EVENTS_JS = """() => {
+    const el = document.querySelector('#securityCode');
+    if (!el) return;
+    el.dispatchEvent(new Event('input', {bubbles:true}));
+    el.dispatchEvent(new Event('change', {bubbles:true}));
+    el.blur();
+}"""
 
-def handle_captcha(page, max_try=6) -> bool:
-    solver = CaptchaSolver()
-    for i in range(max_try):
-        try:
-            ans = solver.solve_once(page)
-            log(f"OCR 辨識結果: {ans}")
-            if not ans:
-                continue
-            solver.fill(page, ans)
-            return True
-        except Exception as e:
-            log(f"處理驗證碼失敗（{i+1}/{max_try}）：{e}")
-    log("超過最大重試次數，無法處理驗證碼")
-    return False
+def clean_captcha(res: str) -> str:
+    # 清理成英數（網站常見 4 位）
+    return re.sub(r"[^0-9a-zA-Z]", "", res or "")
 
 # -----------------------------
-# 送出查詢與重試邏輯
+# Step2 車次清單
 # -----------------------------
-def click_search(page):
-    # AJAX 提交，避免卡在「等待導航」
-    page.locator("#SubmitButton").click(no_wait_after=True)
-
-def submit_and_wait_step2(page, max_submit_retries=5):
-    """
-    - 送出查詢
-    - 等遮罩 → 等 Step2 或錯誤
-    - 若錯誤含驗證碼/錯誤字樣，重新解一次驗證碼後再送
-    """
-    for attempt in range(max_submit_retries):
-        click_search(page)
-        wait_mask_then_clear_if_stuck(page, hard_timeout_ms=18000)
-        state = wait_step2_or_error(page, timeout_ms=18000)
-
-        if state == "step2":
-            return True
-        elif state == "error":
-            err = read_error_text(page)
-            log(f"提交後出現錯誤：{err or '(無內容)'}")
-            if "驗證碼" in err or "錯誤" in err or "請重新輸入" in err:
-                log(f"嘗試重新解驗證碼並重送（{attempt+1} / {max_submit_retries}）")
-                human_sleep(0.6)
-                if not handle_captcha(page):
-                    return False
-                continue
-            else:
-                # 不是驗證碼錯誤，多半是其他條件未通過，直接返回
-                return False
-        else:
-            # 兩者都沒等到，當作超時，嘗試再解一次驗證碼並重送
-            log(f"等待結果超時（{attempt+1} / {max_submit_retries}），嘗試再送")
-            try:
-                handle_captcha(page)  # 有些情況是驗證碼過期
-            except Exception:
-                pass
-            continue
-    return False
-
-# -----------------------------
-# 解析 Step2 車次清單
-# -----------------------------
-def scrape_trains_on_step2(page):
-    """
-    回傳 list[dict]：
-        departure, arrival, estimated, code, date, student_discount(bool), discount_text, selected(bool)
-    """
-    root = page.locator("#BookingS2Form_TrainQueryDataViewPanel")
-    rows = root.locator(".result-listing label.result-item")
-    n = rows.count()
-    data = []
-
-    for i in range(n):
-        row = rows.nth(i)
-        radio = row.locator("input.uk-radio")
-        departure = radio.get_attribute("querydeparture") or ""
-        arrival = radio.get_attribute("queryarrival") or ""
-        estimated = radio.get_attribute("queryestimatedtime") or ""
-        code = radio.get_attribute("querycode") or ""
-        date = radio.get_attribute("querydeparturedate") or ""
-
-        # 折扣
-        discount_text = ""
-        try:
-            discount_text = row.locator(".discount span").all_inner_texts()
-            discount_text = " ".join([t.strip() for t in discount_text if t.strip()])
-        except Exception:
-            pass
-
-        student_discount = "學生" in discount_text or "學⽣" in discount_text  # 容錯
-
-        # 是否為目前預選
-        selected = False
-        try:
-            selected = (radio.is_checked() or "active" in (row.get_attribute("class") or ""))
-        except Exception:
-            pass
-
-        data.append({
-            "date": date,
-            "code": code,
-            "departure": departure,
-            "arrival": arrival,
-            "estimated": estimated,
-            "student_discount": student_discount,
-            "discount_text": discount_text,
-            "selected": selected,
-        })
-    return data
+def rows_from_step2(raw_rows):
+    """把 thsrc_browser.extract_step2_rows 的原始欄位整理成 list[TrainRow]（thsrc_async.scrape_trains_on_step2 用）。"""
+    today = datetime.now().date()
+    return [TrainRow.from_step2(r, today) for r in raw_rows]
 
 # -----------------------------
 # CSV
@@ -339,20 +92,107 @@ def save_csv(rows, csv_path):
         log("沒有可寫入的資料")
         return
     ensure_dir(csv_path)
-    fieldnames = ["date", "code", "departure", "arrival", "estimated", "student_discount", "discount_text", "selected"]
     write_header = not os.path.exists(csv_path)
     with open(csv_path, "a", newline="", encoding="utf-8-sig") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
+        w = csv.DictWriter(f, fieldnames=FIELDS)
         if write_header:
             w.writeheader()
         for r in rows:
-            w.writerow(r)
+            w.writerow(as_row(r).to_dict())
     log(f"已寫入 {len(rows)} 筆到 {csv_path}")
 
+def save_results(rows, csv_path, store: str = "", query: "SearchQuery" = None):
+    """
+    依 --store 決定寫到哪裡：空字串或 csv:PATH → 追加 CSV；sqlite:PATH → 寫入 SQLite（thsrc_store）；
+    diff:PATH → 與同一查詢的上一輪比較，只記出現 / 消失（thsrc_diff，需給 query）。
+    diff 模式回傳 thsrc_diff.Diff，其餘回傳 None。
+    """
+    kind, path = parse_store_spec(store) if store else ("csv", csv_path)
+    if kind == "csv":
+        save_csv(rows, path or csv_path)
+        return None
+    if not rows:
+        log("沒有可寫入的資料")
+        return None
+    if kind == "diff":
+        from thsrc_diff import DiffStore, query_key
+        if query is None:
+            raise ValueError("diff: 儲存需要查詢參數")
+        db = DiffStore(path)
+        try:
+            diff = db.apply(query_key(query), rows)
+        finally:
+            db.close()
+        log(f"差異：新出現 {len(diff.appeared)}、消失 {len(diff.disappeared)}、未變 {diff.unchanged}（{path}）")
+        return diff
+    db = SqliteStore(path)
+    try:
+        n = db.insert_rows(rows)
+    finally:
+        db.close()
+    log(f"已寫入 {n} 筆到 {path}")
+    return None
+
+
 # -----------------------------
-# 主流程
+# 查詢參數
 # -----------------------------
-def main():
+# 預設用 Edge 的 UA（比 Chromium 更像真人流量）
+DEFAULT_EDGE_UA = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/126.0.0.0 Safari/537.36 Edg/126.0.0.0"
+)
+
+# 反自動化痕跡（常見檢查項）
+STEALTH_INIT_SCRIPT = """
+    Object.defineProperty(navigator, 'webdriver', { get: () => undefined });
+    Object.defineProperty(navigator, 'languages', { get: () => ['zh-TW','zh','en-US','en'] });
+    window.chrome = { runtime: {} };
+    const originalQuery = window.navigator.permissions && window.navigator.permissions.query;
+    if (originalQuery) {
+      window.navigator.permissions.query = (parameters) => (
+        parameters.name === 'notifications' ?
+          Promise.resolve({ state: Notification.permission }) :
+          originalQuery(parameters)
+      );
+    }
+"""
+
+@dataclass
+class SearchQuery:
+    origin: str
+    dest: str
+    date: str                 # YYYY-MM-DD
+    time: str                 # 出發時間下拉文字，例如 15:00
+    adult: int = 1
+    student: int = 0
+    engine: str = "edge"      # edge / chromium
+    headless: bool = False
+    proxy: str = ""
+    ua: str = ""
+    url: str = ""             # 空字串則用 URL
+    block_resources: bool = False   # 只放行頁面 / AJAX / script / 驗證碼圖，其餘請求擋掉
+    profile: str = ""               # 持久化 profile 目錄（靜態資源走磁碟快取）；空字串則每次全新 context
+    profile_max_mb: int = 200
+    profile_wipe_hours: float = 24
+    measure_net: bool = False       # 每輪流量記進 trace（bench_rounds 用；--block_resources 時一律記錄）
+
+    @classmethod
+    def from_args(cls, args) -> "SearchQuery":
+        return cls(
+            origin=args.origin, dest=args.dest, date=args.date, time=args.time,
+            adult=args.adult, student=args.student, engine=args.engine,
+            headless=args.headless, proxy=args.proxy, ua=args.ua, url=args.url,
+            block_resources=args.block_resources, profile=args.profile,
+            profile_max_mb=args.profile_max_mb, profile_wipe_hours=args.profile_wipe_hours,
+        )
+
+    def launch_key(self):
+        """瀏覽器層級的參數；查詢引擎（thsrc_async）依此判斷 browser 能否共用。"""
+        return ("search", self.engine, self.headless, self.proxy, self.ua, self.block_resources, self.profile)
+
+def build_parser() -> argparse.ArgumentParser:
     ap = argparse.ArgumentParser(description="THSR 查詢（Playwright + ddddocr）")
     ap.add_argument("--origin", required=True, help="出發站，例如 台北 / 南港 / 板橋 / 桃園 / 新竹 / 台中 / 嘉義 / 台南 / 左營")
     ap.add_argument("--dest", required=True, help="到達站")
@@ -361,113 +201,150 @@ def main():
     ap.add_argument("--adult", type=int, default=1, help="全票張數")
     ap.add_argument("--student", type=int, default=0, help="學生票張數")
     ap.add_argument("--csv", default="thsrc_results.csv", help="輸出 CSV 路徑")
+    ap.add_argument("--store", default="",
+                    help="結果存放處：sqlite:PATH 寫入 SQLite；diff:PATH 只記折扣出現 / 消失（thsrc_diff）；空白則照舊追加到 --csv")
     ap.add_argument("--engine", choices=["edge", "chromium"], default="edge", help="瀏覽器引擎（預設 edge）")
     ap.add_argument("--headless", action="store_true", help="啟用 headless 模式")
     ap.add_argument("--proxy", default="", help="Proxy，如 http://HOST:PORT")
     ap.add_argument("--ua", default="", help="自訂 User-Agent（空字串則使用預設 Edge UA）")
-    args = ap.parse_args()
+    ap.add_argument("--trace", default="", help="逐階段計時輸出（JSON Lines 檔路徑；'-' 為 stdout；空白不輸出）")
+    ap.add_argument("--url", default="", help="訂票首頁網址（預設官網；可指向 thsrc_replay_server.py 離線回放）")
+    ap.add_argument("--block_resources", action="store_true",
+                    help="擋掉圖片 / 字型 / CSS / 第三方追蹤，只載入頁面、AJAX、script 與驗證碼圖（省流量）")
+    ap.add_argument("--profile", default="", help="持久化瀏覽器 profile 目錄，靜態 JS / CSS 跨輪走磁碟快取（空白則每次全新）")
+    ap.add_argument("--profile_max_mb", type=int, default=200, help="--profile 目錄大小上限（MB），超過即清空重建")
+    ap.add_argument("--profile_wipe_hours", type=float, default=24, help="--profile 每隔幾小時整個清空一次（0=不定期清）")
+    ap.add_argument("--snapshot_dir", default="debug", help="失敗時的除錯快照目錄（HTML 以 gzip 壓縮、截圖為 JPEG）")
+    ap.add_argument("--snapshot_rate", type=float, default=1.0, help="失敗時拍快照的抽樣比例（0~1；0=不拍）")
+    ap.add_argument("--snapshot_max_mb", type=float, default=50, help="快照目錄大小上限（MB），超過從最舊的刪起")
+    ap.add_argument("--watchdog_sec", type=float, default=0,
+                    help="看門狗：超過該階段最長正常等待（goto 60 秒、其餘 30~40 秒）再加此秒數沒有進度，就強制結束瀏覽器"
+                         "（預設 0=關閉；thsrc_watch 內執行時改用它自己的設定）")
+    return ap
+
+STATIONS = ("南港", "台北", "板橋", "桃園", "新竹", "苗栗", "台中", "彰化", "雲林", "嘉義", "台南", "左營")
+MAX_TICKETS = 10
+_TIME_RE = re.compile(r"^([01]\d|2[0-3]):(00|30)$")
+
+def check_query(query: SearchQuery):
+    """檢查查詢內容是否合法（站名、日期、時段、張數）；不合法丟 ValueError。"""
+    for label, station in (("出發站", query.origin), ("到達站", query.dest)):
+        if station not in STATIONS:
+            raise ValueError(f"{label}「{station}」不是高鐵站名（可用：{' / '.join(STATIONS)}）")
+    if query.origin == query.dest:
+        raise ValueError("出發站與到達站不能相同")
+    try:
+        datetime.strptime(query.date, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"日期需為 YYYY-MM-DD：{query.date}") from None
+    if not _TIME_RE.match(query.time):
+        raise ValueError(f"出發時間需為整點或半點的 HH:MM：{query.time}")
+    for label, n in (("全票", query.adult), ("學生票", query.student)):
+        if not 0 <= n <= MAX_TICKETS:
+            raise ValueError(f"{label}張數需介於 0 到 {MAX_TICKETS}：{n}")
+    if query.adult + query.student == 0:
+        raise ValueError("全票與學生票至少要有一張")
+
+def validate_args(ap: argparse.ArgumentParser, args):
+    """在開瀏覽器之前擋下不合法的參數（ap.error 直接以 exit code 2 結束）。"""
+    try:
+        check_query(SearchQuery.from_args(args))
+    except ValueError as e:
+        ap.error(str(e))
+    if not 0 <= args.snapshot_rate <= 1:
+        ap.error("--snapshot_rate 需介於 0 到 1")
+
+def parse_query(argv=None):
+    """解析命令列參數，回傳 (SearchQuery, args)。thsrc_watch 也用它來解讀 --scraper 字串。"""
+    ap = build_parser()
+    args = ap.parse_args(argv)
+    validate_args(ap, args)
+    return SearchQuery.from_args(args), args
 
-    # 預設用 Edge 的 UA（比 Chromium 更像真人流量）
-    default_edge_ua = (
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-        "AppleWebKit/537.36 (KHTML, like Gecko) "
-        "Chrome/126.0.0.0 Safari/537.36 Edg/126.0.0.0"
+# -----------------------------
+# 函式庫入口
+# -----------------------------
+def launch_options(query: SearchQuery) -> dict:
+    launch_kwargs = dict(headless=query.headless)
+    if query.engine == "edge":
+        # 使用 Edge channel（需本機有 Edge）
+        launch_kwargs["channel"] = "msedge"
+    # proxy 在 browser.launch 層級（若有）
+    if query.proxy:
+        launch_kwargs["proxy"] = {"server": query.proxy}
+    return launch_kwargs
+
+def context_options(query: SearchQuery) -> dict:
+    return dict(
+        locale="zh-TW",
+        timezone_id="Asia/Taipei",
+        viewport={"width": 1280, "height": 900},
+        user_agent=query.ua or DEFAULT_EDGE_UA,
     )
-    user_agent = args.ua or default_edge_ua
-
-    with sync_playwright() as p:
-        launch_kwargs = dict(headless=args.headless)
-        if args.engine == "edge":
-            # 使用 Edge channel（需本機有 Edge）
-            launch_kwargs["channel"] = "msedge"
-        # proxy 在 browser.launch 層級（若有）
-        if args.proxy:
-            launch_kwargs["proxy"] = {"server": args.proxy}
-
-        browser = p.chromium.launch(**launch_kwargs)
-
-        context = browser.new_context(
-            locale="zh-TW",
-            timezone_id="Asia/Taipei",
-            viewport={"width": 1280, "height": 900},
-            user_agent=user_agent,
-        )
-
-        # 反自動化痕跡（常見檢查項）
-        context.add_init_script("""
-            Object.defineProperty(navigator, 'webdriver', { get: () => undefined });
-            Object.defineProperty(navigator, 'languages', { get: () => ['zh-TW','zh','en-US','en'] });
-            window.chrome = { runtime: {} };
-            const originalQuery = window.navigator.permissions && window.navigator.permissions.query;
-            if (originalQuery) {
-              window.navigator.permissions.query = (parameters) => (
-                parameters.name === 'notifications' ?
-                  Promise.resolve({ state: Notification.permission }) :
-                  originalQuery(parameters)
-              );
-            }
-        """)
-
-        page = context.new_page()
-        page.set_default_timeout(20000)
-
-        try:
-            log("前往首頁")
-            page.goto(URL, wait_until="domcontentloaded", timeout=60000)
-            human_sleep()
-
-            close_consent(page)
 
-            select_station(page, "出發", args.origin)
-            select_station(page, "到達", args.dest)
-            set_date(page, args.date)
-            set_time(page, args.time)
-            set_adult_count(page, args.adult)
-            set_student_count(page, args.student)
+def query_profile(query: SearchQuery):
+    """有指定 --profile 時回傳 thsrc_browser.ProfileDir，否則 None。"""
+    if not query.profile:
+        return None
+    if query.block_resources:
+        log("注意：--block_resources 會讓瀏覽器停用 HTTP cache，--profile 的磁碟快取將無作用")
+    return ProfileDir(query.profile, query.profile_max_mb, query.profile_wipe_hours)
 
-            # 處理驗證碼
-            log("嘗試解驗證碼")
-            if not handle_captcha(page):
-                raise RuntimeError("無法處理驗證碼")
+def configure_snapshots(args):
+    snapshots.configure(args.snapshot_dir, args.snapshot_rate, args.snapshot_max_mb)
 
-            # 送出並等待 Step2
-            log("送出查詢")
-            ok = submit_and_wait_step2(page, max_submit_retries=6)
-            if not ok:
-                # 儲存除錯資料
-                Path("debug").mkdir(exist_ok=True)
-                page.screenshot(path="debug/failed.png", full_page=True)
-                with open("debug/failed.html", "w", encoding="utf-8") as f:
-                    f.write(page.content())
-                raise RuntimeError("送出查詢失敗或超時")
+def search(query: SearchQuery, linger_sec: float = 0.0, pool=None, trace: RoundTrace = None):
+    """
+    同步入口：跑一次查詢並回傳 Step2 車次（list[TrainRow]）。不寫 CSV；失敗時丟例外（並留下 debug/ 快照）。
+    實際流程只有 thsrc_async 一份；這裡只負責在同步程式裡跑它。
+    pool：thsrc_async.BlockingSearchEngine，給了就借用長駐的瀏覽器，不給則開一個 event loop、跑完即關。
+    trace：thsrc_trace.RoundTrace；由呼叫端 finish()，才能把之後的 save 階段也記進同一輪。
+    """
+    if pool is not None:
+        return pool.search(query, trace=trace, linger_sec=linger_sec)
+    import asyncio
+    from thsrc_async import search_async
+    return asyncio.run(search_async(query, trace=trace, linger_sec=linger_sec))
 
-            log("已進入 Step2，開始擷取車次列表")
-            rows = scrape_trains_on_step2(page)
-            if not rows:
-                log("Step2 無資料，儲存除錯快照")
-                Path("debug").mkdir(exist_ok=True)
-                page.screenshot(path="debug/no_rows.png", full_page=True)
-                with open("debug/no_rows.html", "w", encoding="utf-8") as f:
-                    f.write(page.content())
-            else:
-                save_csv(rows, args.csv)
+# -----------------------------
+# 主流程
+# -----------------------------
+def search_and_save(query: SearchQuery, csv_path: str, store: str = "", pool=None, trace_sink=None,
+                    linger_sec: float = 0.0):
+    """跑一輪查詢並寫入 --csv / --store，整輪（含 save）記成一筆 trace。回傳 rows；失敗丟例外。"""
+    trace = RoundTrace("search", sink=trace_sink, route=f"{query.origin}→{query.dest}",
+                       date=query.date, time=query.time)
+    try:
+        rows = search(query, linger_sec=linger_sec, pool=pool, trace=trace)
+        with trace.span("save") as sp:
+            if rows:
+                diff = save_results(rows, csv_path, store, query)
+                if diff is not None:
+                    sp.set(appeared=len(diff.appeared), disappeared=len(diff.disappeared))
+    except Exception as e:
+        trace.finish("error", reason=str(e))
+        raise
+    trace.finish("ok" if rows else "no_rows", rows=len(rows))
+    return rows
 
-            log("完成")
-            time.sleep(1.2)  # 保留觀察
-        except Exception as e:
-            log(f"發生例外：{e}")
-            # 例外時也輸出一次快照
-            try:
-                Path("debug").mkdir(exist_ok=True)
-                page.screenshot(path="debug/exception.png", full_page=True)
-                with open("debug/exception.html", "w", encoding="utf-8") as f:
-                    f.write(page.content())
-            except Exception:
-                pass
-            sys.exit(1)
-        finally:
-            context.close()
-            browser.close()
+def main():
+    # CLI 只是 asyncio 引擎（thsrc_async）的薄包裝：單一查詢 = 一個 event loop 跑一頁
+    query, args = parse_query()
+    configure_snapshots(args)
+    sink = open_sink(args.trace)
+    dog = None
+    if args.watchdog_sec > 0:
+        from thsrc_watchdog import Watchdog
+        dog = Watchdog(stall_sec=args.watchdog_sec, sink=sink).start()
+    try:
+        search_and_save(query, args.csv, args.store, trace_sink=sink, linger_sec=1.2)
+        log("完成")
+    except Exception as e:
+        log(f"發生例外：{e}")
+        sys.exit(1)
+    finally:
+        if dog is not None:
+            dog.close()
 
 if __name__ == "__main__":
     main()
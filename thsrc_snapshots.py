@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# thsrc_snapshots.py
+# 失敗時的除錯快照（HTML + 截圖），取代每次都同步寫 debug/{failed,no_rows,exception}.* 的做法：
+#   - 抽樣：只有 rate 比例的失敗會拍（網站狀況不好時不會每輪都付出截圖成本）
+#   - 去重：HTML 正規化（數字一律換成 0）後取雜湊，和已存過的一樣就不再存
+#   - 背景寫檔：HTML 以 gzip 壓縮、截圖用 JPEG，由背景執行緒寫出；佇列滿了就丟棄，不阻塞查詢
+#   - 環狀目錄：目錄總大小超過 max_mb 時從最舊的檔刪起
+#   - 檔名帶時間與雜湊（20251020-150102_failed_3fa2c1d0.html.gz），失敗歷史不再互相覆蓋
+#
+# 用法：
+#   import thsrc_snapshots as snapshots
+#   snapshots.configure(directory="debug", rate=0.2, max_mb=50)
+#   snapshots.capture(page, "failed")             # playwright.sync_api
+#   await snapshots.capture_async(page, "failed") # playwright.async_api
+#
+# 需求：只用標準函式庫。
+
+import atexit
+import gzip
+import hashlib
+import queue
+import random
+import re
+import threading
+from datetime import datetime
+from pathlib import Path
+
+def log(msg: str):
+    ts = datetime.now().strftime("%H:%M:%S")
+    print(f"[{ts}] {msg}")
+
+_DIGITS_RE = re.compile(r"\d+")
+_NAME_RE = re.compile(r"_([0-9a-f]{8})\.html\.gz$")
+# 本模組寫出的檔名（見 _write）；_trim 只刪這些，目錄裡的其他檔案不動
+_OWN_RE = re.compile(r"^\d{8}-\d{6}_.+_[0-9a-f]{8}\.(html\.gz|jpg)$")
+
+def page_hash(html: str) -> str:
+    """HTML 的雜湊；數字（時間戳、session id、驗證碼網址參數等）先換成 0，讓同一種錯誤頁得到同一個雜湊。"""
+    return hashlib.sha1(_DIGITS_RE.sub("0", html).encode("utf-8", "replace")).hexdigest()[:8]
+
+class SnapshotStore:
+    def __init__(self, directory: str = "debug", rate: float = 1.0, max_mb: float = 50,
+                 screenshot: bool = True, full_page: bool = False, queue_size: int = 16):
+        self.dir = Path(directory)
+        self.rate = rate
+        self.max_mb = max_mb
+        self.screenshot = screenshot
+        self.full_page = full_page
+        self.seen = set()
+        self.taken = self.sampled_out = self.duplicates = self.dropped = 0
+        if self.dir.exists():
+            for p in self.dir.iterdir():
+                m = _NAME_RE.search(p.name)
+                if m:
+                    self.seen.add(m.group(1))
+        self.q = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+        self._thread.start()
+
+    # ---- 擷取 ----
+    def _sampled(self) -> bool:
+        if self.rate >= 1 or random.random() < self.rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+    def _accept(self, html: str):
+        """回傳雜湊；已存過同樣的頁面回傳 None。"""
+        h = page_hash(html)
+        if h in self.seen:
+            self.duplicates += 1
+            return None
+        self.seen.add(h)
+        return h
+
+    def _submit(self, name: str, h: str, html: str, image: bytes):
+        try:
+            self.q.put_nowait((name, h, html, image))
+            self.taken += 1
+        except queue.Full:
+            self.dropped += 1
+            self.seen.discard(h)
+
+    def capture(self, page, name: str) -> bool:
+        """sync 版：抽中且不是重複頁面時才截圖並排入背景寫檔。回傳是否排入。"""
+        if not self._sampled():
+            return False
+        html = page.content()
+        h = self._accept(html)
+        if h is None:
+            return False
+        image = None
+        if self.screenshot:
+            try:
+                image = page.screenshot(full_page=self.full_page, type="jpeg", quality=60)
+            except Exception:
+                pass
+        self._submit(name, h, html, image)
+        return True
+
+    async def capture_async(self, page, name: str) -> bool:
+        """async 版（playwright.async_api 的 page）。"""
+        if not self._sampled():
+            return False
+        html = await page.content()
+        h = self._accept(html)
+        if h is None:
+            return False
+        image = None
+        if self.screenshot:
+            try:
+                image = await page.screenshot(full_page=self.full_page, type="jpeg", quality=60)
+            except Exception:
+                pass
+        self._submit(name, h, html, image)
+        return True
+
+    # ---- 背景寫檔 ----
+    def _run(self):
+        while True:
+            item = self.q.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                log(f"寫入除錯快照失敗：{e}")
+                self.seen.discard(item[1])
+            try:
+                self._trim()
+            except Exception as e:
+                log(f"清理除錯快照失敗：{e}")
+
+    def _write(self, name: str, h: str, html: str, image: bytes):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        stem = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{name}_{h}"
+        with gzip.open(self.dir / f"{stem}.html.gz", "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(html)
+        if image:
+            (self.dir / f"{stem}.jpg").write_bytes(image)
+        log(f"已存除錯快照 {self.dir / stem}.*")
+
+    def _trim(self):
+        """
+        本模組寫出的快照總大小超過 max_mb 時由舊到新刪除；目錄裡的其他檔案不算也不刪。
+        刪掉的 HTML 其雜湊一併移出 seen：seen 只記目錄裡還在的頁面，不會隨執行時間無限增長，
+        之後再遇到同樣的頁面也會重新存一份。
+        """
+        if not self.max_mb:
+            return
+        files = []
+        for p in self.dir.iterdir():
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            if p.is_file() and _OWN_RE.match(p.name):
+                files.append((st.st_mtime, st.st_size, p))
+        total = sum(size for _, size, _ in files)
+        limit = self.max_mb * 1024 * 1024
+        for _, size, p in sorted(files, key=lambda x: x[0]):
+            if total <= limit:
+                break
+            try:
+                p.unlink()
+                total -= size
+            except OSError:
+                continue
+            m = _NAME_RE.search(p.name)
+            if m:
+                self.seen.discard(m.group(1))
+
+    def close(self, timeout: float = 10):
+        """寫完佇列中的快照後結束背景執行緒。"""
+        if self._thread.is_alive():
+            self.q.put(None)
+            self._thread.join(timeout)
+
+# -----------------------------
+# 行程內共用的預設 store
+# -----------------------------
+_store = None
+_lock = threading.Lock()
+
+def configure(directory: str = "debug", rate: float = 1.0, max_mb: float = 50, **kw) -> SnapshotStore:
+    """設定（或改設定）預設 store；參數沒變時沿用現有的。"""
+    global _store
+    with _lock:
+        cur = _store
+        if cur is not None and (str(cur.dir), cur.rate, cur.max_mb) == (str(Path(directory)), rate, max_mb):
+            return cur
+        _store = SnapshotStore(directory, rate, max_mb, **kw)
+    if cur is not None:
+        cur.close()
+    return _store
+
+def default_store() -> SnapshotStore:
+    return _store or configure()
+
+def capture(page, name: str) -> bool:
+    return default_store().capture(page, name)
+
+async def capture_async(page, name: str) -> bool:
+    return await default_store().capture_async(page, name)
+
+@atexit.register
+def close():
+    if _store is not None:
+        _store.close()
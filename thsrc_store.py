@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# thsrc_store.py
+# 查詢結果的 SQLite 儲存（取代只會越長越大的 out.csv）。
+#
+# - 表 trains：欄位同 CSV，另加 scraped_at（寫入時間）；(date, code, discount_text, scraped_at) 唯一
+# - WAL 模式、每批資料一個 transaction
+# - thsrc_watch 以自增 id 當游標，只撈「上一輪之後」新寫入且命中關鍵字的列
+#
+# 匯入舊的 CSV 歷史（一次性）：
+#   python thsrc_store.py import out.csv --db history.db
+#
+# 需求：內建 sqlite3 即可，無需額外套件。
+
+import argparse
+import csv
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from thsrc_rows import FIELDS, TrainRow, hhmm_to_min
+from thsrc_rules import compile_rules
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trains (
+    id               INTEGER PRIMARY KEY AUTOINCREMENT,
+    date             TEXT NOT NULL,
+    code             TEXT NOT NULL,
+    departure        TEXT,
+    arrival          TEXT,
+    estimated        TEXT,
+    student_discount INTEGER,
+    discount_text    TEXT NOT NULL DEFAULT '',
+    selected         INTEGER,
+    scraped_at       TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_trains_key ON trains(date, code, discount_text, scraped_at);
+CREATE INDEX IF NOT EXISTS ix_trains_scraped_at ON trains(scraped_at);
+"""
+
+def log(msg: str):
+    ts = datetime.now().strftime("%H:%M:%S")
+    print(f"[{ts}] {msg}")
+
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+def _truthy(v) -> int:
+    if isinstance(v, str):
+        return 1 if v.strip().lower() in ("true", "1", "yes") else 0
+    return 1 if v else 0
+
+class SqliteStore:
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def insert_rows(self, rows, scraped_at: str = None, batch_size: int = 500) -> int:
+        """寫入多列（thsrc_rows.TrainRow 或欄位同 CSV 的 dict），回傳實際新增筆數；重複的 key 直接略過。"""
+        scraped_at = scraped_at or now_iso()
+        sql = (
+            "INSERT OR IGNORE INTO trains (date, code, departure, arrival, estimated, "
+            "student_discount, discount_text, selected, scraped_at) VALUES (?,?,?,?,?,?,?,?,?)"
+        )
+        before = self.conn.total_changes
+        buf = []
+        with self.conn:
+            for r in rows:
+                if isinstance(r, TrainRow):
+                    r = r.to_dict()
+                buf.append((
+                    str(r.get("date", "")).strip(),
+                    str(r.get("code", "")).strip(),
+                    str(r.get("departure", "")).strip(),
+                    str(r.get("arrival", "")).strip(),
+                    str(r.get("estimated", "")).strip(),
+                    _truthy(r.get("student_discount")),
+                    str(r.get("discount_text", "") or "").strip(),
+                    _truthy(r.get("selected")),
+                    r.get("scraped_at") or scraped_at,
+                ))
+                if len(buf) >= batch_size:
+                    self.conn.executemany(sql, buf)
+                    buf = []
+            if buf:
+                self.conn.executemany(sql, buf)
+        return self.conn.total_changes - before
+
+    def hits_since(self, after_id: int, keyword: str = ""):
+        """
+        回傳 (rows, last_id)：id > after_id 且 discount_text 含 keyword 的列（dict，欄位同 CSV + scraped_at）。
+        走主鍵範圍掃描，不必看舊資料；last_id 是目前表中最大的 id，當下一輪的游標。
+        """
+        cur = self.conn.execute(
+            "SELECT * FROM trains WHERE id > ? AND instr(discount_text, ?) > 0 ORDER BY id",
+            (after_id, keyword),
+        )
+        rows = [self._to_dict(r) for r in cur]
+        last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM trains").fetchone()[0]
+        return rows, max(after_id, last_id)
+
+    def hit_hours(self, rule: str = ""):
+        """
+        依寫入時間的小時統計：回傳 {hour: (rounds, hit_rounds)}。
+        一輪 = 同一個 scraped_at；hit_rounds 為該輪至少一列折扣符合 rule（thsrc_rules 語法，空字串 = 任何列）的輪數。
+        規則只對不重複的折扣文字各比對一次，再交給 SQL 依小時彙總。
+        """
+        texts = [t for (t,) in self.conn.execute("SELECT DISTINCT discount_text FROM trains")
+                 if not rule or compile_rules(rule).test_text(t)]
+        hit = f"discount_text IN ({','.join('?' * len(texts))})" if texts else "0"
+        cur = self.conn.execute(
+            "SELECT CAST(strftime('%H', scraped_at) AS INTEGER) AS h, COUNT(DISTINCT scraped_at), "
+            f"COUNT(DISTINCT CASE WHEN {hit} THEN scraped_at END) "
+            "FROM trains GROUP BY h",
+            texts,
+        )
+        return {h: (n, hit) for h, n, hit in cur if h is not None}
+
+    @staticmethod
+    def _to_dict(r) -> dict:
+        d = {k: r[k] for k in FIELDS}
+        d["student_discount"] = bool(d["student_discount"])
+        d["selected"] = bool(d["selected"])
+        d["scraped_at"] = r["scraped_at"]
+        return d
+
+    def close(self):
+        self.conn.close()
+
+def parse_store_spec(spec: str):
+    """
+    'sqlite:path.db' → ('sqlite', 'path.db')；'diff:path.db' → ('diff', 'path.db')（thsrc_diff 差異儲存）；
+    'csv:out.csv' 或不帶前綴 → ('csv', path)。
+    """
+    kind, sep, path = spec.partition(":")
+    if sep and kind in ("sqlite", "diff", "csv"):
+        return kind, path
+    return "csv", spec
+
+def csv_rounds(rows):
+    """
+    CSV 沒有寫入時間，切輪的判斷同 thsrc_analytics：同一輪的列依出發時間排序，
+    因此「出發時間回頭、同車次重複或換日」即為新的一輪。逐列產生 (輪次編號, row)，從 0 起算。
+    """
+    n, prev = 0, None
+    for r in rows:
+        cur = (str(r.get("date", "")).strip(), str(r.get("code", "")).strip(), hhmm_to_min(r.get("departure", "")))
+        if prev is not None and (cur[2] < prev[2] or cur[1] == prev[1] or cur[0] != prev[0]):
+            n += 1
+        prev = cur
+        yield n, r
+
+def import_csv(csv_path: str, store: SqliteStore, scraped_at: str = None) -> int:
+    """
+    把舊的 out.csv 歷史匯入 SQLite。CSV 沒有寫入時間：以 csv_rounds 切出每一輪，
+    最後一輪記為 scraped_at（預設檔案 mtime），之前每輪依序早一秒，讓每輪各自成為一筆 (date, code, discount_text, scraped_at)，
+    不會被唯一索引併成一筆。這些時間只用來區分輪次與先後，不是實際查詢時間。
+    同一個檔案重複匯入得到相同的時間，不會重複寫入。
+    """
+    if scraped_at is None:
+        scraped_at = datetime.fromtimestamp(os.path.getmtime(csv_path)).isoformat(timespec="seconds")
+    last = datetime.fromisoformat(scraped_at)
+    # 先數輪數（串流，不把整個檔案留在記憶體），再逐列寫入
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        rounds = 1 + max((n for n, _ in csv_rounds(csv.DictReader(f))), default=0)
+
+    def stamped():
+        with open(csv_path, newline="", encoding="utf-8-sig") as f:
+            for n, r in csv_rounds(csv.DictReader(f)):
+                r["scraped_at"] = (last - timedelta(seconds=rounds - 1 - n)).isoformat(timespec="seconds")
+                yield r
+
+    return store.insert_rows(stamped(), scraped_at=scraped_at)
+
+def main():
+    ap = argparse.ArgumentParser(description="THSR 查詢結果 SQLite 工具")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    imp = sub.add_parser("import", help="把既有 CSV 歷史匯入 SQLite")
+    imp.add_argument("csv", help="來源 CSV，例如 out.csv")
+    imp.add_argument("--db", required=True, help="目標 SQLite 檔，例如 history.db")
+    imp.add_argument("--scraped_at", default=None, help="最後一輪的寫入時間（ISO 格式）；預設取 CSV 檔的修改時間")
+    args = ap.parse_args()
+
+    store = SqliteStore(args.db)
+    try:
+        n = import_csv(args.csv, store, args.scraped_at)
+        log(f"已從 {args.csv} 匯入 {n} 筆到 {args.db}")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# thsrc_trace.py
+# 每一輪查詢 / 訂位的逐階段計時（span）。一輪結束時寫成一行 JSON 到指定的 sink。
+#
+# 一筆紀錄長這樣：
+#   {"round_id": "...", "kind": "search", "started_at": "2025-10-20T15:00:01", "duration_ms": 41234.5,
+#    "outcome": "ok", "reason": "", "attrs": {...},
+#    "spans": [{"name": "goto", "duration_ms": 812.3, "retries": 0, "outcome": "ok"}, ...]}
+#
+# 用法：
+#   trace = RoundTrace("search", sink=open_sink("trace.jsonl"), route="台北→台中")
+#   with trace.span("captcha") as sp:
+#       ok = handle_captcha(page, span=sp)      # 函式內每次重試呼叫 sp.retry()
+#   trace.finish("ok")
+#
+# sink 為 None 時照樣計時，只是不輸出。
+#
+# 心跳：每輪開始、span 開始 / 結束、sp.retry()、sp.beat() 與 finish() 都會通知 add_listener() 註冊的監聽者
+# listener(trace, event, stage)，event 為 start / span / retry / beat / span_end / finish（finish 時 stage 為 outcome）。
+# thsrc_watchdog 靠它判斷一輪是否卡住；階段內有好幾個長等待時，在等待之間呼叫 sp.beat() 回報進度。
+
+import json
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+_listeners = []
+
+def add_listener(fn):
+    if fn not in _listeners:
+        _listeners.append(fn)
+
+def remove_listener(fn):
+    if fn in _listeners:
+        _listeners.remove(fn)
+
+class Span:
+    __slots__ = ("name", "start", "duration_ms", "retries", "outcome", "attrs", "trace")
+
+    def __init__(self, name: str, trace=None):
+        self.trace = trace
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration_ms = 0.0
+        self.retries = 0
+        self.outcome = "ok"
+        self.attrs = {}
+
+    def retry(self, n: int = 1):
+        self.retries += n
+        if self.trace is not None:
+            self.trace.beat("retry", self.name)
+
+    def beat(self):
+        """回報本階段仍有進度（不算重試）。"""
+        if self.trace is not None:
+            self.trace.beat("beat", self.name)
+
+    def fail(self, outcome: str = "fail"):
+        """函式以回傳值（而非例外）表示失敗時，用它標記 span 結果。"""
+        self.outcome = outcome
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> dict:
+        d = {"name": self.name, "duration_ms": round(self.duration_ms, 1),
+             "retries": self.retries, "outcome": self.outcome}
+        if self.attrs:
+            d.update(self.attrs)
+        return d
+
+class RoundTrace:
+    def __init__(self, kind: str, sink=None, **attrs):
+        self.round_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.sink = sink
+        self.attrs = attrs
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.finished = False
+        self.beat("start", "")
+
+    def beat(self, event: str, stage: str):
+        """通知心跳監聽者；監聽者出錯不影響本輪。"""
+        for fn in list(_listeners):
+            try:
+                fn(self, event, stage)
+            except Exception:
+                pass
+
+    @contextmanager
+    def span(self, name: str):
+        sp = Span(name, self)
+        self.spans.append(sp)
+        self.beat("span", name)
+        try:
+            yield sp
+        except BaseException as e:
+            sp.outcome = f"error:{type(e).__name__}"
+            raise
+        finally:
+            sp.duration_ms = (time.perf_counter() - sp.start) * 1000
+            self.beat("span_end", name)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, outcome: str = "ok", reason: str = "", **attrs) -> dict:
+        """結束本輪並寫出紀錄（重複呼叫只寫第一次）。"""
+        if self.finished:
+            return {}
+        self.finished = True
+        self.attrs.update(attrs)
+        rec = {
+            "round_id": self.round_id,
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "duration_ms": round((time.perf_counter() - self.t0) * 1000, 1),
+            "outcome": outcome,
+            "reason": reason,
+            "attrs": self.attrs,
+            "spans": [sp.to_dict() for sp in self.spans],
+        }
+        self.beat("finish", outcome)
+        if self.sink is not None:
+            self.sink.write(rec)
+        return rec
+
+class JsonlSink:
+    """把紀錄逐行追加到 JSON Lines 檔；path 為 '-' 時寫到 stdout。可跨執行緒共用。"""
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        if path != "-":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, rec: dict):
+        line = json.dumps(rec, ensure_ascii=False, default=str)
+        with self.lock:
+            if self.path == "-":
+                sys.stdout.write(line + "\n")
+                sys.stdout.flush()
+            else:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+
+def open_sink(spec: str):
+    """空字串 → None（不輸出）；'-' → stdout；其餘視為 JSON Lines 檔路徑。"""
+    if not spec:
+        return None
+    return JsonlSink(spec)
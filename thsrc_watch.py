@@ -1,44 +1,116 @@
 # -*- coding: utf-8 -*-
-# 監看 out.csv 的 discount_text 是否含「學生5折」，若有就寄 Gmail。
+# 監看 out.csv 的折扣是否符合 --rule（預設「學生88折」；可寫 學生<=75折、早鳥 之類的規則，見 thsrc_rules.py），若有就寄 Gmail。
 # 會每隔 3~5 分鐘重跑你的抓票腳本一次（帶隨機抖動），直到手動停止或到達指定時間。
 #
-# 需求：內建 smtplib / email 即可，無需額外套件。
+# 需求：內建 smtplib / email 即可，無需額外套件（寄信見 thsrc_notify.py）。
 #
 # 範例：
 # python thsrc_watch.py --scraper "python thsrc_search_v2_plus.py --origin 台北 --dest 台中 --date 2025-10-20 --time 15:00 --adult 0 --student 1 --csv out.csv --engine edge"  --csv out.csv   --sender gogle130355710@gmail.com  --app_password xyqrcfauievkzqap  --to gogle130355710@gmail.com --until "2025-10-15 16:10"
 
 import argparse
 import csv
+import hashlib
+import io
+import json
 import os
 import random
-import smtplib
+import shlex
 import subprocess
 import sys
 import time
-from datetime import datetime
-from email.message import EmailMessage
+from datetime import date, datetime
 from pathlib import Path
 
+from thsrc_rows import TrainRow, as_row, duration_text, infer_travel_date, min_to_hhmm
+from thsrc_rules import RuleSet, compile_rules
+
 KEYWORD = "學生88折"
 
 def log(msg: str):
     print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
 
-def load_notified(state_path: str):
-    if not os.path.exists(state_path):
-        return set()
-    try:
-        with open(state_path, "r", encoding="utf-8") as f:
-            lines = [ln.strip() for ln in f if ln.strip()]
-        return set(lines)
-    except:
-        return set()
-
-def save_notified(state_path: str, keys_set: set):
-    Path(state_path).parent.mkdir(parents=True, exist_ok=True)
-    with open(state_path, "w", encoding="utf-8") as f:
-        for k in sorted(keys_set):
-            f.write(k + "\n")
+class NotifiedLog:
+    """
+    已通知 key 的記錄檔（一行一筆「記錄日期<TAB>key」，key 格式同 make_key）。
+    - 新 key 只追加到檔尾，不再每次整檔重寫
+    - 乘車日期（key 第一欄，只有 MM/DD）以記錄當天為準推回完整日期，過了就自動過期，啟動時只載入仍有效的 key；
+      不以「今天」推算，否則半年前記下的舊 key 會被當成明年的車次而永遠不過期
+    - 舊格式（只有 key、沒有記錄日期）的行以檔案修改日期當記錄日期，載入時立刻改寫成新格式
+    - 檔案行數超過有效 key 數兩倍（且多於 COMPACT_MIN 行）時，原子地改寫成只剩有效 key
+    """
+    COMPACT_MIN = 200
+
+    def __init__(self, path: str):
+        self.path = path
+        self.keys = {}          # key -> 記錄日期
+        self.lines = 0
+        has_legacy = False
+        if os.path.exists(path):
+            try:
+                legacy = date.fromtimestamp(os.path.getmtime(path))
+                with open(path, "r", encoding="utf-8") as f:
+                    for ln in f:
+                        ln = ln.strip()
+                        if not ln:
+                            continue
+                        self.lines += 1
+                        day, sep, k = ln.partition("\t")
+                        recorded = date.fromisoformat(day) if sep else legacy
+                        has_legacy = has_legacy or not sep
+                        k = k if sep else ln
+                        if not self._expired(k, recorded):
+                            self.keys[k] = recorded
+            except Exception:
+                self.keys, self.lines = {}, 0
+        # 舊格式的行立刻改寫成帶記錄日期：否則 add_many 每輪都會更新 mtime，下次啟動又被當成新的記錄日期
+        if has_legacy or self.lines > len(self.keys):
+            self.compact()
+
+    @staticmethod
+    def _expired(key: str, recorded: date, today: date = None) -> bool:
+        d = infer_travel_date(key.split("|", 1)[0], recorded)
+        return d is not None and d < (today or date.today())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add_many(self, keys):
+        new = [k for k in keys if k not in self.keys]
+        if not new:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        today = date.today()
+        with open(self.path, "a", encoding="utf-8") as f:
+            for k in new:
+                f.write(f"{today.isoformat()}\t{k}\n")
+        self.keys.update(dict.fromkeys(new, today))
+        self.lines += len(new)
+        self._maybe_compact()
+
+    def expire(self):
+        """丟掉乘車日期已過的 key（每輪呼叫一次即可）。"""
+        today = date.today()
+        dead = [k for k, recorded in self.keys.items() if self._expired(k, recorded, today)]
+        if dead:
+            for k in dead:
+                del self.keys[k]
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if self.lines > max(self.COMPACT_MIN, 2 * len(self.keys)):
+            self.compact()
+
+    def compact(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for k in sorted(self.keys):
+                f.write(f"{self.keys[k].isoformat()}\t{k}\n")
+        os.replace(tmp, self.path)
+        self.lines = len(self.keys)
 
 def run_scraper(cmd: str) -> int:
     log(f"執行抓票：{cmd}")
@@ -49,53 +121,213 @@ def run_scraper(cmd: str) -> int:
         log(f"抓票腳本執行失敗：{e}")
         return 1
 
-def read_hits(csv_path: str, keyword: str):
-    """回傳本次偵測命中的列（list of dict）"""
-    rows = []
+def scraper_argv(cmd: str):
+    """
+    從 --scraper 字串取出 thsrc_search_v2_plus.py 之後的參數；
+    指令不是呼叫 thsrc_search_v2_plus.py 時回傳 None（只能走 subprocess）。
+    """
+    try:
+        tokens = shlex.split(cmd, posix=(os.name != "nt"))
+    except ValueError:
+        return None
+    for i, tok in enumerate(tokens):
+        if Path(tok.strip('"')).name == "thsrc_search_v2_plus.py":
+            return [t.strip('"') for t in tokens[i + 1:]]
+    return None
+
+def scraper_departure(argv):
+    """從搜尋腳本參數取出 --date / --time 組成出發時間（datetime）；取不到回傳 None。"""
+    if not argv:
+        return None
+    ap = argparse.ArgumentParser(add_help=False)
+    ap.add_argument("--date", default="")
+    ap.add_argument("--time", default="")
+    known, _ = ap.parse_known_args(argv)
+    try:
+        return datetime.strptime(f"{known.date} {known.time}", "%Y-%m-%d %H:%M")
+    except ValueError:
+        return None
+
+def make_policy(args):
+    """--adaptive 時回傳 thsrc_scheduler.AdaptivePolicy（歷史取 --history，未指定則用 --store 的 SQLite）；否則 None。"""
+    if not args.adaptive:
+        return None
+    from thsrc_scheduler import AdaptivePolicy
+    history = args.history
+    if not history and args.store:
+        from thsrc_store import parse_store_spec
+        kind, path = parse_store_spec(args.store)
+        history = path if kind == "sqlite" else ""
+    return AdaptivePolicy(history, backoff=args.backoff)
+
+def make_pool(args, sessions: int = 1):
+    """inprocess / 多查詢模式共用的長駐查詢引擎（thsrc_async.BlockingSearchEngine），瀏覽器跨輪重複使用。"""
+    from thsrc_async import BlockingSearchEngine
+    # --pool_rounds 0 = 每輪重開
+    return BlockingSearchEngine(max_rounds=args.pool_rounds or 1, max_rss_mb=args.pool_max_mb, max_browsers=sessions)
+
+def make_watchdog(args, pool, trace_sink):
+    """--watchdog_sec > 0 時啟動 thsrc_watchdog（只結束 pool 中使用中的瀏覽器）；否則 None。"""
+    if args.watchdog_sec <= 0:
+        return None
+    from thsrc_watchdog import Watchdog
+    return Watchdog.for_pool(pool, stall_sec=args.watchdog_sec, sink=trace_sink).start()
+
+def run_inprocess(argv, pool=None, trace_sink=None):
+    """
+    直接在本 process 呼叫 thsrc_search_v2_plus.search()，省掉 shell / 新直譯器 / 重複 import。
+    pool 為 thsrc_async.BlockingSearchEngine（make_pool），讓瀏覽器跨輪重複使用；trace_sink 為逐階段計時輸出。
+    結果照舊寫到 --csv / --store（保留歷史），回傳本輪擷取到的列；失敗回傳 None。
+    """
+    import thsrc_search_v2_plus as scraper
+    try:
+        query, sargs = scraper.parse_query(argv)
+    except SystemExit:
+        log("無法解析 --scraper 參數")
+        return None
+    scraper.configure_snapshots(sargs)
+    log(f"執行抓票（in-process）：{query.origin}→{query.dest} {query.date} {query.time}")
+    try:
+        return scraper.search_and_save(query, sargs.csv, sargs.store, pool=pool, trace_sink=trace_sink or scraper.open_sink(sargs.trace))
+    except Exception as e:
+        log(f"抓票失敗：{e}")
+        return None
+
+def _rules(rule) -> RuleSet:
+    return compile_rules(rule) if isinstance(rule, str) else rule
+
+def filter_hits(rows, rule):
+    """rows 為 thsrc_rows.TrainRow；rule 為規則字串（thsrc_rules 語法）或已編好的 RuleSet。"""
+    rules = _rules(rule)
+    return [row for row in rows if rules.test(row)]
+
+def hits_from_dicts(dicts, rule):
+    """CSV / SQLite 讀出的 dict 列：先以原始文字比對規則，只有命中的列才轉成 TrainRow。"""
+    rules = _rules(rule)
+    return [TrainRow.from_dict(d) for d in dicts if rules.test_text(d.get("discount_text") or "")]
+
+class CsvTail:
+    """
+    增量讀取只會追加的 CSV：記住已處理到的 byte offset（存在 state 目錄的 csv_offset.json），
+    每輪只解析新追加的完整列。檔案被截短、覆寫或輪替時自動從頭重讀。
+    read_new() 之後要 commit() 才會推進 offset；未 commit 時下一輪會重讀同一段（例如寄信失敗）。
+    """
+    FINGERPRINT_BYTES = 64
+
+    def __init__(self, csv_path: str, state_path: str):
+        self.csv_path = csv_path
+        self.state_path = state_path
+        self.key = os.path.abspath(csv_path)
+        self._all = self._load_all()
+        self.state = self._all.get(self.key) or {}
+        self._pending = None
+
+    def _load_all(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _fingerprint(self, f, offset: int) -> str:
+        # offset 前最後一小段內容；檔案被換掉時這段通常會不同
+        start = max(0, offset - self.FINGERPRINT_BYTES)
+        f.seek(start)
+        return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+    def read_new(self):
+        """回傳自上次 commit 以來新追加的列（list of dict）。"""
+        if not os.path.exists(self.csv_path):
+            log(f"找不到 CSV：{self.csv_path}")
+            return []
+        st = os.stat(self.csv_path)
+        with open(self.csv_path, "rb") as f:
+            header = f.readline()
+            if not header.endswith(b"\n"):
+                return []
+            data_start = len(header)
+            offset = int(self.state.get("offset", 0))
+            rotated = (
+                offset < data_start
+                or st.st_size < offset
+                or (self.state.get("ino") and st.st_ino and self.state["ino"] != st.st_ino)
+                or self.state.get("fingerprint") != self._fingerprint(f, offset)
+            )
+            if rotated:
+                if offset:
+                    log("CSV 疑似被截短或輪替，從頭重新讀取")
+                offset = data_start
+            f.seek(offset)
+            chunk = f.read()
+
+        end = chunk.rfind(b"\n")  # 只取完整的列，寫到一半的留給下一輪
+        if end < 0:
+            self._pending = None
+            return []
+        fieldnames = next(csv.reader([header.decode("utf-8-sig")]))
+        rows = list(csv.DictReader(io.StringIO(chunk[:end + 1].decode("utf-8")), fieldnames=fieldnames))
+
+        new_offset = offset + end + 1
+        with open(self.csv_path, "rb") as f:
+            fp = self._fingerprint(f, new_offset)
+        self._pending = {"offset": new_offset, "ino": st.st_ino, "fingerprint": fp}
+        return rows
+
+    def commit(self):
+        if not self._pending:
+            return
+        self.state = self._pending
+        self._pending = None
+        self._all[self.key] = self.state
+        Path(self.state_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._all, f)
+        os.replace(tmp, self.state_path)
+
+def read_hits(csv_path: str, rule, tail: CsvTail = None):
+    """回傳本次偵測命中的列（list[TrainRow]）；給 tail 時只看上次 commit 之後新追加的列"""
+    if tail is not None:
+        return hits_from_dicts(tail.read_new(), rule)
     if not os.path.exists(csv_path):
         log(f"找不到 CSV：{csv_path}")
-        return rows
+        return []
     with open(csv_path, newline="", encoding="utf-8-sig") as f:
-        r = csv.DictReader(f)
-        for row in r:
-            text = (row.get("discount_text") or "").strip()
-            if keyword in text:
-                rows.append(row)
-    return rows
-
-def make_key(row: dict) -> str:
-    # 用幾個欄位組成唯一 key，避免重複寄
-    return "|".join([
-        row.get("date","").strip(),
-        row.get("code","").strip(),
-        row.get("departure","").strip(),
-        row.get("arrival","").strip(),
-        row.get("discount_text","").strip(),
-    ])
-
-def send_gmail_smtp(sender: str, app_password: str, to: str, subject: str, html_body: str, text_body: str = None):
-    msg = EmailMessage()
-    msg["From"] = sender
-    msg["To"] = to
-    msg["Subject"] = subject
-
-    # 純文字 & HTML 兩種都放，增加相容性
-    text_body = text_body or "See HTML content."
-    msg.set_content(text_body)
-    msg.add_alternative(html_body, subtype="html")
-
-    with smtplib.SMTP("smtp.gmail.com", 587) as smtp:
-        smtp.ehlo()
-        smtp.starttls()
-        smtp.login(sender, app_password)
-        smtp.send_message(msg)
+        return hits_from_dicts(csv.DictReader(f), rule)
+
+def make_key(row) -> str:
+    # 用幾個欄位組成唯一 key，避免重複寄（格式見 TrainRow.key）
+    return as_row(row).key()
+
+def make_notifier(args):
+    """
+    依參數建立背景寄信的 thsrc_notify.NotifyWorker：SMTP 連線跨輪保持、--digest_sec 內的通知合併成一封，
+    寄送失敗的信存進 --mail_queue 之後重寄。確定寄出的 key 由主迴圈以 drain() 取回再寫入 notified。
+    """
+    from thsrc_notify import Notifier, NotifyWorker, SmtpConfig, SmtpConnection
+    host, _, port = args.smtp.partition(":")
+    cfg = SmtpConfig(
+        host=host,
+        port=int(port or 587),
+        username="" if args.smtp_plain else args.sender,
+        password="" if args.smtp_plain else args.app_password,
+        starttls=not args.smtp_plain,
+    )
+    queue = args.mail_queue or str(Path(args.state).parent / "mail_queue.jsonl")
+    notifier = Notifier(SmtpConnection(cfg), args.sender, retry_path=queue, digest_sec=args.digest_sec)
+    if len(notifier.retry):
+        log(f"重寄佇列中有 {len(notifier.retry)} 封待寄信")
+    return NotifyWorker(notifier, maxsize=args.mail_backlog)
 
 def format_email(rows):
     # 產生 email 內容
     lines_txt = []
     lines_html = []
     for r in rows:
-        line = f"{r.get('date')}  車次 {r.get('code')}  {r.get('departure')} → {r.get('arrival')}  車程 {r.get('estimated')}  折扣:{r.get('discount_text')}"
+        line = (f"{r.mmdd}  車次 {r.code}  {min_to_hhmm(r.departure)} → {min_to_hhmm(r.arrival)}  "
+                f"車程 {duration_text(r.duration)}  折扣:{r.discount_text}")
         lines_txt.append(line)
         lines_html.append(f"<li>{line}</li>")
     text_body = "偵測到學生5折的車次：\n" + "\n".join(lines_txt)
@@ -108,6 +340,139 @@ def format_email(rows):
     """
     return text_body, html_body
 
+def notify_new_hits(rows, notified: NotifiedLog, notifier, to: str, keyword: str, key_suffix: str = "") -> bool:
+    """
+    去掉已通知過（或已排入、尚未確定寄出）的列後交給 notifier（NotifyWorker）寄一封通知信，不等寄出即返回。
+    回傳是否成功排入；信確定寄出後主迴圈才以 notifier.drain() 把 key 寫入 notified。
+    key_suffix：多查詢模式下加上查詢 id，讓不同訂閱各自去重。
+    """
+    pending = notifier.pending_keys()
+    new_rows = []
+    new_keys = []
+    for r in rows:
+        k = make_key(r) + key_suffix
+        if k not in notified and k not in pending:
+            new_rows.append(r)
+            new_keys.append(k)
+    if not new_rows:
+        return True
+
+    text_body, html_body = format_email(new_rows)
+    if not notifier.notify(to, f"[THSR] 偵測到 {keyword} 共 {len(new_rows)} 筆", html_body, text_body, keys=new_keys):
+        return False
+    log(f"已排入通知信（{len(new_rows)} 筆）")
+    return True
+
+def compile_job_rules(jobs) -> RuleSet:
+    """所有訂閱的規則編成一份：每列只比對一次，得到它符合哪些訂閱。"""
+    rules = RuleSet()
+    for job in jobs:
+        rules.add(job.id, job.keyword)
+    return rules
+
+def run_multi(args, until_dt, notified: NotifiedLog, notifier):
+    """
+    多查詢模式：從 --queries 讀清單，優先佇列排程，共用最多 --sessions 個瀏覽器 session，
+    並以 --max_per_min 限制全體查詢的總速率。時段重疊的訂閱合併成一次查詢（--coalesce_min）。
+    清單檔改變（或收到 SIGHUP）時熱載入：只重排有變更的查詢，session 與其他查詢的排程不動。
+    """
+    import thsrc_search_v2_plus as scraper
+    from thsrc_reload import ConfigFile, install_sighup
+    from thsrc_scheduler import (RateLimiter, Scheduler, coalesce, fan_out, load_jobs,
+                                 next_deadline, reload_groups, stagger)
+    from thsrc_trace import open_sink
+
+    jobs = load_jobs(args.queries)
+    if not jobs and not args.reload_sec:
+        log("查詢清單是空的。")
+        return
+    rules = compile_job_rules(jobs)
+    groups = coalesce(jobs, args.coalesce_min)
+    sched = Scheduler()
+    for group, due in stagger(groups, time.time(), args.min_sec):
+        sched.add(group, due)
+    config = None
+    if args.reload_sec > 0:
+        config = ConfigFile(args.queries, load_jobs)
+        hup = install_sighup(config)
+        log(f"查詢清單熱載入：每 {args.reload_sec:g} 秒檢查一次{'，或 kill -HUP ' + str(os.getpid()) if hup else ''}")
+    pool = make_pool(args, args.sessions)
+    limiter = RateLimiter(args.max_per_min)
+    trace_sink = open_sink(args.trace)
+    dog = make_watchdog(args, pool, trace_sink)
+    policy = make_policy(args)
+    log(f"多查詢監看：{len(jobs)} 筆訂閱合併為 {len(groups)} 個查詢，"
+        f"瀏覽器上限 {args.sessions}，速率上限每分鐘 {args.max_per_min} 次")
+
+    try:
+        while True:
+            if config is not None:
+                new_jobs = config.poll()
+                if new_jobs is not None:
+                    rules = compile_job_rules(new_jobs)
+                    kept, added, removed = reload_groups(sched, new_jobs, args.coalesce_min, args.min_sec)
+                    log(f"已重新載入查詢清單：沿用 {len(kept)}、新增或變更 {len(added)}、移除 {len(removed)} 個查詢")
+            due, group = sched.peek()
+            now = time.time()
+            if group is None:
+                if config is None:
+                    break
+                time.sleep(args.reload_sec)     # 清單暫時是空的：等它被編輯
+                continue
+            if until_dt and datetime.fromtimestamp(max(now, due)) >= until_dt:
+                log("到達指定時間，停止。")
+                break
+            if due > now:
+                # 熱載入時分段睡，檔案一改就能套用
+                time.sleep(min(due - now, args.reload_sec) if config is not None else due - now)
+                if config is not None:
+                    continue
+            sched.pop()
+            waited = limiter.acquire()
+            if waited:
+                log(f"速率上限：等待 {waited:.0f} 秒")
+            notified.add_many(notifier.drain())
+            notified.expire()
+
+            q = group.query
+            log(f"[{group.id}] 查詢 {q.origin}→{q.dest} {q.date} {q.time}（{len(group.members)} 個訂閱）")
+            try:
+                rows = scraper.search_and_save(q, group.csv, group.store, pool=pool, trace_sink=trace_sink)
+            except Exception as e:
+                log(f"[{group.id}] 抓票失敗：{e}")
+                rows = None
+
+            matched = {id(r): rules.match(r) for r in rows or []}
+            for job in list(group.detached):
+                if rows and fan_out(rows, job)[1]:
+                    # 拆出去的訂閱每輪都重新檢查：這次的結果涵蓋到了就併回，不必等到熱載入
+                    log(f"[{job.id}] 合併查詢已涵蓋 {job.query.time} 的班次，併回 [{group.id}]")
+                    group.rejoin(sched, job)
+            split = []
+            for job in group.members:
+                mine, covered = fan_out(rows or [], job)
+                if rows and not covered and job.query.time != q.time:
+                    # 合併查詢的結果沒涵蓋到這個訂閱的時段 → 拆出去單獨查
+                    split.append(job)
+                    continue
+                job.rounds += 1
+                job.last_run = time.time()
+                hits = [r for r in mine if job.id in matched[id(r)]]
+                job.hits += len(hits)
+                notify_new_hits(hits, notified, notifier, job.to or args.to, job.keyword, key_suffix=f"|{job.id}")
+
+            for job in split:
+                log(f"[{job.id}] 合併查詢未涵蓋 {job.query.time} 的班次，改為單獨查詢")
+                group.split(sched, job)
+            if group.members:
+                sched.reschedule(group.id, next_deadline(due, group.next_interval(policy)))
+            else:
+                sched.remove(group.id)
+    finally:
+        if dog is not None:
+            dog.close()
+        pool.close()
+
 def parse_until(until_str: str):
     if not until_str:
         return None
@@ -121,66 +486,167 @@ def parse_until(until_str: str):
 
 def main():
     ap = argparse.ArgumentParser(description="THSR 學生5折監看器（每 3~5 分鐘輪詢）")
-    ap.add_argument("--scraper", required=True, help="執行抓票指令（字串）")
+    ap.add_argument("--scraper", default="", help="執行抓票指令（字串）")
+    ap.add_argument("--queries", default="", help="多查詢模式：查詢清單 JSON（格式見 thsrc_scheduler.py），取代 --scraper")
+    ap.add_argument("--mode", choices=["inprocess", "subprocess"], default="inprocess",
+                    help="inprocess：同一 process 直接呼叫搜尋函式（預設）；subprocess：照舊用 shell 執行 --scraper")
     ap.add_argument("--csv", default="out.csv", help="抓票輸出的 CSV 路徑")
+    ap.add_argument("--store", default="",
+                    help="抓票寫入 SQLite 時填 sqlite:PATH（subprocess 模式改從資料庫撈新命中，不掃 CSV）；"
+                         "diff:PATH 則只讀新出現 / 消失的事件（兩種模式皆可，需與 --scraper 的 --store 相同）")
     ap.add_argument("--sender", required=True, help="寄件者 Gmail（需已啟用兩步驟＋App Password）")
-    ap.add_argument("--app_password", required=True, help="Gmail 應用程式專用密碼（16 碼）")
-    ap.add_argument("--to", required=True, help="收件者 Email")
+    ap.add_argument("--app_password", default="", help="Gmail 應用程式專用密碼（16 碼）")
+    ap.add_argument("--smtp", default="smtp.gmail.com:587", help="SMTP 伺服器 HOST:PORT")
+    ap.add_argument("--smtp_plain", action="store_true", help="不做 STARTTLS、不登入（接本機 aiosmtpd 之類的測試替身用）")
+    ap.add_argument("--digest_sec", type=float, default=0,
+                    help="同一收件者在這段秒數內的通知合併成一封摘要信（0=立即寄）")
+    ap.add_argument("--mail_backlog", type=int, default=100, help="背景寄信佇列上限（封）")
+    ap.add_argument("--mail_queue", default="", help="寄送失敗待重寄的佇列檔（預設與 --state 同目錄的 mail_queue.jsonl）")
+    ap.add_argument("--to", default="", help="收件者 Email（多查詢模式可在清單內逐筆指定）")
+    ap.add_argument("--rule", default=KEYWORD,
+                    help="單一查詢模式的命中規則，例如 學生5折、學生<=75折、早鳥、學生<=75折,早鳥<=8折（語法見 thsrc_rules.py）；"
+                         "多查詢模式寫在清單的 keyword")
     ap.add_argument("--state", default=".state/notified.txt", help="已通知記錄檔，避免重複寄")
     ap.add_argument("--min_sec", type=int, default=180, help="每輪最少等待秒數（預設 180=3 分鐘）")
     ap.add_argument("--max_sec", type=int, default=300, help="每輪最多等待秒數（預設 300=5 分鐘）")
     ap.add_argument("--until", default="", help="到此時間自動停止（例：2025-10-20 23:59）")
+    ap.add_argument("--adaptive", action="store_true",
+                    help="依離出發時間與歷史命中時段自動調整間隔（近出發 / 熱門時段較密，其餘放慢）")
+    ap.add_argument("--history", default="", help="--adaptive 用的歷史結果 SQLite 檔（預設取 --store 的 sqlite:PATH）")
+    ap.add_argument("--backoff", type=float, default=3.0, help="--adaptive 時冷門時段最多放慢到 --max_sec 的幾倍")
+    ap.add_argument("--trace", default="", help="inprocess 模式逐階段計時輸出（JSON Lines 檔；'-' 為 stdout）")
+    ap.add_argument("--pool_rounds", type=int, default=30, help="inprocess 模式下同一個瀏覽器最多重用幾輪（0=每輪重開）")
+    ap.add_argument("--pool_max_mb", type=int, default=0, help="瀏覽器行程記憶體超過此 MB 即回收（0=不檢查）")
+    ap.add_argument("--watchdog_sec", type=float, default=0,
+                    help="inprocess / 多查詢模式的看門狗：超過該階段最長正常等待再加此秒數沒有進度，就強制結束瀏覽器並回收"
+                         "（預設 0=關閉）")
+    ap.add_argument("--sessions", type=int, default=2, help="多查詢模式：同時保留的瀏覽器 session 上限")
+    ap.add_argument("--max_per_min", type=float, default=6, help="多查詢模式：全體查詢每分鐘最多幾次（0=不限）")
+    ap.add_argument("--coalesce_min", type=int, default=60,
+                    help="多查詢模式：同路線同日期、出發時間相差不超過此分鐘數的訂閱合併成一次查詢（0=不合併）")
+    ap.add_argument("--reload_sec", type=float, default=5,
+                    help="多查詢模式：每隔幾秒檢查 --queries 是否被修改並熱載入（也可送 SIGHUP；0=不熱載入）")
     args = ap.parse_args()
+    if not args.scraper and not args.queries:
+        ap.error("需指定 --scraper 或 --queries")
+    if args.scraper and not args.to:
+        ap.error("單一查詢模式需指定 --to")
+    if not args.smtp_plain and not args.app_password:
+        ap.error("需指定 --app_password（本機測試替身可改用 --smtp_plain）")
+    try:
+        until_dt = parse_until(args.until) if args.until else None
+        rule = compile_rules(args.rule)
+    except ValueError as e:
+        ap.error(str(e))
+    inproc_argv = scraper_argv(args.scraper) if args.mode == "inprocess" and not args.queries else None
+    if inproc_argv is not None:
+        # 先把 --scraper 參數驗一次：寫錯就立刻結束，不要每輪都失敗
+        import thsrc_search_v2_plus as scraper
+        try:
+            _, sargs = scraper.parse_query(inproc_argv)
+        except SystemExit:
+            log("--scraper 參數不正確")
+            sys.exit(2)
+        if args.store.startswith("diff:") and sargs.store != args.store:
+            log(f"注意：--store {args.store} 與 --scraper 的 --store（{sargs.store or '未指定'}）不同，將讀不到事件")
 
-    until_dt = parse_until(args.until) if args.until else None
-    notified = load_notified(args.state)
+    notified = NotifiedLog(args.state)
+    notifier = make_notifier(args)
+
+    if args.queries:
+        try:
+            run_multi(args, until_dt, notified, notifier)
+        except KeyboardInterrupt:
+            log("手動停止。")
+        finally:
+            notifier.close()
+            notified.add_many(notifier.drain())
+        return
+
+    if args.mode == "inprocess" and inproc_argv is None:
+        log("--scraper 不是 thsrc_search_v2_plus.py 指令，改用 subprocess 模式")
+    tail = CsvTail(args.csv, str(Path(args.state).parent / "csv_offset.json"))
+    db, db_cursor, db_next, diff_mode = None, 0, 0, False
+    if args.store:
+        from thsrc_store import SqliteStore, parse_store_spec
+        kind, path = parse_store_spec(args.store)
+        if kind == "sqlite":
+            db = SqliteStore(path)
+        elif kind == "diff":
+            from thsrc_diff import DiffStore
+            db, diff_mode = DiffStore(path), True
+    pool, trace_sink, dog = None, None, None
+    if inproc_argv is not None:
+        pool = make_pool(args)
+        from thsrc_trace import open_sink
+        trace_sink = open_sink(args.trace)
+        dog = make_watchdog(args, pool, trace_sink)
+
+    from thsrc_scheduler import next_deadline
+    policy = make_policy(args)
+    departure = scraper_departure(scraper_argv(args.scraper))
 
     log("開始監看（Ctrl+C 可中止）")
+    due = time.time()
     try:
         while True:
             if until_dt and datetime.now() >= until_dt:
                 log("到達指定時間，停止。")
                 break
+            notified.add_many(notifier.drain())
+            notified.expire()
+
+            if inproc_argv is not None and not diff_mode:
+                rows = filter_hits(run_inprocess(inproc_argv, pool, trace_sink) or [], rule)
+            else:
+                if inproc_argv is not None:
+                    run_inprocess(inproc_argv, pool, trace_sink)
+                else:
+                    rc = run_scraper(args.scraper)
+                    if rc != 0:
+                        log(f"抓票腳本回傳非 0（{rc}），略過本輪分析。")
+                if diff_mode:
+                    # 差異儲存：只看上一輪之後的出現 / 消失事件，沒變化的輪次什麼都不用讀
+                    events, db_next = db.events_since(db_cursor)
+                    events = [e for e in events if rule.test_text(e["discount_text"])]
+                    for e in events:
+                        if e["kind"] == "disappeared":
+                            log(f"折扣已消失：{e['date']} 車次 {e['code']} {e['departure']} {e['discount_text']}")
+                    rows = [TrainRow.from_dict(e) for e in events if e["kind"] == "appeared"]
+                elif db is not None:
+                    found, db_next = db.hits_since(db_cursor)
+                    rows = hits_from_dicts(found, rule)
+                else:
+                    rows = read_hits(args.csv, rule, tail)
+            queued = notify_new_hits(rows, notified, notifier, args.to, args.rule)
+            if queued:
+                # 通知沒能交付時不推進 CSV offset / 資料庫游標，下一輪會再讀到這些列
+                tail.commit()
+                db_cursor = max(db_cursor, db_next)
 
-            rc = run_scraper(args.scraper)
-            if rc != 0:
-                log(f"抓票腳本回傳非 0（{rc}），略過本輪分析。")
-
-            rows = read_hits(args.csv, KEYWORD)
-            # 去除已寄過的
-            new_rows = []
-            new_keys = []
-            for r in rows:
-                k = make_key(r)
-                if k not in notified:
-                    new_rows.append(r)
-                    new_keys.append(k)
-
-            if new_rows:
-                text_body, html_body = format_email(new_rows)
-                try:
-                    send_gmail_smtp(
-                        sender=args.sender,
-                        app_password=args.app_password,
-                        to=args.to,
-                        subject=f"[THSR] 偵測到 {KEYWORD} 共 {len(new_rows)} 筆",
-                        html_body=html_body,
-                        text_body=text_body,
-                    )
-                    log(f"已寄出通知信（{len(new_rows)} 筆）")
-                    # 記錄避免重複寄
-                    notified.update(new_keys)
-                    save_notified(args.state, notified)
-                except Exception as e:
-                    log(f"寄信失敗：{e}")
-
-            # 等待下一輪（3~5 分鐘隨機）
-            wait_s = random.randint(args.min_sec, args.max_sec)
-            log(f"下一輪等待 {wait_s} 秒…")
+            # 等待下一輪（預設 3~5 分鐘隨機；--adaptive 依出發時間與歷史調整）。
+            # 以本輪的預定開始時間起算，抓票耗時不會讓週期越拖越長
+            if policy is not None:
+                interval = policy.interval(args.min_sec, args.max_sec, departure, args.rule)
+            else:
+                interval = random.randint(args.min_sec, args.max_sec)
+            due = next_deadline(due, interval)
+            wait_s = max(0, due - time.time())
+            log(f"下一輪等待 {wait_s:.0f} 秒…")
             time.sleep(wait_s)
 
     except KeyboardInterrupt:
         log("手動停止。")
+    finally:
+        # 等背景寄信把佇列寄完，再記下確定寄出的 key
+        notifier.close()
+        notified.add_many(notifier.drain())
+        if dog is not None:
+            dog.close()
+        if pool is not None:
+            pool.close()
+        if db is not None:
+            db.close()
 
 if __name__ == "__main__":
     main()
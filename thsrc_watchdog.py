@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# thsrc_watchdog.py
+# 看門狗：監看每一輪查詢 / 訂位的進度，瀏覽器卡死時提早強制結束，不必等 submit_and_wait_step2 最多 6 次
+# 送出（每次 18 + 18 秒）與每次重解驗證碼一路耗完。預設關閉（--watchdog_sec 0），需要時再開。
+#
+# - 心跳來自 thsrc_trace：每輪開始、每個 span 開始 / 結束、每次 sp.retry() / sp.beat() 都算一次進度；
+#   流程在階段內的每個長等待（點擊、等遮罩、等 Step2、每次驗證碼嘗試）之間都會 sp.beat()。
+# - 背景執行緒每秒檢查：某輪超過預算沒有心跳，就強制結束該輪使用中的瀏覽器行程。
+#   預算 = 該階段兩次心跳之間最長的正常等待（取自流程裡的逾時設定，見 STAGE_TIMEOUT_SEC）+ --watchdog_sec，
+#   所以健康但慢的階段（page.goto 最多 60 秒）不會被誤殺。被卡住的 Playwright 呼叫會立刻丟例外，
+#   呼叫端照原本的錯誤處理走：SessionPool / 查詢引擎（thsrc_async）回收該瀏覽器，下一輪重開。
+# - 殺掉瀏覽器後 grace_sec 內那一輪仍沒結束（多半是 Playwright driver 自己卡住），再把 driver 一起結束，
+#   並呼叫 on_escalate（pool.invalidate：下一輪整個池 / 引擎重開）。
+# - 統計卡住的輪數、比例、卡在哪個階段，以及從發現到該輪結束的恢復時間；每次恢復寫一行日誌，
+#   有 trace sink 時另寫一筆 {"kind": "watchdog", ...} 紀錄，結束時印出摘要。
+#
+# 只在別的執行緒做兩件事：讀 pid、送 kill 訊號；不碰任何 Playwright 物件。
+# 需求：Linux 只用標準函式庫（讀 /proc）；Windows 需 pip install psutil 才找得到瀏覽器行程，否則只會記錄不會結束。
+#
+# 用法：
+#   dog = Watchdog.for_pool(pool, stall_sec=15, sink=trace_sink).start()
+#   ...（照常跑 RoundTrace 記錄的每一輪）
+#   dog.close()
+
+import threading
+import time
+import weakref
+from collections import Counter
+from datetime import datetime
+
+import thsrc_trace
+from thsrc_browser import browser_pids, descendant_pids, kill_pids
+
+# 各階段兩次心跳之間最長的正常等待（秒），取自流程裡的逾時設定；預算 = 這個值 + stall_sec
+DEFAULT_TIMEOUT_SEC = 30            # Playwright 預設逾時：launch、點擊、填欄位、等遮罩 / Step2（18~25 秒）
+STAGE_TIMEOUT_SEC = {
+    "goto": 60,                     # page.goto(timeout=60000)
+    "captcha": 40,                  # 單次嘗試：換圖 + 等圖 6 秒 + 截圖（預設逾時）+ OCR（第一次含載入模型）
+    "submit_and_wait_step2": 40,    # 送出後重解驗證碼的單次嘗試同 captcha
+}
+# 不經過瀏覽器的階段：卡住也不是瀏覽器的問題，不處理
+SKIP_STAGES = {"save"}
+
+def log(msg: str):
+    ts = datetime.now().strftime("%H:%M:%S")
+    print(f"[{ts}] {msg}")
+
+def kill_browsers() -> list:
+    """沒有 pool 時的預設動作：結束本 process 底下所有瀏覽器行程（保留 Playwright driver）。"""
+    return kill_pids(browser_pids())
+
+def kill_all() -> list:
+    """升級動作：連 Playwright driver 一起結束。"""
+    return kill_pids(descendant_pids())
+
+class _Round:
+    __slots__ = ("ref", "round_id", "kind", "stage", "beat", "last", "detected", "killed", "escalated")
+
+    def __init__(self, trace, now: float):
+        self.ref = weakref.ref(trace)
+        self.round_id = trace.round_id
+        self.kind = trace.kind
+        self.stage = ""
+        self.beat = now
+        self.detected = 0.0     # 發現卡住的時間；0 = 沒卡住
+        self.last = 0.0         # 卡住前最後一次心跳
+        self.killed = 0
+        self.escalated = False
+
+class Watchdog:
+    def __init__(self, stall_sec: float = 15, grace_sec: float = 15, poll_sec: float = 1.0,
+                 kill=kill_browsers, escalate=kill_all, on_escalate=None, sink=None, clock=time.monotonic):
+        """
+        stall_sec   ：超過該階段最長正常等待多少秒仍沒有心跳才算卡住
+        kill()      ：卡住時呼叫，回傳被結束的 pid list
+        escalate()  ：kill 之後 grace_sec 內仍沒恢復時呼叫
+        on_escalate ：escalate 之後呼叫（例如 pool.invalidate）
+        sink        ：thsrc_trace 的 sink；每次恢復寫一筆紀錄
+        clock       ：心跳與檢查用的時鐘（秒；測試時可換成假時鐘）
+        """
+        self.stall_sec = stall_sec
+        self.grace_sec = grace_sec
+        self.poll_sec = poll_sec
+        self.kill = kill
+        self.escalate = escalate
+        self.on_escalate = on_escalate
+        self.sink = sink
+        self.clock = clock
+        self._rounds = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # 統計
+        self.rounds = 0
+        self.stuck = 0
+        self.escalations = 0
+        self.recovery = []          # 每次卡住從發現到該輪結束的秒數
+        self.lost = []              # 每次卡住從最後一次心跳到該輪結束的秒數
+        self.stages = Counter()
+
+    @classmethod
+    def for_pool(cls, pool, **kw) -> "Watchdog":
+        """
+        只結束 pool 中使用中的瀏覽器；升級時讓 pool 下一輪整個重開。
+        pool 需有 busy_pids() / invalidate()：thsrc_browser.SessionPool 或 thsrc_async.BlockingSearchEngine。
+        """
+        return cls(kill=lambda: kill_pids(pool.busy_pids()), on_escalate=pool.invalidate, **kw)
+
+    def budget(self, stage: str) -> float:
+        return STAGE_TIMEOUT_SEC.get(stage, DEFAULT_TIMEOUT_SEC) + self.stall_sec
+
+    # -------- 心跳（在跑查詢的執行緒呼叫） --------
+    def _on_beat(self, trace, event: str, stage: str):
+        now = self.clock()
+        with self._lock:
+            r = self._rounds.get(trace.round_id)
+            if event == "finish":
+                if r is not None:
+                    del self._rounds[trace.round_id]
+                    self.rounds += 1
+                    if r.detected:
+                        self._recovered(r, now, outcome=stage)
+                return
+            if r is None:
+                r = self._rounds[trace.round_id] = _Round(trace, now)
+            r.beat = now
+            if event in ("span", "retry"):
+                r.stage = stage
+
+    def _recovered(self, r: _Round, now: float, outcome: str):
+        recovery = now - r.detected
+        lost = now - r.last
+        self.recovery.append(recovery)
+        self.lost.append(lost)
+        log(f"看門狗：{r.kind} 卡在 {r.stage or '(階段間)'} 的那一輪已結束（{outcome}），發現後 {recovery:.1f} 秒恢復；"
+            f"累計卡住 {self.stuck} / {self.rounds} 輪")
+        if self.sink is not None:
+            self.sink.write({
+                "kind": "watchdog", "round_id": r.round_id, "round_kind": r.kind, "stage": r.stage,
+                "outcome": outcome, "killed": r.killed, "escalated": r.escalated,
+                "stalled_ms": round((r.detected - r.last) * 1000, 1),
+                "recovery_ms": round(recovery * 1000, 1), "lost_ms": round(lost * 1000, 1),
+                "at": datetime.now().isoformat(timespec="seconds"),
+            })
+
+    # -------- 監看執行緒 --------
+    def check(self, now: float = None):
+        """檢查一次所有進行中的輪次（監看執行緒每 poll_sec 呼叫；也可直接呼叫）。"""
+        now = self.clock() if now is None else now
+        actions = []
+        with self._lock:
+            for rid, r in list(self._rounds.items()):
+                if r.ref() is None:
+                    # trace 沒有 finish 就被丟掉了（例如呼叫端沒給 trace），不再追蹤
+                    del self._rounds[rid]
+                    continue
+                if r.stage in SKIP_STAGES:
+                    continue
+                if not r.detected:
+                    idle = now - r.beat
+                    if idle > self.budget(r.stage):
+                        r.detected, r.last = now, r.beat
+                        self.stuck += 1
+                        self.stages[r.stage or "(階段間)"] += 1
+                        actions.append(("kill", r, idle))
+                elif not r.escalated and now - r.detected > self.grace_sec:
+                    r.escalated = True
+                    self.escalations += 1
+                    actions.append(("escalate", r, now - r.last))
+        # kill 在鎖外做：被卡住的執行緒醒來後會馬上呼叫 finish → _on_beat
+        for what, r, idle in actions:
+            stage = r.stage or "(階段間)"
+            if what == "kill":
+                pids = self._safe(self.kill)
+                with self._lock:
+                    r.killed += len(pids)
+                log(f"看門狗：{r.kind} 在 {stage} 已 {idle:.0f} 秒沒有進度，強制結束瀏覽器（{len(pids)} 個行程）")
+            else:
+                pids = self._safe(self.escalate)
+                log(f"看門狗：結束瀏覽器後仍未恢復（已 {idle:.0f} 秒），連同 Playwright driver 一起結束"
+                    f"（{len(pids)} 個行程）")
+                if self.on_escalate is not None:
+                    self._safe(self.on_escalate)
+
+    @staticmethod
+    def _safe(fn):
+        try:
+            return fn() or []
+        except Exception as e:
+            log(f"看門狗動作失敗：{e}")
+            return []
+
+    def _run(self):
+        while not self._stop.wait(self.poll_sec):
+            self.check()
+
+    def start(self) -> "Watchdog":
+        if self._thread is None:
+            thsrc_trace.add_listener(self._on_beat)
+            self._thread = threading.Thread(target=self._run, name="thsrc-watchdog", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=self.poll_sec + 1)
+            thsrc_trace.remove_listener(self._on_beat)
+            self._thread = None
+            if self.stuck:
+                log(self.summary())
+
+    # -------- 統計 --------
+    def stats(self) -> dict:
+        n = len(self.recovery)
+        return {
+            "rounds": self.rounds,
+            "stuck": self.stuck,
+            "stuck_rate": round(self.stuck / self.rounds, 4) if self.rounds else 0.0,
+            "escalations": self.escalations,
+            "recovery_avg_s": round(sum(self.recovery) / n, 1) if n else 0.0,
+            "recovery_max_s": round(max(self.recovery), 1) if n else 0.0,
+            "lost_s": round(sum(self.lost), 1),
+            "stages": dict(self.stages),
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        stages = "、".join(f"{k} {v}" for k, v in self.stages.most_common()) or "-"
+        return (f"看門狗統計：{s['rounds']} 輪中卡住 {s['stuck']} 輪（{s['stuck_rate'] * 100:.1f}%），"
+                f"升級 {s['escalations']} 次；恢復平均 {s['recovery_avg_s']} 秒、最長 {s['recovery_max_s']} 秒，"
+                f"共損失 {s['lost_s']} 秒；卡住階段：{stages}")